@@ -0,0 +1,121 @@
+"""
+模型客户端连接池的基准测试
+
+在本地启动一个兼容OpenAI接口的模拟服务，分别按"每次调用新建ChatOpenAI"（旧做法）
+和"复用LLMClientPool中的客户端"两种方式顺序调用N次，输出平均/中位耗时和服务端
+看到的TCP连接数；最后用8个线程共享连接池并发调用，检查连接复用情况。
+
+旧做法未传入http_client，langchain_openai会复用其缓存的默认httpx客户端，因此同样只用
+一个连接；两者的差距来自每次构建ChatOpenAI和OpenAI客户端的开销，而非握手。
+
+用法（在项目根目录执行）：
+    python benchmarks/bench_llm_pool.py [调用次数]
+    python benchmarks/bench_llm_pool.py 300 --tls cert.pem key.pem
+
+--tls时服务端使用给定的证书和私钥（证书需签发给localhost），客户端通过SSL_CERT_FILE信任该证书。
+"""
+import argparse
+import json
+import os
+import ssl
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+connections = set()
+
+
+class _CompletionHandler(BaseHTTPRequestHandler):
+    """对任意chat/completions请求立即返回固定的回答，并记录客户端连接"""
+
+    protocol_version = "HTTP/1.1"
+    # 关闭Nagle算法，避免长连接上的小响应被延迟确认拖慢
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        connections.add(self.client_address)
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({
+            "id": "bench", "object": "chat.completion", "created": 0, "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _serve(tls):
+    server = ThreadingHTTPServer(("localhost", 0), _CompletionHandler)
+    if tls:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*tls)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    scheme = "https" if tls else "http"
+    return server, f"{scheme}://localhost:{server.server_address[1]}/v1"
+
+
+def _measure(name, scheme, call, count):
+    call()
+    connections.clear()
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    print(f"{scheme:5} {name:8} 平均 {statistics.mean(timings) * 1000:6.2f} ms  "
+          f"中位 {statistics.median(timings) * 1000:6.2f} ms  连接数 {len(connections)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模型客户端连接池基准测试")
+    parser.add_argument("count", nargs="?", type=int, default=300, help="每种方式的顺序调用次数")
+    parser.add_argument("--tls", nargs=2, metavar=("CERT", "KEY"), help="使用HTTPS，指定服务端证书和私钥")
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    if args.tls:
+        os.environ["SSL_CERT_FILE"] = args.tls[0]
+
+    from langchain_openai import ChatOpenAI
+    from utils import LLMClientPool
+
+    server, url = _serve(args.tls)
+    scheme = "https" if args.tls else "http"
+
+    def per_call():
+        # 连接池之前的做法：每次分析新建ChatOpenAI，参数与原dataframe_agent相同
+        model = ChatOpenAI(base_url=url, api_key=os.getenv("OPENAI_API_KEY"), model="gpt-4o-mini",
+                           temperature=0, max_tokens=8192, streaming=False)
+        model.invoke("hi")
+
+    pool = LLMClientPool()
+
+    def pooled():
+        pool.get(url).invoke("hi")
+
+    try:
+        _measure("per-call", scheme, per_call, args.count)
+        _measure("pooled", scheme, pooled, args.count)
+        connections.clear()
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda _: pooled(), range(args.count)))
+        print(f"{scheme:5} pooled x8 线程：{args.count} 次请求共使用 {len(connections)} 个连接")
+    finally:
+        pool.close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
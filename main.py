@@ -10,10 +10,17 @@ import pandas as pd
 import streamlit as st
 import json
 import io
+import re
+import time
+import uuid
 import seaborn as sns
 import numpy as np
 
-from utils import dataframe_agent, load_data_file
+from utils import (dataframe_agent, load_data_file_cached, hash_uploaded_file, ingestion_cache, analysis_cache, python_tool_cache,
+                   analysis_warmer, analysis_single_flight, analysis_jobs, run_analysis_batch, chart_image_cache, chart_cache_key, figure_to_image, CHART_TYPES,
+                   dataset_fingerprint, set_dataset_fingerprint, filter_spec_fingerprint,
+                   analysis_budget, ANALYSIS_TIME_BUDGET, ANALYSIS_TOKEN_BUDGET, ANALYSIS_MAX_ITERATIONS,
+                   STREAMING_MEMORY_LIMIT_MB, COMPRESSION_FORMATS, ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_ADMIN)
 
 # 设置页面配置
 st.set_page_config(
@@ -831,182 +838,431 @@ div[data-baseweb="popover"] li[aria-selected="true"] {
 
 
 def render_chart(chart_data, style="默认"):
-    """渲染图表，支持不同样式"""
-    try:
-        # 设置图表样式
-        if style == "简洁":
-            plt.style.use('seaborn-v0_8-whitegrid')
-            colors = ['#2E86AB', '#A23B72', '#F18F01', '#C73E1D']
-        elif style == "专业":
-            plt.style.use('seaborn-v0_8-darkgrid')
-            colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd']
-        elif style == "彩色":
-            plt.style.use('seaborn-v0_8-bright')
-            colors = ['#FF6B6B', '#4ECDC4', '#45B7D1', '#96CEB4', '#FFEAA7', '#DDA0DD']
-        else:
-            plt.style.use('default')
-            colors = plt.cm.Set3.colors
+    """渲染图表，支持不同样式；渲染结果按图表数据和样式缓存，命中时不再调用pyplot"""
+    chart_type = next((name for name in CHART_TYPES if name in chart_data), None)
+    if chart_type is None:
+        st.error("不支持的图表类型")
+        return
+    
+    cache_key = chart_cache_key(chart_type, chart_data[chart_type], style)
+    image = chart_image_cache.get(cache_key)
+    if image is None:
+        fig = None
+        try:
+            fig = draw_chart(chart_data, style)
+            image = figure_to_image(fig)
+        except Exception as e:
+            st.error(f"图表渲染失败: {str(e)}")
+            return
+        finally:
+            if fig is not None:
+                plt.close(fig)
+        chart_image_cache.put(cache_key, image)
+    st.image(image, use_container_width=True)
+
+
+def draw_chart(chart_data, style="默认"):
+    """用matplotlib绘制图表并返回Figure，支持不同样式"""
+    # 设置图表样式
+    if style == "简洁":
+        plt.style.use('seaborn-v0_8-whitegrid')
+        colors = ['#2E86AB', '#A23B72', '#F18F01', '#C73E1D']
+    elif style == "专业":
+        plt.style.use('seaborn-v0_8-darkgrid')
+        colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd']
+    elif style == "彩色":
+        plt.style.use('seaborn-v0_8-bright')
+        colors = ['#FF6B6B', '#4ECDC4', '#45B7D1', '#96CEB4', '#FFEAA7', '#DDA0DD']
+    else:
+        plt.style.use('default')
+        colors = plt.cm.Set3.colors
+    
+    if "bar" in chart_data:
+        bar_data = chart_data["bar"]
+        fig, ax = plt.subplots(figsize=(12, 7))
+        # 兼容两种数据格式：columns/data 和 categories/values
+        categories = bar_data.get("columns", bar_data.get("categories", []))
+        values = bar_data.get("data", bar_data.get("values", []))
         
-        if "bar" in chart_data:
-            bar_data = chart_data["bar"]
-            fig, ax = plt.subplots(figsize=(12, 7))
-            # 兼容两种数据格式：columns/data 和 categories/values
-            categories = bar_data.get("columns", bar_data.get("categories", []))
-            values = bar_data.get("data", bar_data.get("values", []))
-            
-            # 确保categories和values是一维数组
-            if isinstance(categories[0], list) and len(categories[0]) == 1:
-                categories = [item[0] for item in categories]
-            if isinstance(values[0], list) and len(values[0]) == 1:
-                values = [item[0] for item in values]
-            
-            bars = ax.bar(categories, values, color=colors[:len(categories)])
-            ax.set_title("柱状图", fontsize=16, fontweight='bold', pad=20)
-            ax.set_xlabel("类别", fontsize=12)
-            ax.set_ylabel("数值", fontsize=12)
-            
-            # 添加数值标签
-            for bar, value in zip(bars, values):
-                height = bar.get_height()
-                ax.text(bar.get_x() + bar.get_width()/2., height + max(values)*0.01,
-                       f'{value:.1f}', ha='center', va='bottom', fontsize=10)
-            
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            st.pyplot(fig)
-            
-        elif "line" in chart_data:
-            line_data = chart_data["line"]
-            fig, ax = plt.subplots(figsize=(12, 7))
-            
-            line_color = colors[0] if colors else '#1f77b4'
-            
-            # 获取数据并确保是一维数组
-            columns = line_data["columns"]
-            data = line_data["data"]
-            
-            # 确保columns和data是一维数组
-            if isinstance(columns[0], list) and len(columns[0]) == 1:
-                columns = [item[0] for item in columns]
-            if isinstance(data[0], list) and len(data[0]) == 1:
-                data = [item[0] for item in data]
-                
-            ax.plot(columns, data, 
-                   marker='o', linewidth=2.5, markersize=6, color=line_color)
-            ax.set_title("折线图", fontsize=16, fontweight='bold', pad=20)
-            ax.set_xlabel("类别", fontsize=12)
-            ax.set_ylabel("数值", fontsize=12)
-            
-            # 添加网格
-            ax.grid(True, alpha=0.3)
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            st.pyplot(fig)
-            
-        elif "scatter" in chart_data:
-            scatter_data = chart_data["scatter"]
-            fig, ax = plt.subplots(figsize=(10, 8))
-            
-            scatter_color = colors[0] if colors else '#1f77b4'
-            
-            # 获取数据并确保是一维数组
-            x_data = scatter_data["x_data"]
-            y_data = scatter_data["y_data"]
-            
-            # 确保x_data和y_data是一维数组
-            if isinstance(x_data[0], list) and len(x_data[0]) == 1:
-                x_data = [item[0] for item in x_data]
-            if isinstance(y_data[0], list) and len(y_data[0]) == 1:
-                y_data = [item[0] for item in y_data]
-                
-            ax.scatter(x_data, y_data, 
-                      c=scatter_color, alpha=0.7, s=60, edgecolors='white', linewidth=1)
-            ax.set_title("散点图", fontsize=16, fontweight='bold', pad=20)
-            ax.set_xlabel("X轴", fontsize=12)
-            ax.set_ylabel("Y轴", fontsize=12)
-            
-            if "labels" in scatter_data:
-                for i, label in enumerate(scatter_data["labels"]):
-                    if i < len(scatter_data["x_data"]) and i < len(scatter_data["y_data"]):
-                        ax.annotate(label, (scatter_data["x_data"][i], scatter_data["y_data"][i]),
-                                  xytext=(5, 5), textcoords='offset points', fontsize=9)
-            
-            ax.grid(True, alpha=0.3)
-            plt.tight_layout()
-            st.pyplot(fig)
-            
-        elif "pie" in chart_data:
-            pie_data = chart_data["pie"]
-            fig, ax = plt.subplots(figsize=(10, 8))
-            
-            # 获取数据并确保是一维数组
-            values = pie_data["values"]
-            labels = pie_data["labels"]
-            
-            # 确保values和labels是一维数组
-            if isinstance(values[0], list) and len(values[0]) == 1:
-                values = [item[0] for item in values]
-            if isinstance(labels[0], list) and len(labels[0]) == 1:
-                labels = [item[0] for item in labels]
-                
-            wedges, texts, autotexts = ax.pie(values, labels=labels, 
-                                            autopct='%1.1f%%', colors=colors[:len(values)],
-                                            startangle=90, explode=[0.05]*len(values))
-            
-            ax.set_title("饼图", fontsize=16, fontweight='bold', pad=20)
-            
-            # 美化文字
-            for autotext in autotexts:
-                autotext.set_color('white')
-                autotext.set_fontweight('bold')
-                autotext.set_fontsize(10)
-            
-            plt.tight_layout()
-            st.pyplot(fig)
-            
-        elif "heatmap" in chart_data:
-            heatmap_data = chart_data["heatmap"]
-            fig, ax = plt.subplots(figsize=(12, 8))
-            
-            # 根据样式选择色彩映射
-            cmap_dict = {
-                "简洁": 'Blues',
-                "专业": 'viridis',
-                "彩色": 'plasma',
-                "默认": 'coolwarm'
-            }
-            cmap = cmap_dict.get(style, 'coolwarm')
-            
-            # 获取数据并确保格式正确
-            data = heatmap_data["data"]
-            x_labels = heatmap_data.get("x_labels", [])
-            y_labels = heatmap_data.get("y_labels", [])
-            
-            # 确保x_labels和y_labels是一维数组
-            if x_labels and isinstance(x_labels[0], list) and len(x_labels[0]) == 1:
-                x_labels = [item[0] for item in x_labels]
-            if y_labels and isinstance(y_labels[0], list) and len(y_labels[0]) == 1:
-                y_labels = [item[0] for item in y_labels]
-                
-            # 确保data是二维数组，如果是嵌套列表的列表，则提取内部值
-            if data and isinstance(data[0], list) and isinstance(data[0][0], list):
-                data = [[item[0] if isinstance(item, list) and len(item) == 1 else item for item in row] for row in data]
-                
-            sns.heatmap(data, 
-                       xticklabels=x_labels,
-                       yticklabels=y_labels,
-                       annot=True, cmap=cmap, ax=ax, fmt='.2f',
-                       cbar_kws={'shrink': 0.8})
+        # 确保categories和values是一维数组
+        if isinstance(categories[0], list) and len(categories[0]) == 1:
+            categories = [item[0] for item in categories]
+        if isinstance(values[0], list) and len(values[0]) == 1:
+            values = [item[0] for item in values]
+        
+        bars = ax.bar(categories, values, color=colors[:len(categories)])
+        ax.set_title("柱状图", fontsize=16, fontweight='bold', pad=20)
+        ax.set_xlabel("类别", fontsize=12)
+        ax.set_ylabel("数值", fontsize=12)
+        
+        # 添加数值标签
+        for bar, value in zip(bars, values):
+            height = bar.get_height()
+            ax.text(bar.get_x() + bar.get_width()/2., height + max(values)*0.01,
+                   f'{value:.1f}', ha='center', va='bottom', fontsize=10)
+        
+        plt.xticks(rotation=45, ha='right')
+        plt.tight_layout()
+        return fig
+        
+    elif "line" in chart_data:
+        line_data = chart_data["line"]
+        fig, ax = plt.subplots(figsize=(12, 7))
+        
+        line_color = colors[0] if colors else '#1f77b4'
+        
+        # 获取数据并确保是一维数组
+        columns = line_data["columns"]
+        data = line_data["data"]
+        
+        # 确保columns和data是一维数组
+        if isinstance(columns[0], list) and len(columns[0]) == 1:
+            columns = [item[0] for item in columns]
+        if isinstance(data[0], list) and len(data[0]) == 1:
+            data = [item[0] for item in data]
+            
+        ax.plot(columns, data, 
+               marker='o', linewidth=2.5, markersize=6, color=line_color)
+        ax.set_title("折线图", fontsize=16, fontweight='bold', pad=20)
+        ax.set_xlabel("类别", fontsize=12)
+        ax.set_ylabel("数值", fontsize=12)
+        
+        # 添加网格
+        ax.grid(True, alpha=0.3)
+        plt.xticks(rotation=45, ha='right')
+        plt.tight_layout()
+        return fig
+        
+    elif "scatter" in chart_data:
+        scatter_data = chart_data["scatter"]
+        fig, ax = plt.subplots(figsize=(10, 8))
+        
+        scatter_color = colors[0] if colors else '#1f77b4'
+        
+        # 获取数据并确保是一维数组
+        x_data = scatter_data["x_data"]
+        y_data = scatter_data["y_data"]
+        
+        # 确保x_data和y_data是一维数组
+        if isinstance(x_data[0], list) and len(x_data[0]) == 1:
+            x_data = [item[0] for item in x_data]
+        if isinstance(y_data[0], list) and len(y_data[0]) == 1:
+            y_data = [item[0] for item in y_data]
+            
+        ax.scatter(x_data, y_data, 
+                  c=scatter_color, alpha=0.7, s=60, edgecolors='white', linewidth=1)
+        ax.set_title("散点图", fontsize=16, fontweight='bold', pad=20)
+        ax.set_xlabel("X轴", fontsize=12)
+        ax.set_ylabel("Y轴", fontsize=12)
+        
+        if "labels" in scatter_data:
+            for i, label in enumerate(scatter_data["labels"]):
+                if i < len(scatter_data["x_data"]) and i < len(scatter_data["y_data"]):
+                    ax.annotate(label, (scatter_data["x_data"][i], scatter_data["y_data"][i]),
+                              xytext=(5, 5), textcoords='offset points', fontsize=9)
+        
+        ax.grid(True, alpha=0.3)
+        plt.tight_layout()
+        return fig
+        
+    elif "pie" in chart_data:
+        pie_data = chart_data["pie"]
+        fig, ax = plt.subplots(figsize=(10, 8))
+        
+        # 获取数据并确保是一维数组
+        values = pie_data["values"]
+        labels = pie_data["labels"]
+        
+        # 确保values和labels是一维数组
+        if isinstance(values[0], list) and len(values[0]) == 1:
+            values = [item[0] for item in values]
+        if isinstance(labels[0], list) and len(labels[0]) == 1:
+            labels = [item[0] for item in labels]
+            
+        wedges, texts, autotexts = ax.pie(values, labels=labels, 
+                                        autopct='%1.1f%%', colors=colors[:len(values)],
+                                        startangle=90, explode=[0.05]*len(values))
+        
+        ax.set_title("饼图", fontsize=16, fontweight='bold', pad=20)
+        
+        # 美化文字
+        for autotext in autotexts:
+            autotext.set_color('white')
+            autotext.set_fontweight('bold')
+            autotext.set_fontsize(10)
+        
+        plt.tight_layout()
+        return fig
+        
+    elif "heatmap" in chart_data:
+        heatmap_data = chart_data["heatmap"]
+        fig, ax = plt.subplots(figsize=(12, 8))
+        
+        # 根据样式选择色彩映射
+        cmap_dict = {
+            "简洁": 'Blues',
+            "专业": 'viridis',
+            "彩色": 'plasma',
+            "默认": 'coolwarm'
+        }
+        cmap = cmap_dict.get(style, 'coolwarm')
+        
+        # 获取数据并确保格式正确
+        data = heatmap_data["data"]
+        x_labels = heatmap_data.get("x_labels", [])
+        y_labels = heatmap_data.get("y_labels", [])
+        
+        # 确保x_labels和y_labels是一维数组
+        if x_labels and isinstance(x_labels[0], list) and len(x_labels[0]) == 1:
+            x_labels = [item[0] for item in x_labels]
+        if y_labels and isinstance(y_labels[0], list) and len(y_labels[0]) == 1:
+            y_labels = [item[0] for item in y_labels]
+            
+        # 确保data是二维数组，如果是嵌套列表的列表，则提取内部值
+        if data and isinstance(data[0], list) and isinstance(data[0][0], list):
+            data = [[item[0] if isinstance(item, list) and len(item) == 1 else item for item in row] for row in data]
+            
+        sns.heatmap(data, 
+                   xticklabels=x_labels,
+                   yticklabels=y_labels,
+                   annot=True, cmap=cmap, ax=ax, fmt='.2f',
+                   cbar_kws={'shrink': 0.8})
+        
+        ax.set_title("热力图", fontsize=16, fontweight='bold', pad=20)
+        plt.tight_layout()
+        return fig
+        
+    else:
+        raise ValueError("不支持的图表类型")
+
+
+def render_analysis_result(result, style="默认"):
+    """显示AI分析结果：文字答案、数据表格和图表"""
+    # 分析完成提示，预算耗尽时提示为部分结果
+    if result.get("partial"):
+        st.warning("⚠️ 分析在预算内未完成，以下为已得到的部分结果（不会写入缓存），可在“分析预算”中调整后重试")
+    else:
+        st.markdown("""
+        <div class="tech-card" style="border-color: #2ed573; background: rgba(46, 213, 115, 0.1); text-align: center;">
+            <h3 style="color: #2ed573; margin: 0;">✅ 分析完成！</h3>
+        </div>
+        """, unsafe_allow_html=True)
+
+    # 显示分析结果
+    if "answer" in result:
+        st.markdown("""
+        <div class="tech-card">
+            <h3 style="color: #00d4ff; margin-bottom: 1rem;">📝 AI分析结果</h3>
+            <p style="color: #b8c5d6; margin-bottom: 1rem;">基于数据特征的智能分析报告</p>
+        </div>
+        """, unsafe_allow_html=True)
+
+        st.markdown('<div class="tech-card">', unsafe_allow_html=True)
+        st.write(result["answer"])
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    # 显示表格
+    if "table" in result:
+        st.markdown("""
+        <div class="tech-card">
+            <h3 style="color: #00d4ff; margin-bottom: 1rem;">📊 数据表格</h3>
+            <p style="color: #b8c5d6; margin-bottom: 1rem;">分析过程中生成的数据表格</p>
+        </div>
+        """, unsafe_allow_html=True)
+
+        st.markdown('<div class="tech-card">', unsafe_allow_html=True)
+        st.dataframe(pd.DataFrame(data=result["table"]["data"],
+                                 columns=result["table"]["columns"]), use_container_width=True)
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    # 显示图表（传递用户选择的样式）
+    if "bar" in result:
+        st.markdown("""
+        <div class="tech-card">
+            <h3 style="color: #00d4ff; margin-bottom: 1rem;">📈 可视化图表</h3>
+            <p style="color: #b8c5d6; margin-bottom: 1rem;">基于分析结果生成的智能图表</p>
+        </div>
+        """, unsafe_allow_html=True)
+
+        render_chart(result, style)
+    if "line" in result:
+        render_chart(result, style)
+    if "scatter" in result:
+        render_chart(result, style)
+    if "pie" in result:
+        render_chart(result, style)
+    if "heatmap" in result:
+        render_chart(result, style)
+
+
+def show_cache_match(cache_info):
+    """显示分析结果的缓存命中情况"""
+    if cache_info.get("match") == "local":
+        st.caption("🧮 简单统计问题，已在本地直接计算（未调用AI模型）")
+    elif cache_info.get("match") == "exact":
+        st.caption("⚡ 命中分析缓存")
+    elif cache_info.get("match") == "inflight":
+        st.caption("🤝 已合并到进行中的相同分析")
+    elif cache_info.get("match") == "similar":
+        st.info(
+            f"♻️ 复用了相似问题的缓存结果（相似度 {cache_info['score']:.2f}）："
+            f"{cache_info['matched_query']}"
+        )
+
+
+@st.fragment(run_every=1.0)
+def show_analysis_job_progress(job_id):
+    """每秒局部刷新后台分析任务的进度，任务结束后刷新整个页面显示结果"""
+    job = analysis_jobs.status(job_id)
+    if job is None or job["status"] not in ("pending", "running"):
+        st.rerun()
+    st.info(f"{job['phase']}（已用时 {job['elapsed']:.0f} 秒，已执行 {job['steps']} 步）")
+    if st.button("⛔ 取消分析", key=f"cancel_analysis_{job_id}"):
+        analysis_jobs.cancel(job_id)
+        st.rerun()
+
+
+# 快速分析结果的标题
+QUICK_ANALYSIS_TITLES = {
+    "overview": "📋 数据概览结果",
+    "correlation": "🔗 相关性分析结果",
+    "distribution": "📊 分布分析结果",
+}
+
+
+def render_quick_result(name, result, style="默认"):
+    """显示单项快速分析的文字结果和图表"""
+    if not result:
+        return
+    if "answer" in result:
+        st.markdown(f"""
+        <div class="tech-card">
+            <h4 style="color: #00d4ff; margin-bottom: 1rem; font-size: 1.6rem;">{QUICK_ANALYSIS_TITLES[name]}</h4>
+        </div>
+        """, unsafe_allow_html=True)
+        
+        st.markdown('<div class="tech-card">', unsafe_allow_html=True)
+        st.write(result["answer"])
+        st.markdown('</div>', unsafe_allow_html=True)
+    if any(chart in result for chart in CHART_TYPES):
+        render_chart(result, style)
+
+
+def use_session_frame(frame):
+    """
+    把数据加载缓存中的DataFrame复制一份保存为当前会话的数据（st.session_state["df"]）
+
+    缓存对象由所有会话共享，不能交给可能原地修改数据的代理；同一缓存对象只复制一次，
+    之后的重新运行直接使用已保存的副本。
+    """
+    fingerprint = dataset_fingerprint(frame)
+    source = (id(frame), fingerprint)
+    if st.session_state.get("df_source") != source or "df" not in st.session_state:
+        session_df = frame.copy()
+        # 副本内容与缓存对象相同，沿用其指纹，避免重新哈希
+        set_dataset_fingerprint(session_df, fingerprint)
+        st.session_state["df"] = session_df
+        st.session_state["df_source"] = source
+    return st.session_state["df"]
+
+
+def build_quick_queries(num_rows, num_cols, numeric_cols, categorical_cols, quick_chart_type):
+    """构建快速分析的查询，按钮和后台预热使用相同的查询以命中同一缓存"""
+    overview_query = f"""
+            请对这个数据集进行全面的概览分析，包括：
+            1. 数据集基本信息（行数、列数、数据类型）
+            2. 数值变量的统计摘要
+            3. 分类变量的分布情况
+            4. 数据质量评估（缺失值、异常值）
+            5. 主要发现和洞察
             
-            ax.set_title("热力图", fontsize=16, fontweight='bold', pad=20)
-            plt.tight_layout()
-            st.pyplot(fig)
+            数据集包含 {num_rows} 行，{num_cols} 列。
+            数值列：{', '.join(numeric_cols[:5]) if numeric_cols else '无'}
+            分类列：{', '.join(categorical_cols[:5]) if categorical_cols else '无'}
+            """
+    
+    # 如果选择了特定图表类型，添加图表要求
+    if quick_chart_type != "自动选择":
+        chart_map = {
+            "柱形图": "请生成柱形图展示主要分类变量的分布。",
+            "折线图": "请生成折线图展示数值变量的趋势。",
+            "散点图": "请生成散点图展示两个主要数值变量的关系。",
+            "饼图": "请生成饼图展示主要分类变量的比例。",
+            "热力图": "请生成热力图展示数值变量间的相关性。"
+        }
+        overview_query += f"\n\n图表要求：{chart_map.get(quick_chart_type, '')}"
+    queries = {"overview": overview_query}
+    
+    if len(numeric_cols) >= 2:
+        correlation_query = f"""
+            请分析数值变量之间的相关性，包括：
+            1. 计算相关系数矩阵
+            2. 识别强相关关系（|r| > 0.7）
+            3. 生成相关性热力图
+            4. 解释相关性的业务含义
             
-        else:
-            st.error("不支持的图表类型")
+            重点分析这些数值列：{', '.join(numeric_cols[:10])}
+            """
+        
+        # 根据快速分析图表类型添加特定要求
+        if quick_chart_type == "热力图":
+            correlation_query += "\n\n图表要求：请生成热力图展示相关性矩阵。"
+        elif quick_chart_type == "散点图":
+            correlation_query += "\n\n图表要求：请生成散点图展示最相关的两个变量关系。"
+        elif quick_chart_type != "自动选择":
+            correlation_query += f"\n\n图表要求：请尽量生成{quick_chart_type}来展示相关性分析结果。"
+        queries["correlation"] = correlation_query
+    
+    if len(categorical_cols) >= 1:
+        distribution_query = f"""
+            请分析分类变量的分布情况，包括：
+            1. 各分类变量的频次统计
+            2. 生成条形图或饼图
+            3. 识别主要类别和异常分布
+            4. 提供分布特征的解释
             
-    except Exception as e:
-        st.error(f"图表渲染失败: {str(e)}")
+            重点分析这些分类列：{', '.join(categorical_cols[:5])}
+            """
+        
+        # 根据快速分析图表类型添加特定要求
+        if quick_chart_type == "柱形图":
+            distribution_query += "\n\n图表要求：请生成柱形图展示分类变量的频次分布。"
+        elif quick_chart_type == "饼图":
+            distribution_query += "\n\n图表要求：请生成饼图展示分类变量的比例分布。"
+        elif quick_chart_type != "自动选择":
+            distribution_query += f"\n\n图表要求：请尽量生成{quick_chart_type}来展示分布分析结果。"
+        queries["distribution"] = distribution_query
+    
+    return queries
+
+
+# 分析建议对应的查询
+SUGGESTION_QUERIES = {
+    "相关性分析": "请计算数值变量之间的相关系数矩阵，找出相关性最强的变量对并解释其含义。",
+    "散点图分析": "请选择相关性最强的两个数值变量，生成散点图展示它们的关系。",
+    "分类分析": "请统计各分类变量的取值分布，找出主要类别和占比。",
+    "分组统计": "请按主要分类变量分组，统计各组数值变量的均值和总和，并比较组间差异。",
+    "时间序列分析": "请按时间列分析数据随时间的变化规律。",
+    "趋势分析": "请生成折线图展示主要数值指标随时间的变化趋势。",
+    "大数据集分析": "请对数据进行聚合汇总，给出关键维度上的汇总统计。",
+    "统计摘要": "请给出数据集的统计摘要，重点关注数值变量的集中趋势和离散程度。",
+    "数据质量检查": "请检查数据质量，统计各列缺失值的数量和比例，并识别数值列中的异常值。"
+}
+
+
+def build_suggestion_queries(suggestions, numeric_cols, categorical_cols, datetime_cols):
+    """将分析建议转换为(建议名称, 查询)列表"""
+    context = (
+        f"\n数值列：{', '.join(numeric_cols[:10]) if numeric_cols else '无'}"
+        f"\n分类列：{', '.join(categorical_cols[:5]) if categorical_cols else '无'}"
+        f"\n时间列：{', '.join(datetime_cols[:3]) if datetime_cols else '无'}"
+    )
+    queries = []
+    for suggestion in suggestions:
+        match = re.search(r"\*\*(.+?)\*\*", suggestion)
+        if match and match.group(1) in SUGGESTION_QUERIES:
+            queries.append((match.group(1), SUGGESTION_QUERIES[match.group(1)] + context))
+    return queries
 
 
 # 主标题和欢迎界面
@@ -1073,6 +1329,12 @@ with col1:
         help="选择您要上传的文件格式类型"
     )
     selected_extensions = file_types[option]
+    # 同时接受压缩后的文件，如 data.csv.gz
+    upload_extensions = selected_extensions + [
+        f"{extension}.{compression}"
+        for extension in selected_extensions
+        for compression in COMPRESSION_FORMATS
+    ]
     
     # 显示支持的格式信息
     st.markdown(f"""
@@ -1080,15 +1342,68 @@ with col1:
         <h4 style="color: #00d4ff; margin: 0 0 0.4rem 0; font-size: 1.4rem;">📄 当前选择格式</h4>
         <p style="color: #ffffff; margin: 0; font-size: 1.4rem;">{option}</p>
         <p style="color: #ffffff; margin: 0.4rem 0 0 0; font-size: 1.2rem;">支持扩展名: {', '.join(selected_extensions)}</p>
+        <p style="color: #b8c5d6; margin: 0.4rem 0 0 0; font-size: 1.1rem;">可直接上传压缩文件: {', '.join('.' + c for c in COMPRESSION_FORMATS)}</p>
     </div>
     """, unsafe_allow_html=True)
+    
+    # 文件加载选项
+    load_options = {}
+    if option.startswith("Excel"):
+        load_options["parallel_sheets"] = st.checkbox(
+            "⚡ 并行预解析全部工作表",
+            value=False,
+            help="大型多工作表文件在多个进程中同时解析所有工作表，切换工作表时无需等待"
+        )
+    elif option.startswith(("CSV", "TSV", "JSON")):
+        load_options["streaming"] = st.checkbox(
+            "📦 分块流式读取",
+            value=False,
+            help="大文件（CSV/TSV/JSON Lines）按块读取并逐块压缩内存，显示读取进度"
+        )
+        if load_options["streaming"]:
+            load_options["memory_limit_mb"] = st.number_input(
+                "内存上限 (MB)",
+                min_value=64,
+                value=STREAMING_MEMORY_LIMIT_MB,
+                step=256,
+                help="解析结果超过该上限时停止读取或改为抽样"
+            )
+            load_options["sample_on_limit"] = st.checkbox(
+                "超出上限时自动抽样",
+                value=False,
+                help="超出内存上限时对整个文件均匀抽样，而不是报错停止"
+            )
+    elif option.startswith("Parquet"):
+        load_options["parquet_pushdown"] = st.checkbox(
+            "🎯 按需读取（列裁剪与谓词下推）",
+            value=True,
+            help="先只读取schema和行组统计，再按选中的列和数值范围读取数据，跳过不满足条件的行组"
+        )
+    if option.startswith(("CSV", "TSV", "TXT", "JSON")):
+        parse_engine = st.selectbox(
+            "⚙️ 解析引擎",
+            options=["C引擎（默认）", "PyArrow（多线程）"],
+            help="PyArrow引擎多线程解析分隔符文件和JSON Lines，大文件加载更快（流式读取时不适用）"
+        )
+        if parse_engine.startswith("PyArrow"):
+            load_options["engine"] = "pyarrow"
+            load_options["arrow_dtypes"] = st.checkbox(
+                "保留Arrow数据类型",
+                value=False,
+                help="列保持ArrowDtype类型，文本较多的数据表内存占用更小"
+            )
+    optimize_memory = st.checkbox(
+        "🧠 加载后压缩内存",
+        value=True,
+        help="将低基数文本列转换为分类类型，筛选、分析和缓存都会更快（数值列保持64位，避免计算溢出和聚合精度损失）"
+    )
     st.markdown('</div>', unsafe_allow_html=True)
 
 with col2:
     st.markdown('<div class="tech-card">', unsafe_allow_html=True)
     data = st.file_uploader(
         f"🚀 上传你的{option}数据文件", 
-        type=selected_extensions,
+        type=upload_extensions,
         help="支持多种数据格式：Excel、CSV、JSON、TSV、Parquet、TXT等"
     )
     
@@ -1122,10 +1437,59 @@ with col2:
 if data:
     try:
         # 显示加载进度
+        load_progress = st.progress(0.0, text="正在读取文件...") if load_options.get("streaming") else None
+        
+        def update_load_progress(fraction, rows):
+            load_progress.progress(fraction, text=f"已读取 {rows:,} 行（{fraction:.0%}）")
+        
+        # 同一个上传文件只哈希一次，之后的每次重新运行直接使用记录的内容哈希
+        upload_identity = (data.file_id, data.size)
+        if st.session_state.get("upload_hash_identity") != upload_identity:
+            st.session_state["upload_hash"] = hash_uploaded_file(data)
+            st.session_state["upload_hash_identity"] = upload_identity
+        
         with st.spinner('正在加载文件...'):
-            # 使用工具函数加载数据
-            df_result = load_data_file(data, option)
+            # 使用工具函数加载数据（相同文件内容直接命中缓存，避免重复解析）
+            df_result = load_data_file_cached(
+                data, option,
+                progress_callback=update_load_progress if load_progress is not None else None,
+                optimize_memory=optimize_memory,
+                content_hash=st.session_state["upload_hash"],
+                **load_options
+            )
+        if load_progress is not None:
+            load_progress.empty()
+        
+        load_summary = df_result.attrs.get("load_summary", {}) if isinstance(df_result, pd.DataFrame) else {}
+        if load_summary.get("encoding"):
+            st.caption(f"🔤 检测到文件编码：{load_summary['encoding']}")
+        if load_summary.get("detected_encoding", load_summary.get("encoding")) != load_summary.get("encoding"):
+            st.warning(
+                f"⚠️ 文件开头按 {load_summary['detected_encoding']} 编码检测，但后文出现了该编码无法解析的内容，"
+                f"已改用 {load_summary['encoding']} 重新解析，请核对中文等非ASCII内容是否正确"
+            )
+        compression = COMPRESSION_FORMATS.get(data.name.rsplit(".", 1)[-1].lower())
+        if compression:
+            st.caption(f"🗜️ 已流式解压 {compression} 压缩文件")
+        if load_summary.get("truncated_lines"):
+            truncated_lines = load_summary["truncated_lines"]
+            shown = "、".join(str(number) for number in truncated_lines[:20])
+            more = f" 等 {len(truncated_lines)} 行" if len(truncated_lines) > 20 else ""
+            st.warning(f"⚠️ 第 {shown}{more} 条记录的字段数多于表头，多出的字段已被截断，请核对原文件")
+        if load_summary.get("sampled"):
+            st.warning(
+                f"⚠️ 文件超出内存上限，已按 {load_summary['sample_rate']:.2%} 的比例均匀抽样："
+                f"共读取 {load_summary['rows_read']:,} 行，保留 {load_summary['rows_loaded']:,} 行"
+            )
         
+        ingestion_stats = ingestion_cache.stats()
+        st.caption(
+            f"⚡ 数据加载缓存：命中 {ingestion_stats['hits']} 次，未命中 {ingestion_stats['misses']} 次，"
+            f"已缓存 {ingestion_stats['entries']} 个文件（{ingestion_stats['bytes'] / 1024 / 1024:.1f} MB / "
+            f"{ingestion_stats['max_bytes'] / 1024 / 1024:.0f} MB）"
+        )
+        
+        parquet_source = None
         if isinstance(df_result, dict) and "sheets" in df_result:
             # Excel文件有多个工作表
             st.markdown("""
@@ -1144,24 +1508,12 @@ if data:
             </div>
             """, unsafe_allow_html=True)
             
-            sheet_info = []
-            for sheet_name, sheet_df in df_result['sheets'].items():
-                # 安全地处理数据类型，避免pyarrow转换错误
-                try:
-                    dtype_str = ", ".join([str(dt) for dt in sheet_df.dtypes.unique()[:3]])
-                except Exception:
-                    dtype_str = "混合类型"
-                
-                sheet_info.append({
-                    "工作表名称": sheet_name,
-                    "行数": sheet_df.shape[0],
-                    "列数": sheet_df.shape[1],
-                    "数据类型": dtype_str
-                })
+            # 工作表概览直接使用只读模式获取的元数据，无需解析每个工作表；已解析的工作表显示实际行列数
+            sheet_info = df_result["sheets"].sheet_info
             
             # 使用科技感的表格显示
             st.markdown('<div class="tech-card">', unsafe_allow_html=True)
-            st.dataframe(pd.DataFrame(sheet_info), use_container_width=True)
+            st.dataframe(pd.DataFrame(sheet_info).astype(str), use_container_width=True)
             st.markdown('</div>', unsafe_allow_html=True)
             
             # Excel文件有多个工作表
@@ -1171,7 +1523,11 @@ if data:
                 options=list(df_result["sheets"].keys()),
                 help="选择您要进行分析的工作表"
             )
-            st.session_state["df"] = df_result["sheets"][sheet_option]
+            # 只解析被选中的工作表
+            with st.spinner(f'正在解析工作表 {sheet_option}...'):
+                use_session_frame(df_result["sheets"][sheet_option])
+            if st.session_state["df"].empty:
+                st.warning(f"⚠️ 工作表 {sheet_option} 解析后没有数据，请选择其他工作表")
             st.markdown('</div>', unsafe_allow_html=True)
             
             # 显示详细的数据信息
@@ -1181,7 +1537,7 @@ if data:
             </div>
             """, unsafe_allow_html=True)
             
-            col1, col2, col3 = st.columns(3)
+            col1, col2, col3, col4 = st.columns(4)
             with col1:
                 st.markdown("""
                 <div class="metric-card">
@@ -1209,6 +1565,24 @@ if data:
                     <div style="color: #b8c5d6; text-align: center; font-size: 0.9rem;">缺失值</div>
                 </div>
                 """.format(color, icon, missing_count), unsafe_allow_html=True)
+            with col4:
+                sheet_summary = st.session_state["df"].attrs.get("load_summary", {})
+                if "memory_after" in sheet_summary:
+                    memory_text = "{:.1f} → {:.1f} MB".format(
+                        sheet_summary["memory_before"] / 1024 / 1024,
+                        sheet_summary["memory_after"] / 1024 / 1024
+                    )
+                else:
+                    memory_text = "{:.1f} MB".format(
+                        st.session_state["df"].memory_usage(deep=True).sum() / 1024 / 1024
+                    )
+                st.markdown("""
+                <div class="metric-card">
+                    <div style="font-size: 2rem; color: #00d4ff; text-align: center;">🧠</div>
+                    <div style="font-size: 1.8rem; font-weight: bold; color: #ffffff; text-align: center; margin: 0.5rem 0;">{}</div>
+                    <div style="color: #b8c5d6; text-align: center; font-size: 0.9rem;">内存占用</div>
+                </div>
+                """.format(memory_text), unsafe_allow_html=True)
             
             # 数据类型信息
             st.markdown("""
@@ -1234,8 +1608,17 @@ if data:
             st.dataframe(column_info, use_container_width=True)
             st.markdown('</div>', unsafe_allow_html=True)
         else:
-            # 单个数据框
-            st.session_state["df"] = df_result
+            # 单个数据框，或按需读取的Parquet数据源
+            if isinstance(df_result, dict) and "parquet" in df_result:
+                parquet_source = df_result["parquet"]
+                all_columns = parquet_source.columns
+                total_rows = parquet_source.num_rows
+                numeric_columns = parquet_source.numeric_columns
+            else:
+                use_session_frame(df_result)
+                all_columns = df_result.columns.tolist()
+                total_rows = len(df_result)
+                numeric_columns = df_result.select_dtypes(include=[np.number]).columns.tolist()
             
             # 成功加载提示
             st.markdown("""
@@ -1246,6 +1629,11 @@ if data:
                 </div>
             </div>
             """, unsafe_allow_html=True)
+            if "memory_after" in load_summary:
+                st.caption(
+                    f"🧠 内存占用：{load_summary['memory_before'] / 1024 / 1024:.1f} MB → "
+                    f"{load_summary['memory_after'] / 1024 / 1024:.1f} MB"
+                )
             
             # 数据筛选器
             st.markdown("""
@@ -1267,7 +1655,7 @@ if data:
                     start_row = st.number_input(
                         "起始行", 
                         min_value=0, 
-                        max_value=len(st.session_state["df"])-1, 
+                        max_value=total_rows-1, 
                         value=0,
                         help="选择数据的起始行号"
                     )
@@ -1275,8 +1663,8 @@ if data:
                     end_row = st.number_input(
                         "结束行", 
                         min_value=start_row+1, 
-                        max_value=len(st.session_state["df"]), 
-                        value=min(100, len(st.session_state["df"])),
+                        max_value=total_rows, 
+                        value=min(100, total_rows),
                         help="选择数据的结束行号"
                     )
                 
@@ -1286,23 +1674,26 @@ if data:
                 st.markdown("**📋 列选择筛选**")
                 selected_columns = st.multiselect(
                     "选择要显示的列",
-                    options=st.session_state["df"].columns.tolist(),
-                    default=st.session_state["df"].columns.tolist()[:5] if len(st.session_state["df"].columns) > 5 else st.session_state["df"].columns.tolist(),
+                    options=all_columns,
+                    default=all_columns[:5] if len(all_columns) > 5 else all_columns,
                     help="选择您要在分析中包含的列"
                 )
                 
                 # 数值列筛选
-                numeric_columns = st.session_state["df"].select_dtypes(include=[np.number]).columns.tolist()
+                filters = {}
                 if numeric_columns:
                     st.markdown("---")
                     st.markdown("**📊 数值列范围筛选**")
                     filter_cols = st.columns(min(3, len(numeric_columns)))
-                    filters = {}
                     
                     for i, col in enumerate(numeric_columns[:3]):  # 最多显示3个数值列的筛选器
                         with filter_cols[i % 3]:
-                            min_val = float(st.session_state["df"][col].min())
-                            max_val = float(st.session_state["df"][col].max())
+                            if parquet_source is not None:
+                                # 直接使用行组统计信息，无需读取整列
+                                min_val, max_val = map(float, parquet_source.column_range(col))
+                            else:
+                                min_val = float(st.session_state["df"][col].min())
+                                max_val = float(st.session_state["df"][col].max())
                             filters[col] = st.slider(
                                 f"{col} 范围",
                                 min_value=min_val,
@@ -1313,22 +1704,39 @@ if data:
                             )
                 
                 # 应用筛选
-                filtered_df = st.session_state["df"].copy()
-                
-                # 应用行筛选
-                filtered_df = filtered_df.iloc[start_row:end_row]
-                
-                # 应用列筛选
-                if selected_columns:
-                    filtered_df = filtered_df[selected_columns]
+                if parquet_source is not None:
+                    # 行范围、列选择和数值范围下推到Parquet读取，跳过无关的行组
+                    filtered_df = parquet_source.read(start_row, end_row, selected_columns, filters)
+                    st.session_state["df"] = filtered_df
+                    read_stats = parquet_source.last_read_stats
+                    st.caption(
+                        f"🎯 按需读取：{read_stats['row_groups_read']}/{read_stats['row_groups_total']} 个行组，"
+                        f"{read_stats['columns_read']}/{read_stats['columns_total']} 列"
+                    )
+                else:
+                    filtered_df = st.session_state["df"].copy()
+                    
+                    # 应用行筛选
+                    filtered_df = filtered_df.iloc[start_row:end_row]
+                    
+                    # 应用列筛选
+                    if selected_columns:
+                        filtered_df = filtered_df[selected_columns]
+                    
+                    # 应用数值筛选
+                    if numeric_columns:
+                        for col, (min_range, max_range) in filters.items():
+                            if col in filtered_df.columns:
+                                filtered_df = filtered_df[
+                                    (filtered_df[col] >= min_range) & (filtered_df[col] <= max_range)
+                                ]
                 
-                # 应用数值筛选
-                if numeric_columns:
-                    for col, (min_range, max_range) in filters.items():
-                        if col in filtered_df.columns:
-                            filtered_df = filtered_df[
-                                (filtered_df[col] >= min_range) & (filtered_df[col] <= max_range)
-                            ]
+                # 筛选结果的指纹由基础数据集指纹和筛选条件推导，无需重新哈希筛选后的数据
+                base_fingerprint = (parquet_source.fingerprint if parquet_source is not None
+                                    else dataset_fingerprint(df_result))
+                set_dataset_fingerprint(filtered_df, filter_spec_fingerprint(
+                    base_fingerprint, start_row, end_row, selected_columns, filters
+                ))
             
             st.markdown('</div>', unsafe_allow_html=True)
             
@@ -1341,7 +1749,7 @@ if data:
             
             col1, col2, col3, col4 = st.columns(4)
             with col1:
-                delta_rows = len(filtered_df) - len(st.session_state["df"])
+                delta_rows = len(filtered_df) - total_rows
                 delta_color = "#00d4ff" if delta_rows == 0 else "#ff6b35" if delta_rows < 0 else "#00ff88"
                 st.markdown("""
                 <div class="metric-card">
@@ -1352,7 +1760,7 @@ if data:
                 </div>
                 """.format(len(filtered_df), delta_color, delta_rows), unsafe_allow_html=True)
             with col2:
-                delta_cols = len(filtered_df.columns) - len(st.session_state["df"].columns)
+                delta_cols = len(filtered_df.columns) - len(all_columns)
                 delta_color = "#00d4ff" if delta_cols == 0 else "#ff6b35" if delta_cols < 0 else "#00ff88"
                 st.markdown("""
                 <div class="metric-card">
@@ -1372,7 +1780,7 @@ if data:
                 </div>
                 """.format(numeric_count), unsafe_allow_html=True)
             with col4:
-                text_count = len(filtered_df.select_dtypes(include=['object']).columns)
+                text_count = len(filtered_df.select_dtypes(include=['object', 'string', 'category']).columns)
                 st.markdown("""
                 <div class="metric-card">
                     <div style="font-size: 1.5rem; color: #00d4ff; text-align: center;">📝</div>
@@ -1428,7 +1836,10 @@ if data:
                 <div style="margin-top: 1rem; padding: 1rem; background: rgba(26, 31, 58, 0.6); border-radius: 8px; border: 1px solid rgba(0, 212, 255, 0.2);">
         """, unsafe_allow_html=True)
         
-        st.dataframe(st.session_state["df"].head(10), use_container_width=True)
+        if parquet_source is not None:
+            st.dataframe(parquet_source.preview(10), use_container_width=True)
+        else:
+            st.dataframe(st.session_state["df"].head(10), use_container_width=True)
         
         st.markdown("""
                 </div>
@@ -1580,8 +1991,36 @@ if "df" in st.session_state:
     col1, col2 = st.columns([3, 1])
     with col1:
         enable_streaming = st.checkbox("🔄 启用流式输出", value=False, help="实时显示AI分析过程")
+        enable_async = st.checkbox(
+            "⏳ 后台执行",
+            value=True,
+            disabled=enable_streaming,
+            help="分析在后台运行，期间页面可以继续操作，并可随时取消正在进行的分析"
+        )
     with col2:
-        enable_cache = st.checkbox("💾 启用缓存", value=True, help="缓存分析结果以提高响应速度")
+        enable_cache = st.checkbox("💾 启用缓存", value=True,
+                                   help="缓存分析结果以提高响应速度；取消勾选时本次分析重新计算并更新缓存")
+        enable_similarity = st.checkbox(
+            "🔍 复用相似问题",
+            value=False,
+            disabled=not enable_cache,
+            help="同一数据集上措辞相近的问题直接复用已缓存的分析结果"
+        )
+    
+    # 单次分析的预算，耗尽时提前结束并返回已得到的部分结果
+    with st.expander("⏱️ 分析预算"):
+        budget_cols = st.columns(3)
+        budget_seconds = budget_cols[0].number_input(
+            "最长时间（秒）", min_value=0, value=int(ANALYSIS_TIME_BUDGET), step=30, help="0表示不限制"
+        )
+        budget_tokens = budget_cols[1].number_input(
+            "token上限", min_value=0, value=ANALYSIS_TOKEN_BUDGET, step=10000,
+            help="所有模型调用的输入和输出token总数，0表示不限制"
+        )
+        budget_iterations = budget_cols[2].number_input(
+            "最大步数", min_value=1, value=ANALYSIS_MAX_ITERATIONS, step=1, help="代理最多执行的推理步数"
+        )
+    current_budget = analysis_budget(budget_seconds, budget_tokens, budget_iterations)
 else:
     # 当没有数据时显示提示
     st.markdown("""
@@ -1643,7 +2082,20 @@ if query:
                 style_instruction = style_instructions.get(chart_style, "")
                 enhanced_query += f"\n{style_instruction}"
         
-        if enable_streaming:
+        # 新的分析替换上一次的后台任务及其结果
+        previous_job = st.session_state.pop("analysis_job_id", None)
+        if previous_job:
+            analysis_jobs.discard(previous_job)
+        
+        result = None
+        if enable_async and not enable_streaming:
+            # 后台执行模式：提交任务后立即返回，下方轮询进度和结果
+            st.session_state["analysis_job_id"] = analysis_jobs.submit(
+                analysis_df, enhanced_query,
+                similarity=enable_cache and enable_similarity, use_cache=enable_cache, budget=current_budget
+            )
+            st.session_state["analysis_job_style"] = chart_style
+        elif enable_streaming:
             # 流式输出模式
             st.markdown("""
             <div class="tech-card">
@@ -1655,72 +2107,35 @@ if query:
             stream_container = st.empty()
             
             with st.spinner("🤖 AI正在深度分析数据中，请稍候..."):
-                result = dataframe_agent(analysis_df, enhanced_query, stream_container=stream_container)
+                result = dataframe_agent(analysis_df, enhanced_query, stream_container=stream_container,
+                                         budget=current_budget)
                 
         else:
-            # 普通模式（支持缓存）
-            if not enable_cache:
-                # 清除相关缓存
-                if hasattr(st, 'cache_data'):
-                    st.cache_data.clear()
-                    
+            # 普通模式（支持缓存，未启用时仅本次请求跳过缓存）
+            cache_info = {}
             with st.spinner("🤖 AI正在深度分析数据中，请稍候..."):
-                result = dataframe_agent(analysis_df, enhanced_query)
-                
-        if result:
-            # 分析完成提示
-            st.markdown("""
-            <div class="tech-card" style="border-color: #2ed573; background: rgba(46, 213, 115, 0.1); text-align: center;">
-                <h3 style="color: #2ed573; margin: 0;">✅ 分析完成！</h3>
-            </div>
-            """, unsafe_allow_html=True)
-            
-            # 显示分析结果
-            if "answer" in result:
-                st.markdown("""
-                <div class="tech-card">
-                    <h3 style="color: #00d4ff; margin-bottom: 1rem;">📝 AI分析结果</h3>
-                    <p style="color: #b8c5d6; margin-bottom: 1rem;">基于数据特征的智能分析报告</p>
-                </div>
-                """, unsafe_allow_html=True)
-                
-                st.markdown('<div class="tech-card">', unsafe_allow_html=True)
-                st.write(result["answer"])
-                st.markdown('</div>', unsafe_allow_html=True)
-            
-            # 显示表格
-            if "table" in result:
-                st.markdown("""
-                <div class="tech-card">
-                    <h3 style="color: #00d4ff; margin-bottom: 1rem;">📊 数据表格</h3>
-                    <p style="color: #b8c5d6; margin-bottom: 1rem;">分析过程中生成的数据表格</p>
-                </div>
-                """, unsafe_allow_html=True)
-                
-                st.markdown('<div class="tech-card">', unsafe_allow_html=True)
-                st.dataframe(pd.DataFrame(data=result["table"]["data"],
-                                         columns=result["table"]["columns"]), use_container_width=True)
-                st.markdown('</div>', unsafe_allow_html=True)
+                result = dataframe_agent(analysis_df, enhanced_query,
+                                         similarity=enable_cache and enable_similarity,
+                                         cache_info=cache_info, use_cache=enable_cache, budget=current_budget)
             
-            # 显示图表（传递用户选择的样式）
-            chart_style_param = chart_style if 'chart_style' in locals() else "默认"
-            if "bar" in result:
-                st.markdown("""
-                <div class="tech-card">
-                    <h3 style="color: #00d4ff; margin-bottom: 1rem;">📈 可视化图表</h3>
-                    <p style="color: #b8c5d6; margin-bottom: 1rem;">基于分析结果生成的智能图表</p>
-                </div>
-                """, unsafe_allow_html=True)
+            show_cache_match(cache_info)
                 
-                render_chart(result, chart_style_param)
-            if "line" in result:
-                render_chart(result, chart_style_param)
-            if "scatter" in result:
-                render_chart(result, chart_style_param)
-            if "pie" in result:
-                render_chart(result, chart_style_param)
-            if "heatmap" in result:
-                render_chart(result, chart_style_param)
+        if result:
+            render_analysis_result(result, chart_style)
+    
+    # 后台分析任务：进行中时轮询进度，结束后显示结果
+    analysis_job_id = st.session_state.get("analysis_job_id")
+    if analysis_job_id:
+        analysis_job = analysis_jobs.status(analysis_job_id)
+        if analysis_job is None:
+            st.session_state.pop("analysis_job_id", None)
+        elif analysis_job["status"] in ("pending", "running"):
+            show_analysis_job_progress(analysis_job_id)
+        elif analysis_job["status"] == "cancelled":
+            st.warning("⛔ 分析已取消")
+        else:
+            show_cache_match(analysis_job["cache_info"])
+            render_analysis_result(analysis_job["result"], st.session_state.get("analysis_job_style", "默认"))
                 
 # 添加数据分析建议功能
 if "df" in st.session_state:
@@ -1751,7 +2166,7 @@ if "df" in st.session_state:
         # 数据基本信息分析
         num_rows, num_cols = current_df.shape
         numeric_cols = current_df.select_dtypes(include=[np.number]).columns.tolist()
-        categorical_cols = current_df.select_dtypes(include=['object', 'category']).columns.tolist()
+        categorical_cols = current_df.select_dtypes(include=['object', 'category', 'string']).columns.tolist()
         datetime_cols = current_df.select_dtypes(include=['datetime64']).columns.tolist()
         
         # 生成建议
@@ -1798,6 +2213,22 @@ if "df" in st.session_state:
                 <p style="color: #ffffff; margin: 0; font-size: 1.2rem;">💡 上传更多数据以获得更详细的分析建议</p>
             </div>
             """, unsafe_allow_html=True)
+        
+        suggestion_queries = build_suggestion_queries(suggestions, numeric_cols, categorical_cols, datetime_cols)
+        if suggestion_queries:
+            suggestion_names = [name for name, _ in suggestion_queries]
+            selected_suggestion = st.selectbox("🎯 选择分析建议", suggestion_names, key="selected_suggestion")
+            if st.button("🚀 按建议分析", use_container_width=True):
+                with st.spinner(f"🔍 正在进行{selected_suggestion}..."):
+                    result = dataframe_agent(current_df, dict(suggestion_queries)[selected_suggestion],
+                                             use_cache=enable_cache, budget=current_budget)
+                if result:
+                    if "answer" in result:
+                        st.markdown('<div class="tech-card">', unsafe_allow_html=True)
+                        st.write(result["answer"])
+                        st.markdown('</div>', unsafe_allow_html=True)
+                    if any(chart in result for chart in ["bar", "line", "scatter", "pie", "heatmap"]):
+                        render_chart(result, chart_style if 'chart_style' in locals() else "默认")
     
     with col2:
         st.markdown("""
@@ -1816,119 +2247,130 @@ if "df" in st.session_state:
             help="为快速分析选择特定的图表类型"
         )
         
+        quick_queries = build_quick_queries(num_rows, num_cols, numeric_cols, categorical_cols, quick_chart_type)
+        
+        # 后台预热：数据加载后预先计算快速分析和分析建议，点击按钮时直接命中缓存
+        enable_warmup = st.checkbox(
+            "🔥 后台预热分析",
+            value=False,
+            key="enable_warmup",
+            disabled=not enable_cache,
+            help="在后台预先计算快速分析和分析建议的结果并写入缓存，切换数据集时自动取消；未启用缓存时不预热"
+        )
+        if "session_id" not in st.session_state:
+            st.session_state["session_id"] = uuid.uuid4().hex
+        # 预热的结果只能通过缓存使用，未启用缓存时预热只会白白消耗token
+        if enable_warmup and enable_cache:
+            analysis_warmer.warm(
+                st.session_state["session_id"], current_df,
+                list(quick_queries.values()) + [query for _, query in suggestion_queries],
+                budget=current_budget
+            )
+            warmup_status = analysis_warmer.status(st.session_state["session_id"])
+            st.caption(
+                f"🔥 后台预热：已完成 {warmup_status.get('done', 0)}/{warmup_status['total']}，"
+                f"进行中 {warmup_status.get('running', 0)}，失败 {warmup_status.get('failed', 0)}"
+            )
+        else:
+            analysis_warmer.cancel(st.session_state["session_id"])
+        
         # 快速分析按钮
         if st.button("📊 数据概览分析", help="生成数据的基本统计概览", use_container_width=True):
-            overview_query = f"""
-            请对这个数据集进行全面的概览分析，包括：
-            1. 数据集基本信息（行数、列数、数据类型）
-            2. 数值变量的统计摘要
-            3. 分类变量的分布情况
-            4. 数据质量评估（缺失值、异常值）
-            5. 主要发现和洞察
-            
-            数据集包含 {num_rows} 行，{num_cols} 列。
-            数值列：{', '.join(numeric_cols[:5]) if numeric_cols else '无'}
-            分类列：{', '.join(categorical_cols[:5]) if categorical_cols else '无'}
-            """
-            
-            # 如果选择了特定图表类型，添加图表要求
-            if quick_chart_type != "自动选择":
-                chart_map = {
-                    "柱形图": "请生成柱形图展示主要分类变量的分布。",
-                    "折线图": "请生成折线图展示数值变量的趋势。",
-                    "散点图": "请生成散点图展示两个主要数值变量的关系。",
-                    "饼图": "请生成饼图展示主要分类变量的比例。",
-                    "热力图": "请生成热力图展示数值变量间的相关性。"
-                }
-                overview_query += f"\n\n图表要求：{chart_map.get(quick_chart_type, '')}"
-            
             with st.spinner("🔍 正在生成数据概览分析..."):
-                result = dataframe_agent(current_df, overview_query)
-                if result and "answer" in result:
-                    st.markdown("""
-                    <div class="tech-card">
-                        <h4 style="color: #00d4ff; margin-bottom: 1rem; font-size: 1.6rem;">📋 数据概览结果</h4>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                    st.markdown('<div class="tech-card">', unsafe_allow_html=True)
-                    st.write(result["answer"])
-                    st.markdown('</div>', unsafe_allow_html=True)
+                result = dataframe_agent(current_df, quick_queries["overview"],
+                                         use_cache=enable_cache, budget=current_budget)
+                render_quick_result("overview", result, chart_style)
         
-        if len(numeric_cols) >= 2 and st.button("🔗 相关性分析", help="分析数值变量间的相关关系", use_container_width=True):
-            correlation_query = f"""
-            请分析数值变量之间的相关性，包括：
-            1. 计算相关系数矩阵
-            2. 识别强相关关系（|r| > 0.7）
-            3. 生成相关性热力图
-            4. 解释相关性的业务含义
-            
-            重点分析这些数值列：{', '.join(numeric_cols[:10])}
-            """
-            
-            # 根据快速分析图表类型添加特定要求
-            if quick_chart_type == "热力图":
-                correlation_query += "\n\n图表要求：请生成热力图展示相关性矩阵。"
-            elif quick_chart_type == "散点图":
-                correlation_query += "\n\n图表要求：请生成散点图展示最相关的两个变量关系。"
-            elif quick_chart_type != "自动选择":
-                correlation_query += f"\n\n图表要求：请尽量生成{quick_chart_type}来展示相关性分析结果。"
-            
+        if "correlation" in quick_queries and st.button("🔗 相关性分析", help="分析数值变量间的相关关系", use_container_width=True):
             with st.spinner("🔍 正在分析数据相关性..."):
-                result = dataframe_agent(current_df, correlation_query)
-                if result:
-                    if "answer" in result:
-                        st.markdown("""
-                        <div class="tech-card">
-                            <h4 style="color: #00d4ff; margin-bottom: 1rem; font-size: 1.6rem;">🔗 相关性分析结果</h4>
-                        </div>
-                        """, unsafe_allow_html=True)
-                        
-                        st.markdown('<div class="tech-card">', unsafe_allow_html=True)
-                        st.write(result["answer"])
-                        st.markdown('</div>', unsafe_allow_html=True)
-                    if "heatmap" in result:
-                        render_chart(result, chart_style_param)
+                result = dataframe_agent(current_df, quick_queries["correlation"],
+                                         use_cache=enable_cache, budget=current_budget)
+                render_quick_result("correlation", result, chart_style)
         
-        if len(categorical_cols) >= 1 and st.button("📊 分布分析", help="分析分类变量的分布"):
-            distribution_query = f"""
-            请分析分类变量的分布情况，包括：
-            1. 各分类变量的频次统计
-            2. 生成条形图或饼图
-            3. 识别主要类别和异常分布
-            4. 提供分布特征的解释
-            
-            重点分析这些分类列：{', '.join(categorical_cols[:5])}
-            """
-            
-            # 根据快速分析图表类型添加特定要求
-            if quick_chart_type == "柱形图":
-                distribution_query += "\n\n图表要求：请生成柱形图展示分类变量的频次分布。"
-            elif quick_chart_type == "饼图":
-                distribution_query += "\n\n图表要求：请生成饼图展示分类变量的比例分布。"
-            elif quick_chart_type != "自动选择":
-                distribution_query += f"\n\n图表要求：请尽量生成{quick_chart_type}来展示分布分析结果。"
-            
+        if "distribution" in quick_queries and st.button("📊 分布分析", help="分析分类变量的分布"):
             with st.spinner("正在分析分布..."):
-                result = dataframe_agent(current_df, distribution_query)
-                if result:
-                    if "answer" in result:
-                        st.write("##### 📊 分布分析结果")
-                        st.write(result["answer"])
-                    if any(chart_type in result for chart_type in ["bar", "pie"]):
-                        render_chart(result, chart_style_param)
+                result = dataframe_agent(current_df, quick_queries["distribution"],
+                                         use_cache=enable_cache, budget=current_budget)
+                render_quick_result("distribution", result, chart_style)
+        
+        # 全部分析：各项分析并发执行，每完成一项立即显示
+        if len(quick_queries) > 1 and st.button("🧩 全部分析", help="同时执行以上全部快速分析", use_container_width=True):
+            start = time.perf_counter()
+            placeholders = {name: st.empty() for name in quick_queries}
+            for name, placeholder in placeholders.items():
+                placeholder.info(f"⏳ 正在生成{QUICK_ANALYSIS_TITLES[name][2:]}...")
+            for name, result, elapsed in run_analysis_batch(current_df, quick_queries, use_cache=enable_cache,
+                                                            budget=current_budget):
+                with placeholders[name].container():
+                    render_quick_result(name, result, chart_style)
+                    st.caption(f"⏱️ {elapsed:.1f} 秒完成")
+            st.caption(f"✅ 全部分析完成，总耗时 {time.perf_counter() - start:.1f} 秒")
 
 # 添加缓存管理功能
 if "df" in st.session_state:
     with st.expander("🛠️ 缓存管理"):
+        # 当前分析数据的指纹；派生指纹（筛选、工作表）的前缀是上传文件的指纹
+        analysis_fingerprint = dataset_fingerprint(
+            st.session_state.get("filtered_df", st.session_state["df"])
+        )
+        file_fingerprint = analysis_fingerprint.split(":")[0]
+        
         col1, col2, col3 = st.columns(3)
         with col1:
-            if st.button("🗑️ 清除分析缓存"):
-                if hasattr(st, 'cache_data'):
-                    st.cache_data.clear()
-                    st.success("缓存已清除！")
+            if st.button("🗑️ 清除当前数据集缓存", help="清除当前文件在所有筛选条件下的分析缓存"):
+                removed = analysis_cache.invalidate(dataset=file_fingerprint)
+                st.success(f"已清除 {removed} 条当前数据集的分析缓存")
         with col2:
-            cache_info = st.empty()
-            cache_info.info("💾 缓存有效期：1小时")
+            cached_entries = analysis_cache.entries(analysis_fingerprint)
+            if cached_entries:
+                entry = st.selectbox(
+                    "已缓存的问题",
+                    cached_entries,
+                    format_func=lambda e: e["question"] + (f"（{e['variant']}）" if e["variant"] else ""),
+                    key="cache_entry_to_delete"
+                )
+                if st.button("❌ 删除该问题的缓存"):
+                    analysis_cache.delete(entry["key"])
+                    st.success("已删除该问题的缓存")
+            else:
+                st.info("当前数据集暂无已缓存的问题")
         with col3:
-            st.info("📊 缓存基于数据和查询内容生成唯一键")
+            # 分析缓存由所有会话和进程共享，全局清除只在管理员模式下提供
+            if ANALYSIS_CACHE_ADMIN:
+                if st.button("🧹 清除全部分析缓存", help="清除所有用户、所有数据集的分析缓存"):
+                    analysis_cache.clear()
+                    st.success("全部分析缓存已清除！")
+            else:
+                st.caption("🔒 分析缓存由所有用户共享，这里只能清除当前数据集的缓存；"
+                           "清除全部缓存需设置环境变量 ANALYSIS_CACHE_ADMIN=1")
+        
+        stats = analysis_cache.stats()
+        stat_cols = st.columns(4)
+        stat_cols[0].metric("缓存条目", f"{stats['entries']:,}")
+        stat_cols[1].metric(
+            "占用空间",
+            f"{stats['bytes'] / 1024 / 1024:.2f} MB",
+            help=f"空间预算 {stats['max_bytes'] / 1024 / 1024:.0f} MB，超出时淘汰最久未访问的条目"
+        )
+        stat_cols[2].metric(
+            "命中率",
+            f"{stats['hit_rate']:.1%}",
+            help=f"命中 {stats['hits']:,} 次，未命中 {stats['misses']:,} 次"
+        )
+        stat_cols[3].metric("平均节省耗时", f"{stats['mean_saved_seconds']:.1f} 秒")
+        st.caption(f"💾 缓存有效期：{ANALYSIS_CACHE_TTL / 3600:g}小时（重启后保留），缓存键由数据内容指纹和归一化后的问题生成")
+        tool_stats = python_tool_cache.stats()
+        st.caption(
+            f"🧮 代码执行缓存：{tool_stats['entries']} 条结果（{tool_stats['bytes'] / 1024:.1f} KB），"
+            f"命中 {tool_stats['hits']} 次，未命中 {tool_stats['misses']} 次"
+        )
+        chart_stats = chart_image_cache.stats()
+        st.caption(
+            f"🖼️ 图表渲染缓存：{chart_stats['entries']} 张图片（{chart_stats['bytes'] / 1024 / 1024:.1f} MB），"
+            f"命中 {chart_stats['hits']} 次，未命中 {chart_stats['misses']} 次"
+        )
+        flight_stats = analysis_single_flight.stats()
+        st.caption(
+            f"🤝 并发去重：执行 {flight_stats['executed']} 次分析，合并 {flight_stats['deduplicated']} 个相同请求，"
+            f"进行中 {flight_stats['in_flight']} 个，等待超时 {flight_stats['timeouts']} 次"
+        )
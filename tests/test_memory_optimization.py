@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+
+from utils import optimize_dataframe_memory
+
+
+def test_optimization_keeps_aggregates_exact():
+    # 每个值都能无损表示为float32，但float32累加的聚合结果会偏离
+    values = np.full(3_000_000, 12345.25)
+    df = pd.DataFrame({"amount": values, "qty": np.full(3_000_000, 200), "price": np.full(3_000_000, 300)})
+    expected_sum, expected_mean = df["amount"].sum(), df["amount"].mean()
+
+    optimized = optimize_dataframe_memory(df.copy())
+
+    assert optimized["amount"].dtype == np.float64
+    assert optimized["amount"].sum() == expected_sum
+    assert optimized["amount"].mean() == expected_mean
+    assert (optimized["qty"] * optimized["price"] == 60000).all()
+
+
+def test_optimization_converts_low_cardinality_text():
+    df = pd.DataFrame({"region": ["华东", "华北"] * 50})
+    assert isinstance(optimize_dataframe_memory(df)["region"].dtype, pd.CategoricalDtype)
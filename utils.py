@@ -5,17 +5,52 @@ Author: 骆昊
 Version: 0.1
 Date: 2025/6/25
 """
+import ast
+import asyncio
+import bz2
+import codecs
+import csv
+import gzip
 import json
+import orjson
+import os
+import re
+import sqlite3
+import threading
+import time
+import types
+import unicodedata
+import uuid
+import warnings
+import zipfile
+import zstandard
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.json as pajson
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import openpyxl
 import io
-import streamlit as st
 import hashlib
+import httpx
+import tiktoken
+
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
 from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
+from langchain_experimental.tools.python.tool import PythonAstREPLTool, sanitize_input
 from langchain.callbacks.base import BaseCallbackHandler
+from langchain_core.runnables.config import run_in_executor
+
+# 启动时读取一次.env，之后的配置项和模型客户端都直接使用环境变量
+load_dotenv()
 
 class StreamlitCallbackHandler(BaseCallbackHandler):
     """Streamlit流式输出回调处理器"""
@@ -47,6 +82,11 @@ class StreamlitCallbackHandler(BaseCallbackHandler):
     def on_tool_end(self, output: str, **kwargs) -> None:
         """工具执行完成时的回调"""
         self.container.success(f"✅ 工具执行完成")
+        
+    def on_text(self, text: str, **kwargs) -> None:
+        """代码执行命中缓存时的回调"""
+        if kwargs.get("tool_cache_hit"):
+            self.container.info(f"♻️ 代码执行命中缓存（第 {kwargs.get('step', '?')} 步）: {text}")
 
 PROMPT_TEMPLATE = """你是一位数据分析助手，你的回应内容取决于用户的请求内容，请按照下面的步骤处理用户请求：
 1. 思考阶段 (Thought) ：先分析用户请求类型（文字回答/表格/图表），并验证数据类型是否匹配。
@@ -84,259 +124,3223 @@ PROMPT_TEMPLATE = """你是一位数据分析助手，你的回应内容取决
 当前用户请求如下：\n"""
 
 
+# 数据指纹全量哈希的最大行数，超过后按等间距抽样行计算，可通过环境变量覆盖
+FINGERPRINT_FULL_ROWS = int(os.getenv("FINGERPRINT_FULL_ROWS", 2000000))
+# 抽样模式下参与哈希的行数（包含首尾各一块）
+FINGERPRINT_SAMPLE_ROWS = int(os.getenv("FINGERPRINT_SAMPLE_ROWS", 200000))
+
+
+def _hash_column(values):
+    """逐行计算列值的64位哈希（SipHash），返回哈希数组的字节"""
+    try:
+        hashed = pd.util.hash_pandas_object(values, index=False)
+    except TypeError:
+        # 字典、列表等不可哈希的值按字符串表示计算
+        hashed = pd.util.hash_pandas_object(values.astype(str), index=False)
+    return hashed.to_numpy().tobytes()
+
+
+def _fingerprint_rows(n_rows):
+    """返回参与哈希的行位置，None表示全部行"""
+    if n_rows <= FINGERPRINT_FULL_ROWS:
+        return None
+    edge = FINGERPRINT_SAMPLE_ROWS // 4
+    middle = np.linspace(edge, n_rows - edge - 1, FINGERPRINT_SAMPLE_ROWS - 2 * edge).astype(np.int64)
+    return np.concatenate([np.arange(edge), middle, np.arange(n_rows - edge, n_rows)])
+
+
+def dataset_fingerprint(df):
+    """
+    计算数据集内容指纹，相同内容的数据得到相同指纹
+
+    每列的值先用pandas向量化的SipHash逐行哈希，再将哈希数组汇总到blake2b中；
+    行数超过FINGERPRINT_FULL_ROWS时只哈希等间距抽样的行和首尾各一块。
+    指纹记录在df.attrs中并与对象id绑定，同一个已加载的数据集在多次重新运行间
+    只计算一次；复制或筛选得到的新对象会重新计算，除非用set_dataset_fingerprint指定。
+    """
+    cached = df.attrs.get("fingerprint")
+    if cached is not None and cached[0] == id(df) and cached[1] == df.shape:
+        return cached[2]
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(df.shape).encode())
+    positions = _fingerprint_rows(len(df))
+    digest.update(b"sampled" if positions is not None else b"full")
+    for i, col in enumerate(df.columns):
+        values = df.iloc[:, i]
+        if positions is not None:
+            values = values.iloc[positions]
+        digest.update(f"{col}\x00{values.dtype}\x00".encode())
+        digest.update(_hash_column(values))
+
+    return set_dataset_fingerprint(df, digest.hexdigest())
+
+
+def set_dataset_fingerprint(df, fingerprint):
+    """
+    为数据集指定指纹，之后dataset_fingerprint直接返回该值而不再哈希数据
+
+    用于指纹可以由来源推导的场景，例如上传文件的内容哈希，或基础数据集指纹加筛选条件。
+    """
+    df.attrs["fingerprint"] = (id(df), df.shape, fingerprint)
+    return fingerprint
+
+
+def filter_spec_fingerprint(base_fingerprint, start_row=0, end_row=None, columns=None, ranges=None):
+    """
+    由基础数据集指纹和归一化的筛选条件推导筛选后数据的指纹，计算量与数据大小无关
+
+    Args:
+        base_fingerprint: 筛选前数据集的指纹
+        start_row: 起始行号（包含）
+        end_row: 结束行号（不包含），None表示到末尾
+        columns: 选中的列，为空表示全部列
+        ranges: 数值列范围条件 {列名: (最小值, 最大值)}，未选中列上的条件不生效
+
+    Returns:
+        "基础指纹:筛选条件摘要"形式的指纹，按数据集失效时可匹配基础指纹的前缀
+    """
+    columns = [str(col) for col in columns] if columns else None
+    spec = {
+        "rows": [int(start_row), None if end_row is None else int(end_row)],
+        "columns": columns,
+        "ranges": sorted(
+            [str(col), float(low), float(high)] for col, (low, high) in (ranges or {}).items()
+            if columns is None or str(col) in columns
+        ),
+    }
+    digest = hashlib.blake2b(orjson.dumps(spec), digest_size=12).hexdigest()
+    return f"{base_fingerprint}:{digest}"
+
+
+# 界面在问题后追加的图表和样式要求块的开头
+QUERY_INSTRUCTION_MARKERS = ("图表要求：", "图表样式要求：")
+_CJK_SPACE_PATTERN = re.compile(r"(?<=[^\x00-\x7f]) | (?=[^\x00-\x7f])")
+# 问句末尾不影响含义的语气词和标点
+_QUERY_TRAILING_NOISE = re.compile(r"(?:[吗呢?!。.…~\s])+$")
+
+
+def normalize_query_text(text):
+    """
+    NFKC归一化（全角转半角）、忽略大小写、合并空白并去掉末尾的"吗"、问号等语气
+
+    其他标点原样保留："利润小于-5"与"利润小于5"、"超过10%"与"超过10"含义不同，不能共用缓存
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = " ".join(text.split())
+    text = _QUERY_TRAILING_NOISE.sub("", text)
+    # 中文字符之间的空格没有意义，"销售额 利润"与"销售额利润"视为相同
+    return _CJK_SPACE_PATTERN.sub("", text)
+
+
+def canonicalize_query(query):
+    """
+    将查询拆分为问题本身和追加的图表/样式要求，并分别归一化
+
+    Returns:
+        (归一化后的问题, 归一化后的要求块)，没有要求块时第二项为空字符串
+    """
+    question_lines, instructions = [], []
+    for line in query.splitlines():
+        stripped = unicodedata.normalize("NFKC", line).strip()
+        if any(stripped.startswith(unicodedata.normalize("NFKC", marker))
+               for marker in QUERY_INSTRUCTION_MARKERS):
+            instructions.append(normalize_query_text(stripped))
+        else:
+            question_lines.append(line)
+    return normalize_query_text("\n".join(question_lines)), "|".join(instructions)
+
+
 def generate_cache_key(df, query):
     """生成缓存键"""
-    # 使用数据框的形状、列名和查询内容生成唯一键
-    # 安全地处理数据类型，避免序列化错误
-    try:
-        dtype_dict = {col: str(dtype) for col, dtype in df.dtypes.to_dict().items()}
-    except Exception:
-        dtype_dict = {col: "unknown" for col in df.columns}
-    
-    df_info = f"{df.shape}_{list(df.columns)}_{dtype_dict}"
-    cache_string = f"{df_info}_{query}"
+    # 使用数据内容指纹和归一化后的查询生成唯一键，内容不同的同结构数据不会共用缓存
+    question, instructions = canonicalize_query(query)
+    cache_string = f"{dataset_fingerprint(df)}_{question}_{instructions}"
     return hashlib.md5(cache_string.encode()).hexdigest()
 
-@st.cache_data(ttl=3600)  # 缓存1小时
-def cached_dataframe_analysis(_df, query, cache_key):
-    """缓存的数据分析函数"""
-    return _perform_analysis(_df, query)
-
-def _perform_analysis(df, query):
-    """执行实际的数据分析"""
-    load_dotenv()
-    import os
-    model = ChatOpenAI(
-        base_url='https://oneapi.xty.app/v1',
-        api_key=os.getenv("OPENAI_API_KEY"),
-        model='gpt-4o-mini',
-        temperature=0,
-        max_tokens=8192,
-        streaming=False  # 关闭流式输出，确保格式一致性
-    )
-    agent = create_pandas_dataframe_agent(
-        llm=model,
-        df=df,
-        agent_executor_kwargs={"handle_parsing_errors": True},
-        max_iterations=32,
-        allow_dangerous_code=True,
-        verbose=True
+
+# 相似问题复用的最低相似度（字符n-gram余弦相似度）
+ANALYSIS_SIMILARITY_THRESHOLD = float(os.getenv("ANALYSIS_SIMILARITY_THRESHOLD", 0.85))
+# 相似度比较时最多检查的同数据集已缓存问题数量（按最近访问排序）
+ANALYSIS_SIMILARITY_MAX_CANDIDATES = int(os.getenv("ANALYSIS_SIMILARITY_MAX_CANDIDATES", 500))
+SIMILARITY_NGRAM_RANGE = (2, 3)
+# 决定问题含义的关键词：比较符、方向相反的词和否定词，两个问题中这些词（及数字）必须完全一致才算相似
+_QUERY_GUARD_TERMS = [
+    "不超过", "不低于", "不高于", "不少于", "不多于", "不等于", "不包括", "不包含", "大于等于", "小于等于",
+    "大于", "小于", "超过", "高于", "低于", "多于", "少于", "等于", "至少", "至多", "以上", "以下", "以内",
+    "最高", "最低", "最大", "最小", "最多", "最少", "最好", "最差", "最早", "最晚", "最新", "最旧",
+    "升序", "降序", "增长", "增加", "上升", "下降", "减少", "下跌", "盈利", "亏损", "前", "后",
+    "没有", "除了", "排除", "不", "非", "未", "无",
+    "not", "no", "without", "except", "exclude", "excluding", "top", "bottom", "first", "last",
+    "highest", "lowest", "largest", "smallest", "max", "min", "maximum", "minimum", "most", "least",
+    "more", "less", "greater", "fewer", "above", "below", "over", "under", "before", "after",
+    "ascending", "descending", "increase", "decrease", "best", "worst",
+]
+_QUERY_GUARD_PATTERN = re.compile(
+    r"-?\d+(?:\.\d+)?%?|[<>]=?|!=|==?|[≠≥≤]|"
+    + "|".join(
+        f"(?<![a-z]){re.escape(term)}(?![a-z])" if term.isascii() else re.escape(term)
+        for term in sorted(_QUERY_GUARD_TERMS, key=len, reverse=True)
     )
+)
 
-    prompt = PROMPT_TEMPLATE + query
 
-    try:
-        response = agent.invoke({"input": prompt})
-        # 增强JSON解析错误处理
+def _char_ngrams(text):
+    """统计文本的字符n-gram，过短的文本退化为单字"""
+    padded = f" {text} "
+    grams = Counter()
+    for n in range(SIMILARITY_NGRAM_RANGE[0], SIMILARITY_NGRAM_RANGE[1] + 1):
+        grams.update(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return grams or Counter(text)
+
+
+def query_similarity(a, b):
+    """两个归一化问题的字符n-gram余弦相似度，范围0~1，数字、比较符、反义词或否定词不同时为0"""
+    if a == b:
+        return 1.0
+    # "前5名"和"前10名"、"最高"和"最低"、"小于-5"和"小于5"字面相近但结果不同
+    if _QUERY_GUARD_PATTERN.findall(a) != _QUERY_GUARD_PATTERN.findall(b):
+        return 0.0
+    grams_a, grams_b = _char_ngrams(a), _char_ngrams(b)
+    dot = sum(count * grams_b[gram] for gram, count in grams_a.items())
+    if not dot:
+        return 0.0
+    norm_a = sum(count * count for count in grams_a.values()) ** 0.5
+    norm_b = sum(count * count for count in grams_b.values()) ** 0.5
+    return dot / (norm_a * norm_b)
+
+# 分析结果缓存的存储后端："sqlite"（持久化，多进程共享）或"memory"
+ANALYSIS_CACHE_BACKEND = os.getenv("ANALYSIS_CACHE_BACKEND", "sqlite")
+# SQLite缓存文件路径，默认位于项目目录下的.cache中
+ANALYSIS_CACHE_PATH = os.getenv(
+    "ANALYSIS_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "analysis_cache.db")
+)
+# 分析结果缓存的空间预算（压缩后字节），默认256MB
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# 分析结果默认有效期（秒），默认24小时
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", 24 * 3600))
+# 是否在页面上提供清除全部分析缓存的按钮；缓存由所有会话共享，默认只允许按数据集清除
+ANALYSIS_CACHE_ADMIN = os.getenv("ANALYSIS_CACHE_ADMIN", "0") == "1"
+# SQLite等待其他进程释放写锁的最长时间（秒）
+ANALYSIS_CACHE_BUSY_TIMEOUT = float(os.getenv("ANALYSIS_CACHE_BUSY_TIMEOUT", 5))
+# SQLite缓存命中时的访问时间和命中统计先记在进程内，至多每隔该秒数批量写入一次
+ANALYSIS_CACHE_FLUSH_INTERVAL = float(os.getenv("ANALYSIS_CACHE_FLUSH_INTERVAL", 10))
+
+
+class AnalysisCacheBackend:
+    """分析结果缓存后端的基类
+
+    结果以orjson序列化并用zstd压缩后存储，空间预算按压缩后的字节数计算。
+    子类实现_load、_store、_candidates、_entries_of、_delete_where、_clear和_usage
+    即可接入不同的存储；命中统计默认记录在进程内，子类可覆盖_record和_counters共享统计。
+    """
+
+    def __init__(self, max_bytes=ANALYSIS_CACHE_MAX_BYTES, ttl=ANALYSIS_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._counts = {"hits": 0, "misses": 0, "saved_seconds": 0.0}
+        self._counter_lock = threading.Lock()
+
+    @staticmethod
+    def _encode(value):
+        payload = orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+
+    @staticmethod
+    def _decode(blob):
+        return orjson.loads(zstandard.ZstdDecompressor().decompress(blob))
+
+    def lookup(self, key):
+        """
+        查找未过期的缓存结果，不计入命中统计
+
+        Returns:
+            (分析结果, 当初计算耗费的秒数)，不存在时返回(None, 0.0)
+        """
+        entry = self._load(key, time.time())
+        if entry is None:
+            return None, 0.0
+        return self._decode(entry[0]), entry[1]
+
+    def record(self, hit, saved_seconds=0.0):
+        """记录一次缓存请求的结果，命中时累计节省的计算时间"""
+        self._record(hit, saved_seconds)
+
+    def get(self, key):
+        """返回未过期的缓存结果并计入命中统计，不存在时返回None"""
+        value, elapsed = self.lookup(key)
+        self.record(value is not None, elapsed)
+        return value
+
+    def put(self, key, value, ttl=None, elapsed=0.0, dataset="", question="", variant=""):
+        """
+        写入缓存结果
+
+        Args:
+            key: 缓存键
+            value: 可JSON序列化的分析结果
+            ttl: 有效期（秒），默认使用ANALYSIS_CACHE_TTL
+            elapsed: 计算该结果耗费的秒数，命中时即为节省的时间
+            dataset: 数据集指纹，用于相似问题查找
+            question: 归一化后的问题
+            variant: 归一化后的图表/样式要求，相似问题只在要求相同时复用
+        """
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        meta = {"elapsed": elapsed, "dataset": dataset, "question": question, "variant": variant}
         try:
-            return json.loads(response["output"])
-        except json.JSONDecodeError:
-            # 如果JSON解析失败，返回原始文本作为答案
-            return {"answer": response["output"]}
-    except Exception as err:
-        print(f"分析错误: {err}")
-        return {"answer": "暂时无法提供分析结果，请稍后重试！"}
+            self._store(key, self._encode(value), now, now + ttl, meta)
+        except (TypeError, sqlite3.Error) as e:
+            # 结果无法序列化（如超出64位的整数）或其他进程长时间持有写锁时不缓存，不影响本次分析
+            print(f"分析缓存写入失败: {str(e)}")
 
-def dataframe_agent(df, query, stream_container=None):
-    """数据分析代理函数，支持缓存和流式输出"""
-    # 生成缓存键
-    cache_key = generate_cache_key(df, query)
-    
-    # 检查是否启用流式输出
-    if stream_container is not None:
-        return dataframe_agent_streaming(df, query, stream_container)
-    else:
-        # 使用缓存
-        return cached_dataframe_analysis(df, query, cache_key)
+    def find_similar(self, dataset, question, variant, threshold=None):
+        """
+        在同一数据集、相同图表要求的已缓存问题中查找最相似的一个
 
-def dataframe_agent_streaming(df, query, stream_container):
-    """支持流式输出的数据分析函数"""
-    load_dotenv()
-    import os
-    
-    # 创建流式回调处理器
-    callback_handler = StreamlitCallbackHandler(stream_container)
-    
-    model = ChatOpenAI(
-        base_url="https://api.openai-hk.com/v1",
-        api_key=os.getenv("OPENAI_API_KEY"),
-        model="gpt-4o-mini",
-        temperature=0,
-        max_tokens=8192,
-        streaming=False,  # 关闭模型级别的流式输出，避免格式解析问题
-        callbacks=[callback_handler]
-    )
-    agent = create_pandas_dataframe_agent(
-        llm=model,
-        df=df,
-        agent_executor_kwargs={"handle_parsing_errors": True},
-        max_iterations=32,
-        allow_dangerous_code=True,
-        verbose=True
-    )
+        Returns:
+            (缓存键, 相似度, 原问题)，没有达到阈值的问题时返回None
+        """
+        threshold = ANALYSIS_SIMILARITY_THRESHOLD if threshold is None else threshold
+        best = None
+        for key, cached_question in self._candidates(dataset, variant, time.time()):
+            score = query_similarity(question, cached_question)
+            if score >= threshold and (best is None or score > best[1]):
+                best = (key, score, cached_question)
+        return best
 
-    prompt = PROMPT_TEMPLATE + query
+    def entries(self, dataset):
+        """列出某个数据集已缓存的问题，按最近访问排序，每项包含key、question、variant和created"""
+        return self._entries_of(dataset, time.time())
 
-    try:
-        # 显示分析开始信息
-        stream_container.info("🤖 AI正在分析您的数据...")
-        response = agent.invoke({"input": prompt})
-        
-        # 尝试解析JSON响应
+    def delete(self, key):
+        self._delete_where(key=key)
+
+    def invalidate(self, dataset=None, question=None):
+        """
+        按数据集和/或归一化问题删除缓存条目
+
+        Args:
+            dataset: 数据集指纹，或指纹的列表/集合；同时删除由其派生（筛选、工作表）的指纹的条目
+            question: 归一化后的问题，为None时删除该数据集的全部条目
+
+        Returns:
+            删除的条目数量
+        """
+        if dataset is None and question is None:
+            raise ValueError("必须指定要失效的数据集或问题")
+        datasets = [dataset] if isinstance(dataset, str) else dataset
+        return self._delete_where(datasets=datasets, question=question)
+
+    def clear(self):
+        self._clear()
+
+    def _record(self, hit, saved_seconds):
+        with self._counter_lock:
+            if hit:
+                self._counts["hits"] += 1
+                self._counts["saved_seconds"] += saved_seconds
+            else:
+                self._counts["misses"] += 1
+
+    def _counters(self):
+        with self._counter_lock:
+            return dict(self._counts)
+
+    def stats(self):
+        """条目数、占用字节、命中次数、命中率和命中时平均节省的秒数"""
+        entries, size = self._usage()
+        counts = self._counters()
+        requests = counts["hits"] + counts["misses"]
+        return {
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": counts["hits"],
+            "misses": counts["misses"],
+            "hit_rate": counts["hits"] / requests if requests else 0.0,
+            "mean_saved_seconds": counts["saved_seconds"] / counts["hits"] if counts["hits"] else 0.0,
+        }
+
+
+class MemoryAnalysisCache(AnalysisCacheBackend):
+    """进程内的分析结果缓存，按最近使用顺序淘汰"""
+
+    def __init__(self, max_bytes=ANALYSIS_CACHE_MAX_BYTES, ttl=ANALYSIS_CACHE_TTL):
+        super().__init__(max_bytes, ttl)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _load(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires"] <= now:
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry["payload"], entry["elapsed"]
+
+    def _store(self, key, payload, now, expires, meta):
+        with self._lock:
+            self._pop(key)
+            if len(payload) > self.max_bytes:
+                return
+            self._entries[key] = {"payload": payload, "created": now, "expires": expires, **meta}
+            self._bytes += len(payload)
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry["payload"])
+
+    def _candidates(self, dataset, variant, now):
+        with self._lock:
+            matches = [
+                (key, entry["question"]) for key, entry in reversed(self._entries.items())
+                if entry["dataset"] == dataset and entry["variant"] == variant and entry["expires"] > now
+            ]
+        return matches[:ANALYSIS_SIMILARITY_MAX_CANDIDATES]
+
+    def _entries_of(self, dataset, now):
+        with self._lock:
+            return [
+                {"key": key, "question": entry["question"], "variant": entry["variant"],
+                 "created": entry["created"]}
+                for key, entry in reversed(self._entries.items())
+                if entry["dataset"] == dataset and entry["expires"] > now
+            ]
+
+    def _delete_where(self, key=None, datasets=None, question=None):
+        with self._lock:
+            if key is not None:
+                keys = [key] if key in self._entries else []
+            else:
+                keys = [
+                    k for k, entry in self._entries.items()
+                    if (datasets is None or any(
+                        entry["dataset"] == dataset or entry["dataset"].startswith(f"{dataset}:")
+                        for dataset in datasets
+                    ))
+                    and (question is None or entry["question"] == question)
+                ]
+            for k in keys:
+                self._pop(k)
+            return len(keys)
+
+    def _clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _usage(self):
+        with self._lock:
+            return len(self._entries), self._bytes
+
+
+class SQLiteAnalysisCache(AnalysisCacheBackend):
+    """基于SQLite的持久化分析结果缓存
+
+    重启后结果仍然有效，同一台机器上的多个Streamlit进程共享同一个缓存文件。
+    使用WAL模式让读写互不阻塞，写入在BEGIN IMMEDIATE事务中完成，
+    超出空间预算时按最近访问时间淘汰最旧的条目。每个线程使用独立的连接。
+    命中只读取数据库，访问时间和命中统计在进程内累积，
+    每隔flush_interval秒或下一次写入结果时批量写回，读取无需获取写锁。
+    """
+
+    def __init__(self, path=ANALYSIS_CACHE_PATH, max_bytes=ANALYSIS_CACHE_MAX_BYTES,
+                 ttl=ANALYSIS_CACHE_TTL, busy_timeout=ANALYSIS_CACHE_BUSY_TIMEOUT,
+                 flush_interval=ANALYSIS_CACHE_FLUSH_INTERVAL):
+        super().__init__(max_bytes, ttl)
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        # 尚未写回的访问时间 {key: 时间}，命中统计的增量记在基类的进程内计数中
+        self._pending_access = {}
+        self._last_flush = time.time()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS analysis_cache ("
+                " key TEXT PRIMARY KEY, payload BLOB NOT NULL, size INTEGER NOT NULL,"
+                " created REAL NOT NULL, expires REAL NOT NULL, last_access REAL NOT NULL,"
+                " elapsed REAL NOT NULL DEFAULT 0, dataset TEXT NOT NULL DEFAULT '',"
+                " question TEXT NOT NULL DEFAULT '', variant TEXT NOT NULL DEFAULT '')"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS analysis_cache_last_access ON analysis_cache (last_access)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS analysis_cache_dataset ON analysis_cache (dataset, variant)"
+            )
+            # 命中统计，多个进程共享
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS analysis_cache_stats (name TEXT PRIMARY KEY, value REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # 事务由_transaction显式控制
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """写事务，开始时即获取写锁，避免多进程同时写入时的死锁"""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            result = json.loads(response["output"])
-            stream_container.success("✅ 分析完成！")
-            return result
-        except json.JSONDecodeError as json_err:
-            # 如果JSON解析失败，返回原始文本
-            stream_container.warning("⚠️ 响应格式解析异常，返回原始结果")
-            return {"answer": response["output"]}
-            
-    except Exception as err:
-        error_msg = f"分析过程中出现错误: {str(err)}"
-        print(error_msg)
-        stream_container.error(error_msg)
-        return {"answer": "暂时无法提供分析结果，请稍后重试！"}
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _load(self, key, now):
+        # 过期条目留待下一次写入时统一删除
+        row = self._connection().execute(
+            "SELECT payload, elapsed FROM analysis_cache WHERE key = ? AND expires > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        with self._counter_lock:
+            self._pending_access[key] = now
+        self._maybe_flush(now)
+        return row[0], row[1]
+
+    def _take_pending(self):
+        """取出尚未写回的访问时间和命中统计增量，并清空进程内的记录"""
+        with self._counter_lock:
+            access, self._pending_access = self._pending_access, {}
+            counts = self._counts
+            self._counts = {"hits": 0, "misses": 0, "saved_seconds": 0.0}
+            self._last_flush = time.time()
+        return access, counts
+
+    def _write_pending(self, conn, access, counts):
+        conn.executemany(
+            "UPDATE analysis_cache SET last_access = MAX(last_access, ?) WHERE key = ?",
+            [(accessed, key) for key, accessed in access.items()]
+        )
+        conn.executemany(
+            "INSERT INTO analysis_cache_stats (name, value) VALUES (?, ?)"
+            " ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            [(name, value) for name, value in counts.items() if value]
+        )
+
+    def _maybe_flush(self, now):
+        """距上次写回超过flush_interval秒时批量写回访问时间和命中统计"""
+        if now - self._last_flush < self.flush_interval:
+            return
+        access, counts = self._take_pending()
+        if not access and not any(counts.values()):
+            return
+        try:
+            with self._transaction() as conn:
+                self._write_pending(conn, access, counts)
+        except sqlite3.OperationalError as e:
+            # 访问时间只用于淘汰顺序，其他进程长时间持有写锁时放弃这一批更新
+            print(f"分析缓存写回访问记录失败: {str(e)}")
+
+    def _store(self, key, payload, now, expires, meta):
+        if len(payload) > self.max_bytes:
+            return
+        access, counts = self._take_pending()
+        with self._transaction() as conn:
+            # 顺带写回累积的访问时间，淘汰顺序以此为准
+            self._write_pending(conn, access, counts)
+            conn.execute(
+                "INSERT OR REPLACE INTO analysis_cache"
+                " (key, payload, size, created, expires, last_access, elapsed, dataset, question, variant)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, expires, now, meta["elapsed"],
+                 meta["dataset"], meta["question"], meta["variant"])
+            )
+            conn.execute("DELETE FROM analysis_cache WHERE expires <= ?", (now,))
+            # 按最近访问时间从新到旧累计大小，删除超出预算的部分
+            conn.execute(
+                "DELETE FROM analysis_cache WHERE key IN ("
+                " SELECT key FROM (SELECT key, SUM(size) OVER"
+                " (ORDER BY last_access DESC, key) AS total FROM analysis_cache)"
+                " WHERE total > ?)",
+                (self.max_bytes,)
+            )
+
+    def _candidates(self, dataset, variant, now):
+        return self._connection().execute(
+            "SELECT key, question FROM analysis_cache"
+            " WHERE dataset = ? AND variant = ? AND expires > ?"
+            " ORDER BY last_access DESC LIMIT ?",
+            (dataset, variant, now, ANALYSIS_SIMILARITY_MAX_CANDIDATES)
+        ).fetchall()
+
+    def _entries_of(self, dataset, now):
+        rows = self._connection().execute(
+            "SELECT key, question, variant, created FROM analysis_cache"
+            " WHERE dataset = ? AND expires > ? ORDER BY last_access DESC",
+            (dataset, now)
+        ).fetchall()
+        return [dict(zip(("key", "question", "variant", "created"), row)) for row in rows]
+
+    def _delete_where(self, key=None, datasets=None, question=None):
+        if key is not None:
+            conditions, params = ["key = ?"], [key]
+        else:
+            conditions, params = [], []
+            if datasets is not None:
+                datasets = list(datasets)
+                conditions.append("(" + " OR ".join(
+                    "dataset = ? OR substr(dataset, 1, ?) = ?" for _ in datasets
+                ) + ")")
+                for dataset in datasets:
+                    params.extend([dataset, len(dataset) + 1, f"{dataset}:"])
+            if question is not None:
+                conditions.append("question = ?")
+                params.append(question)
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"DELETE FROM analysis_cache WHERE {' AND '.join(conditions)}", params
+            )
+            return cursor.rowcount
+
+    def _clear(self):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM analysis_cache")
+
+    def _record(self, hit, saved_seconds):
+        super()._record(hit, saved_seconds)
+        self._maybe_flush(time.time())
+
+    def _counters(self):
+        counts = {"hits": 0, "misses": 0, "saved_seconds": 0.0}
+        counts.update(self._connection().execute(
+            "SELECT name, value FROM analysis_cache_stats"
+        ).fetchall())
+        # 加上本进程尚未写回的增量
+        for name, value in super()._counters().items():
+            counts[name] += value
+        counts["hits"], counts["misses"] = int(counts["hits"]), int(counts["misses"])
+        return counts
+
+    def _usage(self):
+        entries, size = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analysis_cache WHERE expires > ?",
+            (time.time(),)
+        ).fetchone()
+        return entries, size
+
+
+def create_analysis_cache(backend=ANALYSIS_CACHE_BACKEND):
+    """按配置创建分析结果缓存，SQLite不可用时退回进程内缓存"""
+    if backend == "sqlite":
+        try:
+            return SQLiteAnalysisCache()
+        except (OSError, sqlite3.Error) as e:
+            print(f"SQLite分析缓存不可用，改用内存缓存: {str(e)}")
+    return MemoryAnalysisCache()
+
+
+analysis_cache = create_analysis_cache()
 
+# 分析失败时返回的结果，不写入缓存
+ANALYSIS_FAILED_RESULT = {"answer": "暂时无法提供分析结果，请稍后重试！"}
 
-def load_data_file(uploaded_file, file_type_option):
+
+# 等待进行中的相同分析的最长时间（秒）
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", 600))
+
+
+class SingleFlight:
+    """合并同一进程内并发的相同计算
+
+    同一个键同时只执行一次计算，其间到达的相同请求等待这次计算并得到同一结果；
+    计算抛出的异常同样传递给所有等待者，等待超时时抛出TimeoutError。
     """
-    加载不同格式的数据文件
-    
+
+    def __init__(self, timeout=SINGLE_FLIGHT_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.deduplicated = 0
+        self.timeouts = 0
+
+    def do(self, key, fn, timeout=None):
+        """
+        执行或等待键对应的计算
+
+        Returns:
+            (结果, 是否来自其他请求发起的计算)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+                self.executed += 1
+            else:
+                self.deduplicated += 1
+
+        if leader:
+            try:
+                call["result"] = fn()
+            except BaseException as e:
+                call["error"] = e
+                raise
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call["event"].set()
+            return call["result"], False
+
+        if not call["event"].wait(self.timeout if timeout is None else timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError("等待进行中的相同分析超时")
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"], True
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), "executed": self.executed,
+                    "deduplicated": self.deduplicated, "timeouts": self.timeouts}
+
+
+analysis_single_flight = SingleFlight()
+
+
+def lookup_cached_analysis(df, query, cache_key, similarity=False, cache_info=None):
+    """
+    只查找分析缓存，不执行分析，命中情况计入缓存统计
+
+    Returns:
+        缓存的分析结果，未命中时返回None（cache_info含义同cached_dataframe_analysis）
+    """
+    cache_info = {} if cache_info is None else cache_info
+    cache_info.clear()
+    cache_info["match"] = None
+    result, elapsed = analysis_cache.lookup(cache_key)
+    if result is not None:
+        cache_info.update(match="exact", score=1.0)
+    elif similarity:
+        question, variant = canonicalize_query(query)
+        similar = analysis_cache.find_similar(dataset_fingerprint(df), question, variant)
+        if similar is not None:
+            result, elapsed = analysis_cache.lookup(similar[0])
+            if result is not None:
+                cache_info.update(match="similar", score=similar[1], matched_query=similar[2])
+    analysis_cache.record(result is not None, elapsed)
+    return result
+
+
+def cached_dataframe_analysis(_df, query, cache_key, similarity=False, cache_info=None, use_cache=True, budget=None):
+    """
+    缓存的数据分析函数，结果保存在持久化缓存中
+
     Args:
-        uploaded_file: Streamlit上传的文件对象
-        file_type_option: 用户选择的文件类型选项
+        similarity: 精确键未命中时，是否复用同一数据集上相似问题的结果
+        cache_info: 可选的字典，写入命中情况：match为"exact"、"similar"或None，
+            相似命中时还包含score（相似度）和matched_query（原问题），
+            与进行中的相同分析合并时为"inflight"
+        use_cache: 为False时本次请求跳过缓存查找，重新分析并更新缓存，不影响其他请求
+        budget: 本次分析的预算（见analysis_budget），预算耗尽时返回不写入缓存的部分结果
     
+    未命中缓存时，并发的相同请求（相同缓存键）只执行一次分析。
+    """
+    cache_info = {} if cache_info is None else cache_info
+    if use_cache:
+        result = lookup_cached_analysis(_df, query, cache_key, similarity=similarity, cache_info=cache_info)
+        if result is not None:
+            return result
+    else:
+        cache_info.clear()
+        cache_info["match"] = None
+
+    # 共享的计算失败或被取消（例如后台预热被取消）时重试一次；重试同样经过并发去重，
+    # 同一批等待者只有一个重新分析，其余等待它的结果，再次失败时直接返回失败结果
+    for _ in range(2):
+        try:
+            result, shared = analysis_single_flight.do(
+                cache_key, lambda: _analyze_and_store(_df, query, cache_key, budget=budget)
+            )
+        except TimeoutError as e:
+            print(f"分析错误: {e}")
+            return dict(ANALYSIS_FAILED_RESULT)
+        if not shared or result != ANALYSIS_FAILED_RESULT:
+            break
+    if shared:
+        cache_info["match"] = "inflight"
+    return result
+
+
+def _analyze_and_store(df, query, cache_key, callbacks=None, budget=None):
+    """执行分析并将成功的结果写入分析缓存"""
+    start = time.perf_counter()
+    result = _perform_analysis(df, query, callbacks=callbacks, budget=budget)
+    _store_analysis(df, query, cache_key, result, time.perf_counter() - start)
+    return result
+
+
+def _store_analysis(df, query, cache_key, result, elapsed):
+    """将成功的分析结果写入分析缓存，失败结果和预算耗尽时的部分结果不缓存"""
+    if result != ANALYSIS_FAILED_RESULT and not (isinstance(result, dict) and result.get("partial")):
+        question, variant = canonicalize_query(query)
+        analysis_cache.put(cache_key, result, elapsed=elapsed,
+                           dataset=dataset_fingerprint(df), question=question, variant=variant)
+
+# 代码执行结果缓存的总内存上限（字节），默认64MB
+PYTHON_TOOL_CACHE_MAX_BYTES = int(os.getenv("PYTHON_TOOL_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# 单条结果超过该大小（字节）时不缓存，默认256KB
+PYTHON_TOOL_CACHE_MAX_RESULT_BYTES = int(os.getenv("PYTHON_TOOL_CACHE_MAX_RESULT_BYTES", 256 * 1024))
+# 可缓存代码中允许引用的内置函数
+_MEMO_SAFE_BUILTINS = {
+    "abs", "all", "any", "bool", "dict", "enumerate", "float", "int", "isinstance", "len", "list",
+    "max", "min", "print", "range", "repr", "round", "set", "sorted", "str", "sum", "tuple", "type", "zip",
+}
+# 会修改对象或产生外部副作用的方法
+_MUTATING_METHODS = {
+    "add", "append", "clear", "discard", "extend", "insert", "pop", "popitem", "remove", "reverse",
+    "setdefault", "sort", "update", "plot", "hist", "boxplot", "savefig", "show",
+    "to_clipboard", "to_csv", "to_excel", "to_feather", "to_hdf", "to_json", "to_parquet", "to_pickle", "to_sql",
+}
+_TOOL_ERROR_PATTERN = re.compile(r"^[A-Za-z_]\w*(Error|Exception|Warning|Interrupt|Exit): ")
+
+
+class BoundedLRUCache:
+    """存放字符串或字节结果的LRU缓存，按值的字节数限制总内存，过大的单个值不缓存"""
+
+    def __init__(self, max_bytes, max_item_bytes):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, str):
+            return len(value.encode("utf-8", errors="replace"))
+        return len(value)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        if size > self.max_item_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._sizeof(self._entries.pop(key))
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self._sizeof(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+python_tool_cache = BoundedLRUCache(PYTHON_TOOL_CACHE_MAX_BYTES, PYTHON_TOOL_CACHE_MAX_RESULT_BYTES)
+
+
+def _analyze_tool_code(tree, namespace, dataset_ids=frozenset()):
+    """
+    检查代理生成的代码能否按结果缓存，以及是否可能修改了数据
+
+    可缓存的代码只包含import语句和表达式语句，只引用数据集、已导入的模块、
+    安全的内置函数以及推导式/lambda内部的变量，且不调用会修改对象的方法。
+    数据集按对象身份（dataset_ids）判断：之前步骤中赋值得到的变量、或被重新赋值的df
+    不在缓存键中，引用它们的代码不缓存。
+
     Returns:
-        pandas.DataFrame 或包含多个工作表的字典
+        (能否缓存, 是否可能修改数据)
     """
-    file_extension = uploaded_file.name.split('.')[-1].lower()
-    
-    try:
-        if file_type_option.startswith("Excel"):
-            # Excel文件处理，添加错误处理
+    mutates = False
+    memoizable = True
+    bound = set()
+    loaded = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            if any(not isinstance(target, ast.Name) for target in targets):
+                mutates = True
+        elif isinstance(node, ast.Delete):
+            mutates = True
+        elif isinstance(node, ast.Call):
+            if any(kw.arg == "inplace" for kw in node.keywords):
+                mutates = True
+            if isinstance(node.func, ast.Attribute) and node.func.attr in _MUTATING_METHODS:
+                mutates = True
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            bound.update((alias.asname or alias.name).split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+            else:
+                bound.add(node.id)
+    for statement in tree.body:
+        if not isinstance(statement, (ast.Expr, ast.Import, ast.ImportFrom)):
+            memoizable = False
+    for name in loaded - bound - _MEMO_SAFE_BUILTINS:
+        value = namespace.get(name)
+        if not (isinstance(value, types.ModuleType) or id(value) in dataset_ids):
+            memoizable = False
+    return memoizable and not mutates, mutates
+
+
+class MemoizedPythonAstREPLTool(PythonAstREPLTool):
+    """带结果缓存的pandas代理Python工具
+
+    以归一化的代码（AST，忽略空白和注释）加数据集指纹为键缓存只读代码的输出，
+    同一会话内和不同问题之间重复执行的df.describe()、groupby汇总等直接返回缓存。
+    一旦执行了可能修改数据的代码，本次分析余下的步骤不再使用缓存。
+    """
+
+    dataset_key: str = ""
+    dataset_ids: frozenset = frozenset()
+    memo_enabled: bool = True
+    steps: int = 0
+    cache_hits: int = 0
+
+    def _run(self, query, run_manager=None):
+        self.steps += 1
+        code = sanitize_input(query) if self.sanitize_input else query
+        try:
+            tree = ast.parse(code)
+        except SyntaxError:
+            return super()._run(query, run_manager=run_manager)
+        namespace = {**(self.globals or {}), **(self.locals or {})}
+        memoizable, mutates = _analyze_tool_code(tree, namespace, self.dataset_ids)
+        key = None
+        if memoizable and self.memo_enabled:
+            key = hashlib.blake2b(
+                f"{self.dataset_key}\x00{ast.dump(tree)}".encode(), digest_size=16
+            ).hexdigest()
+            cached = python_tool_cache.get(key)
+            if cached is not None:
+                # import语句仍然执行，保证后续步骤引用的模块存在
+                imports = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+                if imports:
+                    exec(ast.unparse(ast.Module(imports, type_ignores=[])), self.globals, self.locals)
+                self.cache_hits += 1
+                if run_manager is not None:
+                    run_manager.on_text(ast.unparse(tree), tool_cache_hit=True, step=self.steps)
+                return cached
+
+        output = super()._run(query, run_manager=run_manager)
+        if mutates:
+            self.memo_enabled = False
+            # 数据可能已被原地修改，清除记录的指纹，之后按内容重新计算
+            for value in (self.locals or {}).values():
+                if isinstance(value, pd.DataFrame):
+                    value.attrs.pop("fingerprint", None)
+        if key is not None:
+            output_text = output if isinstance(output, str) else str(output)
+            if not _TOOL_ERROR_PATTERN.match(output_text):
+                python_tool_cache.put(key, output_text)
+        return output
+
+    async def _arun(self, query, run_manager=None):
+        # 基类在线程池中执行_run但不传递run_manager，缓存命中时无法在异步模式下报告进度
+        sync_manager = run_manager.get_sync() if run_manager is not None else None
+        return await run_in_executor(None, self._run, query, sync_manager)
+
+
+def _memoize_python_tool(agent, callbacks=None):
+    """将pandas代理的Python工具替换为带结果缓存的版本，返回替换后的工具"""
+    for i, tool in enumerate(agent.tools):
+        if isinstance(tool, PythonAstREPLTool):
+            frames = [value for value in tool.locals.values() if isinstance(value, pd.DataFrame)]
+            memo_tool = MemoizedPythonAstREPLTool(
+                globals=tool.globals,
+                locals=tool.locals,
+                dataset_key="|".join(dataset_fingerprint(frame) for frame in frames),
+                dataset_ids=frozenset(id(frame) for frame in frames),
+                callbacks=callbacks
+            )
+            agent.tools[i] = memo_tool
+            return memo_tool
+    return None
+
+
+# 模型服务连接池：每个服务地址的最大连接数和最大空闲长连接数
+LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", 20))
+LLM_POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", 10))
+# 空闲长连接的保留时间（秒）
+LLM_POOL_KEEPALIVE_EXPIRY = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", 60))
+# 建立连接和等待模型响应的超时（秒）
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 10))
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 120))
+
+
+class LLMClientPool:
+    """按服务地址和密钥复用的模型客户端
+
+    同一服务地址的所有会话共享一个httpx连接池，避免每次分析都重新建立连接和TLS握手；
+    httpx.Client和ChatOpenAI都可以在多个线程中并发使用。
+    异步连接池绑定事件循环，只在后台分析任务（AnalysisJobManager）的事件循环中使用。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._models = {}
+
+    def _http_client(self, base_url, client_class=httpx.Client):
+        key = (base_url, client_class)
+        client = self._clients.get(key)
+        if client is None:
+            client = client_class(
+                timeout=httpx.Timeout(LLM_REQUEST_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=LLM_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=LLM_POOL_KEEPALIVE_EXPIRY,
+                ),
+            )
+            self._clients[key] = client
+        return client
+
+    def get(self, base_url, model="gpt-4o-mini", callbacks=None):
+        """
+        获取指定服务地址的模型实例
+
+        Args:
+            callbacks: 模型级别的回调处理器，传入时返回共享连接池的浅拷贝，不影响其他会话
+        """
+        api_key = os.getenv("OPENAI_API_KEY")
+        key = (base_url, api_key, model)
+        with self._lock:
+            llm = self._models.get(key)
+            if llm is None:
+                llm = ChatOpenAI(
+                    base_url=base_url,
+                    api_key=api_key,
+                    model=model,
+                    temperature=0,
+                    max_tokens=8192,
+                    streaming=False,  # 关闭流式输出，确保格式一致性
+                    stream_usage=True,  # 代理内部以流式调用模型，开启后才能统计token用量
+                    timeout=httpx.Timeout(LLM_REQUEST_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+                    http_client=self._http_client(base_url),
+                    http_async_client=self._http_client(base_url, httpx.AsyncClient),
+                )
+                self._models[key] = llm
+        if callbacks:
+            return llm.model_copy(update={"callbacks": callbacks})
+        return llm
+
+    def close(self):
+        """关闭同步连接池（异步连接池随事件循环释放）"""
+        with self._lock:
+            for client in self._clients.values():
+                if isinstance(client, httpx.Client):
+                    client.close()
+            self._clients.clear()
+            self._models.clear()
+
+
+llm_pool = LLMClientPool()
+
+
+# 提示词中数据概况的token预算
+PROMPT_PROFILE_TOKEN_BUDGET = int(os.getenv("PROMPT_PROFILE_TOKEN_BUDGET", 1500))
+# 统计token时使用的模型编码
+PROMPT_TOKEN_MODEL = os.getenv("PROMPT_TOKEN_MODEL", "gpt-4o-mini")
+# 数据概况中的示例行数和每列展示的常见值个数
+PROFILE_SAMPLE_ROWS = int(os.getenv("PROFILE_SAMPLE_ROWS", 3))
+PROFILE_TOP_VALUES = int(os.getenv("PROFILE_TOP_VALUES", 5))
+# 超过该行数时，唯一值个数和常见值在抽样上统计
+PROFILE_STATS_MAX_ROWS = int(os.getenv("PROFILE_STATS_MAX_ROWS", 1000000))
+# 概况中单个值的最大显示长度
+PROFILE_MAX_VALUE_CHARS = 40
+
+_token_encoding = None
+_token_encoding_lock = threading.Lock()
+
+
+def count_tokens(text):
+    """
+    统计文本的token数
+
+    tiktoken的编码文件无法加载（例如离线环境）时按字符估算：
+    中日韩字符约1个token，其余约4个字符1个token。
+    """
+    global _token_encoding
+    with _token_encoding_lock:
+        if _token_encoding is None:
             try:
-                wb = openpyxl.load_workbook(uploaded_file)
-                if len(wb.sheetnames) > 1:
-                    # 多个工作表，返回字典
-                    sheets = {}
-                    for sheet_name in wb.sheetnames:
-                        try:
-                            df = pd.read_excel(uploaded_file, sheet_name=sheet_name)
-                            if not df.empty:  # 只添加非空工作表
-                                sheets[sheet_name] = df
-                        except Exception as e:
-                            print(f"跳过工作表 {sheet_name}: {str(e)}")
-                    
-                    if not sheets:
-                        raise ValueError("所有工作表都无法读取或为空")
-                    return {"sheets": sheets}
-                else:
-                    # 单个工作表
-                    return pd.read_excel(uploaded_file)
+                _token_encoding = tiktoken.encoding_for_model(PROMPT_TOKEN_MODEL)
             except Exception as e:
-                raise ValueError(f"Excel文件读取失败: {str(e)}")
+                print(f"tiktoken编码加载失败，改为估算token数: {e}")
+                _token_encoding = False
+    if _token_encoding:
+        return len(_token_encoding.encode(text, disallowed_special=()))
+    wide = sum(1 for char in text if ord(char) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _format_profile_value(value):
+    """格式化概况中的单个值，浮点数保留4位有效数字，过长的值截断"""
+    if isinstance(value, (float, np.floating)):
+        text = f"{value:.4g}"
+    else:
+        text = str(value)
+    if len(text) > PROFILE_MAX_VALUE_CHARS:
+        text = text[:PROFILE_MAX_VALUE_CHARS] + "…"
+    return text
+
+
+def _profile_column(name, series, stats_series, sampled, detail):
+    """
+    生成单列的概况描述
+
+    Args:
+        detail: 详细程度，2包含常见值，1包含空值率、唯一值和范围，0只有列名和类型
+    """
+    parts = [f"`{name}` {series.dtype}"]
+    if detail == 0:
+        return "- " + " ".join(parts)
+
+    null_rate = series.isna().mean() if len(series) else 0.0
+    parts.append(f"空值{null_rate:.1%}" if null_rate else "无空值")
+    parts.append(f"唯一值{'≈' if sampled else ''}{stats_series.nunique(dropna=True)}")
+
+    is_number = pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype)
+    if is_number or pd.api.types.is_datetime64_any_dtype(series.dtype):
+        valid = series.dropna()
+        if len(valid):
+            parts.append(f"范围[{_format_profile_value(valid.min())}, {_format_profile_value(valid.max())}]")
+            if is_number:
+                parts.append(f"均值{_format_profile_value(valid.mean())}")
+        return "- " + " ".join(parts)
+
+    if detail >= 2:
+        top = stats_series.value_counts(dropna=True).head(PROFILE_TOP_VALUES)
+        if len(top):
+            values = ", ".join(f"{_format_profile_value(value)}({count})" for value, count in top.items())
+            parts.append(f"常见值: {values}")
+    return "- " + " ".join(parts)
+
+
+def _profile_sample_rows(df, rows):
+    """随机抽取若干代表性的行，按原顺序输出为CSV"""
+    if rows <= 0 or df.empty:
+        return ""
+    sample = df.sample(min(rows, len(df)), random_state=0).sort_index()
+    sample = sample.apply(lambda column: column.map(_format_profile_value) if column.dtype == object else column)
+    return sample.to_csv(index=False).strip()
+
+
+dataset_profile_cache = BoundedLRUCache(16 * 1024 * 1024, 1024 * 1024)
+
+
+def build_dataset_profile(df, budget=PROMPT_PROFILE_TOKEN_BUDGET):
+    """
+    生成数据集的紧凑概况：列类型、空值率、唯一值个数、取值范围、常见值和示例行
+
+    概况超出token预算时依次去掉常见值、减少示例行、只保留列名和类型，
+    最后截断列清单。结果按数据指纹和预算缓存。
+
+    Returns:
+        (概况文本, token数)
+    """
+    cache_key = f"{dataset_fingerprint(df)}:{budget}"
+    profile = dataset_profile_cache.get(cache_key)
+    if profile is not None:
+        return profile, count_tokens(profile)
+
+    sampled = len(df) > PROFILE_STATS_MAX_ROWS
+    stats_df = df.sample(PROFILE_STATS_MAX_ROWS, random_state=0) if sampled else df
+    header = f"df共{len(df)}行、{len(df.columns)}列，各列概况："
+    column_lines = {}
+
+    def render(detail, rows, max_columns=None):
+        if detail not in column_lines:
+            column_lines[detail] = [
+                _profile_column(name, df[name], stats_df[name], sampled, detail)
+                for name in df.columns
+            ]
+        lines = column_lines[detail]
+        if max_columns is not None and max_columns < len(lines):
+            lines = lines[:max_columns] + [f"- …另有{len(df.columns) - max_columns}列未列出，可通过df.columns查看"]
+        text = "\n".join([header] + lines)
+        sample = _profile_sample_rows(df, rows)
+        if sample:
+            text += f"\n示例行：\n{sample}"
+        return text
+
+    profile = None
+    for detail, rows in ((2, PROFILE_SAMPLE_ROWS), (1, PROFILE_SAMPLE_ROWS), (1, 1), (0, 1), (0, 0)):
+        text = render(detail, rows)
+        if count_tokens(text) <= budget:
+            profile = text
+            break
+    if profile is None:
+        # 二分查找预算内能列出的最多列数
+        low, high = 0, len(df.columns)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if count_tokens(render(0, 0, middle)) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        profile = render(0, 0, low)
+
+    dataset_profile_cache.put(cache_key, profile)
+    return profile, count_tokens(profile)
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """累计一次分析中各次模型调用的token用量"""
+
+    run_inline = True
+
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def on_llm_end(self, response, **kwargs):
+        self.calls += 1
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                self.input_tokens += usage.get("input_tokens", 0)
+                self.output_tokens += usage.get("output_tokens", 0)
+
+
+# 单次分析的默认预算：最长时间（秒）、token用量（输入+输出）和代理最大步数，0表示不限制
+ANALYSIS_TIME_BUDGET = float(os.getenv("ANALYSIS_TIME_BUDGET", 180))
+ANALYSIS_TOKEN_BUDGET = int(os.getenv("ANALYSIS_TOKEN_BUDGET", 100000))
+ANALYSIS_MAX_ITERATIONS = int(os.getenv("ANALYSIS_MAX_ITERATIONS", 32))
+# 预算耗尽时部分结果中保留的中间表格行数
+ANALYSIS_PARTIAL_TABLE_ROWS = int(os.getenv("ANALYSIS_PARTIAL_TABLE_ROWS", 50))
+# 代理达到最大步数时AgentExecutor返回的输出
+_AGENT_STOPPED_OUTPUT = "Agent stopped due to iteration limit or time limit."
+
+
+def analysis_budget(seconds=None, tokens=None, iterations=None):
+    """生成分析预算字典，未指定的项使用默认值"""
+    return {
+        "seconds": ANALYSIS_TIME_BUDGET if seconds is None else seconds,
+        "tokens": ANALYSIS_TOKEN_BUDGET if tokens is None else tokens,
+        "iterations": ANALYSIS_MAX_ITERATIONS if iterations is None else iterations,
+    }
+
+
+class AnalysisBudgetExceeded(Exception):
+    """分析超出时间或token预算"""
+
+
+class AnalysisMonitor(TokenUsageHandler):
+    """记录一次分析中各步骤的耗时和token用量，超出预算时在下一次调用模型或执行工具前中止"""
+
+    raise_error = True
+
+    def __init__(self, budget=None):
+        super().__init__()
+        self.budget = budget or analysis_budget()
+        self.start = time.perf_counter()
+        self.steps = []
+        self.last_observation = None
+        self.last_thought = None
+        self._running = {}
+
+    def _check(self):
+        seconds, tokens = self.budget["seconds"], self.budget["tokens"]
+        if seconds and time.perf_counter() - self.start > seconds:
+            raise AnalysisBudgetExceeded(f"分析超出时间预算（{seconds:g}秒）")
+        if tokens and self.input_tokens + self.output_tokens > tokens:
+            raise AnalysisBudgetExceeded(f"分析超出token预算（{tokens}）")
+
+    def _begin(self, run_id, kind, name):
+        self._check()
+        self._running[run_id] = (kind, name, time.perf_counter())
+
+    def _end(self, run_id):
+        kind, name, start = self._running.pop(run_id, (None, None, None))
+        if kind is not None:
+            self.steps.append((kind, name, time.perf_counter() - start))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._begin(run_id, "模型", "llm")
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._begin(run_id, "模型", "llm")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        super().on_llm_end(response, **kwargs)
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._begin(run_id, "工具", (serialized or {}).get("name", "tool"))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self.last_observation = str(output)
+        self._end(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_agent_action(self, action, **kwargs):
+        self.last_thought = action.log
+
+    def summary(self):
+        """各步骤耗时的汇总文本"""
+        total = time.perf_counter() - self.start
+        steps = "，".join(f"{kind}({name}) {seconds:.2f}s" for kind, name, seconds in self.steps)
+        return f"总耗时 {total:.2f}s，共 {len(self.steps)} 步：{steps or '无'}"
+
+
+def _create_analysis_agent(model, df, budget=None):
+    """创建数据分析代理，提示词中附带按token预算压缩的数据概况，代替默认的df.head()"""
+    profile, profile_tokens = build_dataset_profile(df)
+    # 前缀会作为模板解析，花括号需要转义
+    profile = profile.replace("{", "{{").replace("}", "}}")
+    agent = create_pandas_dataframe_agent(
+        llm=model,
+        # 代理代码可能原地修改数据（fillna(inplace=True)、.loc赋值等），浅拷贝会写回原数据，
+        # 因此交给代理的是深拷贝，会话和缓存中共享的数据不受影响
+        df=df.copy(),
+        prefix=(
+            "\nYou are working with a pandas dataframe in Python. The name of the dataframe is `df`.\n"
+            f"以下是df的数据概况，可直接据此编写代码，无需先查看数据结构：\n{profile}\n"
+            "You should use the tools below to answer the question posed of you:"
+        ),
+        include_df_in_prompt=False,
+        agent_executor_kwargs={"handle_parsing_errors": True},
+        max_iterations=(budget or analysis_budget())["iterations"] or None,
+        allow_dangerous_code=True,
+        verbose=True
+    )
+    return agent, profile_tokens
+
+
+def _log_analysis_stats(profile_tokens, prompt, monitor):
+    """打印一次分析的token统计和各步骤耗时"""
+    print(
+        f"token统计：数据概况 {profile_tokens}，指令与问题 {count_tokens(prompt)}，"
+        f"模型调用 {monitor.calls} 次，输入 {monitor.input_tokens}，输出 {monitor.output_tokens}"
+    )
+    print(f"步骤耗时：{monitor.summary()}")
+
+
+def _build_analysis_agent(df, budget=None):
+    """创建数据分析代理，返回(代理, 带缓存的代码执行工具, 数据概况的token数)"""
+    agent, profile_tokens = _create_analysis_agent(llm_pool.get('https://oneapi.xty.app/v1'), df, budget)
+    return agent, _memoize_python_tool(agent), profile_tokens
+
+
+def _parse_agent_response(response, memo_tool):
+    """将代理的输出解析为结果字典"""
+    if memo_tool is not None and memo_tool.steps:
+        print(f"代码执行缓存：{memo_tool.steps} 步中命中 {memo_tool.cache_hits} 步")
+    # 增强JSON解析错误处理
+    try:
+        return json.loads(response["output"])
+    except json.JSONDecodeError:
+        # 如果JSON解析失败，返回原始文本作为答案
+        return {"answer": response["output"]}
+
+
+def _latest_intermediate_table(agent):
+    """取代理代码中最近生成的DataFrame/Series（原始数据除外），转换为table格式"""
+    for tool in agent.tools:
+        if not isinstance(tool, PythonAstREPLTool):
+            continue
+        source = tool.locals.get("df")
+        for value in reversed(list(tool.locals.values())):
+            if value is source or not isinstance(value, (pd.DataFrame, pd.Series)) or value.empty:
+                continue
+            frame = value.to_frame() if isinstance(value, pd.Series) else value
+            if not isinstance(frame.index, pd.RangeIndex):
+                frame = frame.reset_index()
+            table = json.loads(frame.head(ANALYSIS_PARTIAL_TABLE_ROWS).to_json(orient="split", date_format="iso"))
+            return {"columns": [str(column) for column in table["columns"]], "data": table["data"]}
+    return None
+
+
+def _partial_analysis_result(agent, monitor, reason):
+    """预算耗尽时，用最后一步的输出和最近生成的中间表格组成部分结果（不写入缓存）"""
+    print(f"分析提前结束: {reason}")
+    detail = monitor.last_observation or monitor.last_thought
+    answer = f"⚠️ {reason}，分析提前结束"
+    if detail:
+        answer += f"。最后一步的中间结果：{detail.strip()[:500]}"
+    result = {"answer": answer, "partial": True}
+    table = _latest_intermediate_table(agent)
+    if table is not None:
+        result["table"] = table
+    return result
+
+
+def _agent_result(agent, memo_tool, monitor, response):
+    """解析代理输出，代理因达到最大步数停止时返回部分结果"""
+    if response["output"] == _AGENT_STOPPED_OUTPUT:
+        return _partial_analysis_result(agent, monitor, f"分析达到最大步数（{monitor.budget['iterations']}）")
+    return _parse_agent_response(response, memo_tool)
+
+
+def _perform_analysis(df, query, callbacks=None, budget=None):
+    """执行实际的数据分析，callbacks为代理执行时附加的回调处理器，budget见analysis_budget"""
+    agent, memo_tool, profile_tokens = _build_analysis_agent(df, budget)
+    prompt = PROMPT_TEMPLATE + query
+    monitor = AnalysisMonitor(budget)
+
+    try:
+        response = agent.invoke({"input": prompt}, config={"callbacks": [monitor, *(callbacks or [])]})
+        return _agent_result(agent, memo_tool, monitor, response)
+    except AnalysisBudgetExceeded as err:
+        return _partial_analysis_result(agent, monitor, str(err))
+    except Exception as err:
+        print(f"分析错误: {err}")
+        return dict(ANALYSIS_FAILED_RESULT)
+    finally:
+        _log_analysis_stats(profile_tokens, prompt, monitor)
+
+
+async def _aperform_analysis(df, query, callbacks=None, budget=None):
+    """异步执行数据分析，任务被取消时中止正在进行的模型请求并抛出CancelledError"""
+    # 计算数据指纹和数据概况可能耗时较长，放到线程中执行，不阻塞事件循环上的其他任务
+    agent, memo_tool, profile_tokens = await asyncio.to_thread(_build_analysis_agent, df, budget)
+    prompt = PROMPT_TEMPLATE + query
+    monitor = AnalysisMonitor(budget)
+
+    try:
+        response = await agent.ainvoke({"input": prompt}, config={"callbacks": [monitor, *(callbacks or [])]})
+        return _agent_result(agent, memo_tool, monitor, response)
+    except AnalysisBudgetExceeded as err:
+        return _partial_analysis_result(agent, monitor, str(err))
+    except Exception as err:
+        print(f"分析错误: {err}")
+        return dict(ANALYSIS_FAILED_RESULT)
+    finally:
+        _log_analysis_stats(profile_tokens, prompt, monitor)
+
+# 是否在本地直接回答简单的统计问题
+LOCAL_ANSWER_ENABLED = os.getenv("LOCAL_ANSWER_ENABLED", "1") == "1"
+# 分组结果超过该类别数时以表格而不是柱状图返回
+LOCAL_ANSWER_MAX_BAR_CATEGORIES = int(os.getenv("LOCAL_ANSWER_MAX_BAR_CATEGORIES", 30))
+
+# 本地可回答的问题词汇：(角色, 取值, 短语)，短语均为normalize_query_text归一化后的形式
+_LOCAL_ANSWER_LEXICON = [
+    ("rows", None, ["多少行", "几行", "行数", "多少条数据", "多少条记录", "多少条", "记录数", "数据量",
+                    "how many rows", "number of rows", "row count", "how many records", "number of records"]),
+    ("columns", None, ["多少列", "几列", "列数", "how many columns", "number of columns", "column count"]),
+    ("agg", "sum", ["总和", "总计", "合计", "总额", "求和", "sum", "total"]),
+    ("agg", "mean", ["平均值", "平均数", "平均", "均值", "average", "mean", "avg"]),
+    ("agg", "median", ["中位数", "median"]),
+    ("agg", "max", ["最大值", "最高值", "最大", "最高", "max", "maximum", "highest", "largest"]),
+    ("agg", "min", ["最小值", "最低值", "最小", "最低", "min", "minimum", "lowest", "smallest"]),
+    ("agg", "nunique", ["多少种", "几种", "不同值", "唯一值", "distinct", "unique"]),
+    ("agg", "count", ["数量", "个数", "计数", "count"]),
+    ("output", "table", ["表格", "table"]),
+    ("output", "bar", ["柱状图", "柱形图", "条形图", "bar chart", "bar"]),
+    ("filler", None, [
+        "告诉我", "帮我", "一下", "请", "计算", "统计", "求", "查询", "显示", "给出", "列出", "看看", "是多少",
+        "多少", "什么", "数据集", "数据", "所有", "全部", "整体", "总体", "分别", "字段", "列", "值", "中", "里",
+        "的", "是", "为", "有", "吗", "呢", "用", "画", "绘制", "生成", "展示", "how many", "what", "whats",
+        "is", "are", "the", "of", "in", "for", "a", "an", "me", "show", "give", "calculate", "compute", "get",
+        "find", "tell", "value", "values", "column", "data", "dataset", "all", "overall", "please", "s",
+        "plot", "draw", "as", "with", "there", "do", "does", "have", "has",
+    ]),
+]
+_LOCAL_GROUP_PATTERN = re.compile(r"(?:按照|按|各个|各|每个|每一个|每|group by|for each|by|per)\s*<(\d+)>|<(\d+)>\s*分组")
+# "总销售额"中的"总"表示求和
+_LOCAL_TOTAL_PATTERN = re.compile(r"总(?=\s*<\d+>)")
+_LOCAL_AGG_NAMES = {"sum": "总和", "mean": "平均值", "median": "中位数", "max": "最大值",
+                    "min": "最小值", "nunique": "不同值个数", "count": "数量"}
+_LOCAL_NUMERIC_AGGS = {"sum", "mean", "median", "max", "min"}
+
+
+def _lexicon_pattern():
+    """按长度从长到短组合词汇的正则，英文短语要求单词边界"""
+    phrases = sorted(
+        ((phrase, role, value) for role, value, items in _LOCAL_ANSWER_LEXICON for phrase in items),
+        key=lambda item: -len(item[0])
+    )
+    parts = []
+    for phrase, _, _ in phrases:
+        escaped = re.escape(phrase)
+        parts.append(f"(?<![a-z0-9]){escaped}(?![a-z0-9])" if phrase.isascii() else escaped)
+    return re.compile("|".join(parts)), {phrase: (role, value) for phrase, role, value in phrases}
+
+
+_LOCAL_LEXICON_PATTERN, _LOCAL_LEXICON_ROLES = _lexicon_pattern()
+
+
+def _local_number(value):
+    """把numpy数值转换为Python数值，浮点数保留4位小数"""
+    value = value.item() if hasattr(value, "item") else value
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else round(value, 4)
+    return value
+
+
+def answer_locally(df, query):
+    """
+    在本地直接计算简单统计问题的答案，不调用模型
+
+    支持行数/列数、单个列的总和/平均值/中位数/最大值/最小值/不同值个数/数量，
+    以及按某一列分组的上述统计（中英文）。问题中只要出现无法识别的内容
+    （筛选条件、数字、其他图表类型等）就不在本地回答。
+
+    Returns:
+        {"answer"}、{"table"}或{"bar"}格式的结果，无法本地回答时返回None
+    """
+    if not LOCAL_ANSWER_ENABLED or not isinstance(df, pd.DataFrame):
+        return None
+    question, instructions = canonicalize_query(query)
+    want = None
+    if instructions:
+        if "bar" in instructions or "柱" in instructions:
+            want = "bar"
+        elif "图表要求" in instructions:
+            return None
+
+    # 列名按从长到短替换为占位符，英文列名要求单词边界
+    columns = sorted(
+        ((normalize_query_text(str(name)), name) for name in df.columns),
+        key=lambda item: -len(item[0])
+    )
+    mentioned = []
+    for normalized, name in columns:
+        if not normalized:
+            continue
+        escaped = re.escape(normalized)
+        pattern = f"(?<![a-z0-9]){escaped}(?![a-z0-9])" if normalized.isascii() else escaped
+        if re.search(pattern, question):
+            question = re.sub(pattern, f" <{len(mentioned)}> ", question)
+            mentioned.append(name)
+
+    question = _LOCAL_TOTAL_PATTERN.sub(" 总和 ", question)
+    group = None
+    match = _LOCAL_GROUP_PATTERN.search(question)
+    if match:
+        group = mentioned[int(match.group(1) or match.group(2))]
+        question = question[:match.start()] + " " + question[match.end():]
+
+    roles = {"rows": False, "columns": False, "agg": set(), "output": set()}
+    for phrase in _LOCAL_LEXICON_PATTERN.findall(question):
+        role, value = _LOCAL_LEXICON_ROLES[phrase]
+        if role in ("rows", "columns"):
+            roles[role] = True
+        elif role in ("agg", "output"):
+            roles[role].add(value)
+    residual = _LOCAL_LEXICON_PATTERN.sub(" ", question)
+    targets = [mentioned[int(index)] for index in re.findall(r"<(\d+)>", residual)]
+    # 标点不影响简单统计问题的含义
+    residual = "".join(char for char in residual if unicodedata.category(char)[0] != "P")
+    if re.sub(r"<\d+>|\s", "", residual) or len(roles["agg"]) > 1 or len(roles["output"]) > 1:
+        return None
+    want = next(iter(roles["output"]), want)
+    agg = next(iter(roles["agg"]), None)
+
+    if group is None:
+        if targets or agg or want:
+            if len(targets) != 1 or agg is None:
+                return None
+            series = df[targets[0]]
+            if agg in _LOCAL_NUMERIC_AGGS and not (
+                pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype)
+            ):
+                return None
+            value = series.agg(agg)
+            if pd.isna(value):
+                return None
+            return {"answer": f"{targets[0]}的{_LOCAL_AGG_NAMES[agg]}为{_local_number(value)}"}
+        if roles["rows"] and roles["columns"]:
+            return {"answer": f"数据共有{len(df)}行、{len(df.columns)}列"}
+        if roles["rows"]:
+            return {"answer": f"数据共有{len(df)}行"}
+        if roles["columns"]:
+            return {"answer": f"数据共有{len(df.columns)}列"}
+        return None
+
+    # 分组统计：没有统计列时统计各组的行数
+    if roles["columns"] or len(targets) > 1 or group in targets:
+        return None
+    if targets:
+        if agg is None:
+            return None
+        series = df[targets[0]]
+        if agg in _LOCAL_NUMERIC_AGGS and not (
+            pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype)
+        ):
+            return None
+        grouped = series.groupby(df[group], observed=True, sort=False).agg(agg)
+        label = f"{targets[0]}{_LOCAL_AGG_NAMES[agg]}"
+    elif agg == "count" or (agg is None and roles["rows"]):
+        grouped = df[group].value_counts(sort=False)
+        label = "数量"
+    else:
+        return None
+    grouped = grouped.dropna().sort_values(ascending=False)
+    categories = [str(key) for key in grouped.index]
+    values = [_local_number(value) for value in grouped.to_numpy()]
+    if want == "table" or (want is None and len(grouped) > LOCAL_ANSWER_MAX_BAR_CATEGORIES):
+        return {"table": {"columns": [str(group), label], "data": [list(row) for row in zip(categories, values)]}}
+    return {"bar": {"columns": categories, "data": values}}
+
+
+def dataframe_agent(df, query, stream_container=None, similarity=False, cache_info=None, use_cache=True, budget=None):
+    """
+    数据分析代理函数，支持缓存和流式输出（缓存和预算参数见cached_dataframe_analysis）
+
+    简单的统计问题直接在本地计算（见answer_locally），此时cache_info的match为"local"。
+    """
+    result = answer_locally(df, query)
+    if result is not None:
+        if cache_info is not None:
+            cache_info.clear()
+            cache_info["match"] = "local"
+        return result
+
+    # 生成缓存键
+    cache_key = generate_cache_key(df, query)
+    
+    # 检查是否启用流式输出
+    if stream_container is not None:
+        return dataframe_agent_streaming(df, query, stream_container, budget=budget)
+    else:
+        # 使用缓存
+        return cached_dataframe_analysis(df, query, cache_key, similarity=similarity,
+                                         cache_info=cache_info, use_cache=use_cache, budget=budget)
+
+def dataframe_agent_streaming(df, query, stream_container, budget=None):
+    """支持流式输出的数据分析函数"""
+    # 创建流式回调处理器
+    callback_handler = StreamlitCallbackHandler(stream_container)
+    
+    model = llm_pool.get("https://api.openai-hk.com/v1", callbacks=[callback_handler])
+    agent, profile_tokens = _create_analysis_agent(model, df, budget)
+    # 工具执行步骤和缓存命中也通过回调处理器显示
+    _memoize_python_tool(agent, callbacks=[callback_handler])
+
+    prompt = PROMPT_TEMPLATE + query
+    monitor = AnalysisMonitor(budget)
+
+    try:
+        # 显示分析开始信息
+        stream_container.info("🤖 AI正在分析您的数据...")
+        try:
+            response = agent.invoke({"input": prompt}, config={"callbacks": [monitor]})
+        except AnalysisBudgetExceeded as err:
+            stream_container.warning(f"⚠️ {err}，返回已得到的部分结果")
+            return _partial_analysis_result(agent, monitor, str(err))
+        finally:
+            _log_analysis_stats(profile_tokens, prompt, monitor)
+        if response["output"] == _AGENT_STOPPED_OUTPUT:
+            stream_container.warning("⚠️ 分析达到最大步数，返回已得到的部分结果")
+            return _agent_result(agent, None, monitor, response)
+        
+        # 尝试解析JSON响应
+        try:
+            result = json.loads(response["output"])
+            stream_container.success("✅ 分析完成！")
+            return result
+        except json.JSONDecodeError as json_err:
+            # 如果JSON解析失败，返回原始文本
+            stream_container.warning("⚠️ 响应格式解析异常，返回原始结果")
+            return {"answer": response["output"]}
+            
+    except Exception as err:
+        error_msg = f"分析过程中出现错误: {str(err)}"
+        print(error_msg)
+        stream_container.error(error_msg)
+        return {"answer": "暂时无法提供分析结果，请稍后重试！"}
+
+
+# 渲染后图表图片缓存的总内存上限（字节），默认128MB
+CHART_CACHE_MAX_BYTES = int(os.getenv("CHART_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+# 单张图片超过该大小（字节）时不缓存，默认8MB
+CHART_CACHE_MAX_IMAGE_BYTES = int(os.getenv("CHART_CACHE_MAX_IMAGE_BYTES", 8 * 1024 * 1024))
+# 图表输出格式："png"或"svg"
+CHART_IMAGE_FORMAT = os.getenv("CHART_IMAGE_FORMAT", "png")
+# 分析结果中可渲染的图表类型，按优先顺序排列
+CHART_TYPES = ("bar", "line", "scatter", "pie", "heatmap")
+
+chart_image_cache = BoundedLRUCache(CHART_CACHE_MAX_BYTES, CHART_CACHE_MAX_IMAGE_BYTES)
+
+
+def chart_cache_key(chart_type, payload, style, image_format=CHART_IMAGE_FORMAT):
+    """由图表类型、图表数据、样式和输出格式生成渲染缓存的键"""
+    content = orjson.dumps(
+        {"type": chart_type, "payload": payload},
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    )
+    digest = hashlib.blake2b(content, digest_size=16)
+    digest.update(f"\x00{style}\x00{image_format}".encode())
+    return digest.hexdigest()
+
+
+def figure_to_image(fig, image_format=CHART_IMAGE_FORMAT):
+    """将matplotlib图表渲染为PNG字节或SVG字符串，参数与st.pyplot的默认输出一致"""
+    buffer = io.BytesIO()
+    if image_format == "svg":
+        fig.savefig(buffer, format="svg", bbox_inches="tight")
+        return buffer.getvalue().decode("utf-8")
+    fig.savefig(buffer, format="png", bbox_inches="tight", dpi=200)
+    return buffer.getvalue()
+
+
+# 后台预热分析的最大并发数（所有会话共享）
+WARMUP_MAX_WORKERS = int(os.getenv("WARMUP_MAX_WORKERS", 2))
+
+
+class AnalysisCancelled(Exception):
+    """后台预热的分析被取消"""
+
+
+class _CancellationHandler(BaseCallbackHandler):
+    """在代理每次调用模型或执行工具前检查取消标志，已取消时中止执行"""
+
+    raise_error = True
+
+    def __init__(self, cancel_event):
+        self.cancel_event = cancel_event
+
+    def _check(self):
+        if self.cancel_event.is_set():
+            raise AnalysisCancelled("分析已取消")
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._check()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._check()
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self._check()
+
+
+class AnalysisWarmer:
+    """在后台线程池中预先计算分析结果并写入分析缓存
+
+    每个会话（owner）同一时间只预热一个数据集，切换数据集或关闭预热时取消：
+    尚未开始的任务直接撤销，正在执行的任务在下一次调用模型或执行工具前中止。
+    已在缓存中的查询不会重复计算。
+    """
+
+    def __init__(self, max_workers=WARMUP_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-warmup")
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def warm(self, owner, df, queries, budget=None):
+        """
+        为会话提交一组预热查询，数据集和设置与正在预热的相同时不重复提交
+
+        Args:
+            owner: 会话标识
+            df: 要分析的数据集
+            queries: 查询字符串列表
+            budget: 每个预热分析的预算（见analysis_budget）
+        """
+        dataset = dataset_fingerprint(df)
+        settings = {"budget": budget}
+        with self._lock:
+            job = self._jobs.get(owner)
+            if job is not None and job["dataset"] == dataset and job["settings"] == settings:
+                new_queries = [query for query in queries if query not in job["tasks"]]
+            else:
+                if job is not None:
+                    job["cancel"].set()
+                    for task in job["tasks"].values():
+                        task["future"].cancel()
+                job = {"dataset": dataset, "settings": settings, "cancel": threading.Event(), "tasks": {}}
+                self._jobs[owner] = job
+                new_queries = list(dict.fromkeys(queries))
+            if not new_queries:
+                return
+            for query in new_queries:
+                task = {"status": "pending"}
+                task["future"] = self._executor.submit(self._run, df, query, job["cancel"], task, budget)
+                job["tasks"][query] = task
+
+    def _run(self, df, query, cancel_event, task, budget=None):
+        if cancel_event.is_set():
+            task["status"] = "cancelled"
+            return
+        cache_key = generate_cache_key(df, query)
+        if analysis_cache.lookup(cache_key)[0] is not None:
+            task["status"] = "done"
+            return
+        task["status"] = "running"
+        try:
+            # 与用户发起的相同分析合并，用户点击按钮时也会等待这次预热的结果
+            result, _ = analysis_single_flight.do(cache_key, lambda: _analyze_and_store(
+                df, query, cache_key, callbacks=[_CancellationHandler(cancel_event)], budget=budget
+            ))
+        except TimeoutError:
+            result = ANALYSIS_FAILED_RESULT
+        if cancel_event.is_set():
+            task["status"] = "cancelled"
+        else:
+            task["status"] = "failed" if result == ANALYSIS_FAILED_RESULT else "done"
+
+    def cancel(self, owner):
+        """取消会话的全部预热任务"""
+        with self._lock:
+            job = self._jobs.pop(owner, None)
+        if job is not None:
+            job["cancel"].set()
+            for task in job["tasks"].values():
+                task["future"].cancel()
+
+    def status(self, owner):
+        """返回会话预热任务的状态计数，例如{"done": 2, "running": 1}"""
+        with self._lock:
+            job = self._jobs.get(owner)
+            tasks = list(job["tasks"].values()) if job is not None else []
+        counts = Counter(task["status"] for task in tasks)
+        counts["total"] = len(tasks)
+        return dict(counts)
+
+
+analysis_warmer = AnalysisWarmer()
+
+
+# 批量分析共用线程池的线程数（所有会话共享）
+ANALYSIS_BATCH_MAX_WORKERS = int(os.getenv("ANALYSIS_BATCH_MAX_WORKERS", 6))
+_analysis_batch_executor = ThreadPoolExecutor(max_workers=ANALYSIS_BATCH_MAX_WORKERS,
+                                              thread_name_prefix="analysis-batch")
+
+
+def run_analysis_batch(df, queries, use_cache=True, budget=None):
+    """
+    在共享线程池中并发执行一组分析，按完成顺序逐个返回结果
+
+    各分析共用同一份数据指纹和数据概况，只计算一次；每个分析仍经过本地计算、
+    缓存和并发去重（见dataframe_agent）。
+
+    Args:
+        queries: {名称: 查询字符串}
+        use_cache: 为False时跳过缓存查找，重新分析并更新缓存
+        budget: 每个分析各自的预算（见analysis_budget）
+
+    Yields:
+        (名称, 结果, 耗时秒数)
+    """
+    dataset_fingerprint(df)
+    build_dataset_profile(df)
+    start = time.perf_counter()
+
+    futures = {_analysis_batch_executor.submit(dataframe_agent, df, query, use_cache=use_cache, budget=budget): name for name, query in queries.items()}
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except Exception as err:
+            print(f"分析错误: {err}")
+            result = dict(ANALYSIS_FAILED_RESULT)
+        yield futures[future], result, time.perf_counter() - start
+
+
+# 同时执行的后台分析任务数
+ANALYSIS_JOB_MAX_CONCURRENCY = int(os.getenv("ANALYSIS_JOB_MAX_CONCURRENCY", 4))
+# 结束的后台分析任务保留多久（秒）供页面读取结果
+ANALYSIS_JOB_RETENTION = int(os.getenv("ANALYSIS_JOB_RETENTION", 3600))
+
+
+class _JobProgressHandler(BaseCallbackHandler):
+    """记录后台分析任务的执行进度，合并执行的相同任务共享同一进度"""
+
+    run_inline = True
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.steps = 0
+
+    def _update(self, phase):
+        for job in self.jobs:
+            job["steps"] = self.steps
+            job["phase"] = phase
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._update("🤔 模型思考中")
+
+    def on_agent_action(self, action, **kwargs):
+        self.steps += 1
+        self._update(f"🔄 执行步骤 {self.steps}: {action.tool}")
+
+    def on_text(self, text, **kwargs):
+        if kwargs.get("tool_cache_hit"):
+            self._update(f"♻️ 步骤 {kwargs.get('step')} 复用了代码执行缓存")
+
+
+class AnalysisJobManager:
+    """在共享的后台事件循环中执行分析任务，页面通过任务ID轮询进度和结果
+
+    任务通过agent.ainvoke执行，取消时直接取消协程：正在等待的模型请求随之中断，
+    代理不再继续后续步骤。缓存键相同的任务同时只执行一次分析，后提交的任务等待
+    进行中的分析并得到同一结果；只有等待同一分析的任务全部取消时才中止这次分析。
+    """
+
+    def __init__(self, max_concurrency=ANALYSIS_JOB_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._loop = None
+        self._semaphore = None
+        # 缓存键 -> 进行中的分析：{"task", "jobs"}，只在后台事件循环中访问
+        self._inflight = {}
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                threading.Thread(target=self._loop.run_forever, name="analysis-jobs", daemon=True).start()
+            return self._loop
+
+    def submit(self, df, query, similarity=False, use_cache=True, budget=None):
+        """
+        提交分析任务，立即返回任务ID（参数含义同cached_dataframe_analysis）
+
+        可在本地回答或命中缓存的任务在提交时直接完成，不进入后台执行。
+        """
+        loop = self._ensure_loop()
+        self._prune()
+        job = {"status": "pending", "phase": "⏳ 排队中", "steps": 0, "result": None,
+               "cache_info": {"match": None}, "submitted": time.time(), "finished": None, "future": None}
+        job_id = uuid.uuid4().hex
+        cache_key = generate_cache_key(df, query)
+        result = answer_locally(df, query)
+        if result is not None:
+            job["cache_info"]["match"] = "local"
+        elif use_cache:
+            result = lookup_cached_analysis(df, query, cache_key, similarity=similarity, cache_info=job["cache_info"])
+        if result is not None:
+            self._finish(job, "done", result)
+        else:
+            job["future"] = asyncio.run_coroutine_threadsafe(self._run(job, df, query, cache_key, budget), loop)
+        with self._lock:
+            self._jobs[job_id] = job
+        return job_id
+
+    async def _analyze(self, jobs, df, query, cache_key, budget):
+        """执行一次分析并写入缓存，jobs为等待这次分析的全部任务"""
+        async with self._semaphore:
+            for job in jobs:
+                job["status"] = "running"
+                job["phase"] = "🚀 开始分析"
+            start = time.perf_counter()
+            result = await _aperform_analysis(df, query, callbacks=[_JobProgressHandler(jobs)], budget=budget)
+            await asyncio.to_thread(_store_analysis, df, query, cache_key, result, time.perf_counter() - start)
+        return result
+
+    def _release(self, cache_key, inflight):
+        if self._inflight.get(cache_key) is inflight:
+            del self._inflight[cache_key]
+
+    async def _run(self, job, df, query, cache_key, budget):
+        inflight = self._inflight.get(cache_key)
+        # 等待者已全部取消的分析正在中止，不再合并
+        if inflight is None or not inflight["jobs"]:
+            inflight = {"jobs": [job]}
+            inflight["task"] = asyncio.ensure_future(self._analyze(inflight["jobs"], df, query, cache_key, budget))
+            inflight["task"].add_done_callback(lambda task, entry=inflight: self._release(cache_key, entry))
+            self._inflight[cache_key] = inflight
+        else:
+            # 合并到进行中的相同分析，沿用其进度
+            job["cache_info"]["match"] = "inflight"
+            leader = inflight["jobs"][0]
+            job.update(status=leader["status"], phase=leader["phase"], steps=leader["steps"])
+            inflight["jobs"].append(job)
+        try:
+            # shield使取消单个任务时不会中止其他任务仍在等待的分析
+            result = await asyncio.shield(inflight["task"])
+            self._finish(job, "failed" if result == ANALYSIS_FAILED_RESULT else "done", result)
+        except asyncio.CancelledError:
+            inflight["jobs"].remove(job)
+            if not inflight["jobs"]:
+                inflight["task"].cancel()
+            self._finish(job, "cancelled", None)
+            raise
+        except Exception as err:
+            print(f"分析错误: {err}")
+            self._finish(job, "failed", dict(ANALYSIS_FAILED_RESULT))
+
+    @staticmethod
+    def _finish(job, status, result):
+        job["result"] = result
+        job["finished"] = time.time()
+        job["status"] = status
+
+    def status(self, job_id):
+        """
+        返回任务状态字典：status（pending/running/done/failed/cancelled）、phase、steps、
+        elapsed、result和cache_info；任务不存在或已过期时返回None
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        end = job["finished"] or time.time()
+        return {key: job[key] for key in ("status", "phase", "steps", "result", "cache_info")} | {
+            "elapsed": end - job["submitted"]
+        }
+
+    def cancel(self, job_id):
+        """取消任务，正在进行的模型请求会被中断"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None and job["status"] in ("pending", "running"):
+            job["future"].cancel()
+            if job["future"].cancelled():
+                self._finish(job, "cancelled", None)
+
+    def discard(self, job_id):
+        """取消并移除任务"""
+        self.cancel(job_id)
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _prune(self):
+        cutoff = time.time() - ANALYSIS_JOB_RETENTION
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items()
+                           if job["finished"] is not None and job["finished"] < cutoff]:
+                del self._jobs[job_id]
+
+
+analysis_jobs = AnalysisJobManager()
+
+
+# 文件大小超过该阈值（字节）时，才会在进程池中并行预解析工作表
+EXCEL_PARALLEL_MIN_BYTES = int(os.getenv("EXCEL_PARALLEL_MIN_BYTES", 10 * 1024 * 1024))
+
+
+def _read_excel_sheet(content, sheet_name):
+    """解析工作簿中的单个工作表（可在子进程中执行）"""
+    return pd.read_excel(io.BytesIO(content), sheet_name=sheet_name, engine="openpyxl")
+
+
+class LazyExcelSheets(Mapping):
+    """按需解析的Excel工作表集合
+
+    创建时只以只读模式读取工作表名称和尺寸，某个工作表的DataFrame在
+    第一次被访问时才解析并保留，避免多工作表文件被反复整体解析。
+    dimension标记可能是错误的（有的程序总是写入A1），尺寸只用于展示，
+    集合中包含全部工作表，是否为空在解析后才判断。
+    """
+
+    def __init__(self, content, optimize_memory=False):
+        self._content = content
+        self._frames = {}
+        self._lock = threading.Lock()
+        self.optimize_memory = optimize_memory
+        # 工作簿指纹，设置后各工作表的指纹由它和工作表名推导
+        self.fingerprint = None
+        # 解析出新的工作表后调用（无参数），数据加载缓存借此重新计算条目大小
+        self.on_materialize = None
+        self.sheet_info = []
+        wb = openpyxl.load_workbook(io.BytesIO(content), read_only=True)
+        try:
+            for ws in wb.worksheets:
+                # 只读模式下尺寸来自工作表的dimension标记，可能缺失
+                max_row, max_column = ws.max_row, ws.max_column
+                self.sheet_info.append({
+                    "工作表名称": ws.title,
+                    # 首行作为表头，不计入数据行数
+                    "行数": max_row - 1 if max_row else "未知",
+                    "列数": max_column if max_column else "未知",
+                    "数据范围": ws.calculate_dimension() if max_row else "未知",
+                    "状态": "未解析（尺寸为元数据估计）"
+                })
+        finally:
+            wb.close()
+        self.sheet_names = [info["工作表名称"] for info in self.sheet_info]
+        self._names = list(self.sheet_names)
+
+    def _record_parsed(self, sheet_name, frame):
+        """解析后用实际的行列数更新工作表概览"""
+        for info in self.sheet_info:
+            if info["工作表名称"] == sheet_name:
+                info["行数"], info["列数"] = len(frame), len(frame.columns)
+                info["状态"] = "已解析（空）" if frame.empty else "已解析"
+
+    def all_empty(self):
+        """
+        判断是否所有工作表都没有数据
+
+        尺寸显示有数据的工作表直接视为非空；全部显示为空时逐个解析确认，
+        以免错误的dimension标记让有数据的工作簿被判为空。
+        """
+        if any(info["行数"] == "未知" or info["行数"] > 0 for info in self.sheet_info):
+            return False
+        for name in self._names:
+            try:
+                if not self[name].empty:
+                    return False
+            except ValueError as e:
+                print(f"跳过工作表 {name}: {str(e)}")
+        return True
+
+    def _notify_materialized(self):
+        if self.on_materialize is not None:
+            self.on_materialize()
+
+    def __getitem__(self, sheet_name):
+        if sheet_name not in self._names:
+            raise KeyError(sheet_name)
+        parsed = False
+        with self._lock:
+            if sheet_name not in self._frames:
+                parsed = True
+                try:
+                    frame = _read_excel_sheet(self._content, sheet_name)
+                except Exception as e:
+                    raise ValueError(f"工作表 {sheet_name} 读取失败: {str(e)}")
+                if self.optimize_memory:
+                    frame = optimize_dataframe_memory(frame)
+                self._frames[sheet_name] = frame
+                self._record_parsed(sheet_name, frame)
+            frame = self._frames[sheet_name]
+        if parsed:
+            self._notify_materialized()
+        if self.fingerprint is not None:
+            set_dataset_fingerprint(frame, f"{self.fingerprint}:{sheet_name}")
+        return frame
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def preload(self, max_workers=None):
+        """在进程池中并行解析所有尚未加载的工作表"""
+        pending = [name for name in self._names if name not in self._frames]
+        if not pending:
+            return
+        max_workers = max_workers or min(len(pending), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                name: executor.submit(_read_excel_sheet, self._content, name)
+                for name in pending
+            }
+            for name, future in futures.items():
+                try:
+                    frame = future.result()
+                except Exception as e:
+                    # 单个工作表失败时保持按需加载，访问时再报告错误
+                    print(f"并行解析工作表 {name} 失败: {str(e)}")
+                    continue
+                if self.optimize_memory:
+                    frame = optimize_dataframe_memory(frame)
+                with self._lock:
+                    if name not in self._frames:
+                        self._frames[name] = frame
+                        self._record_parsed(name, frame)
+        self._notify_materialized()
+
+    def enable_memory_optimization(self):
+        """开启内存压缩：已解析的工作表立即压缩，其余工作表在解析时压缩"""
+        with self._lock:
+            self.optimize_memory = True
+            for name, frame in self._frames.items():
+                self._frames[name] = optimize_dataframe_memory(frame)
+        self._notify_materialized()
+
+    def memory_bytes(self):
+        """原始文件字节数加上已解析工作表占用的内存"""
+        with self._lock:
+            frames = list(self._frames.values())
+        return len(self._content) + sum(_estimate_result_bytes(frame) for frame in frames)
+
+
+# 流式读取CSV/TSV时每个分块的行数
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", 100000))
+# 流式读取时解析结果的默认内存上限（MB）
+STREAMING_MEMORY_LIMIT_MB = int(os.getenv("STREAMING_MEMORY_LIMIT_MB", 2048))
+# 文本列唯一值占比低于该阈值时转换为category类型
+CATEGORY_RATIO_THRESHOLD = 0.5
+# 是否把整数列降为int8/int16/int32；降位后的列在代理代码的乘法、求和中可能静默溢出，默认关闭
+DOWNCAST_INTEGERS = os.getenv("DOWNCAST_INTEGERS", "0") == "1"
+# 是否把逐值无损的float64列降为float32；float32累加的求和、均值等聚合会丢失精度，默认关闭
+DOWNCAST_FLOATS = os.getenv("DOWNCAST_FLOATS", "0") == "1"
+
+
+# 编码检测时读取的字节样本大小
+ENCODING_SAMPLE_BYTES = int(os.getenv("ENCODING_SAMPLE_BYTES", 256 * 1024))
+# 按检测出的编码严格解析遇到非法字节时（样本之后才出现其他编码的内容），依次改用的编码
+ENCODING_FALLBACKS = ("gb18030", "utf-8", "latin-1")
+# BOM与编码的对应关系，UTF-32的BOM以UTF-16的BOM开头，需先判断
+_BOM_ENCODINGS = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+
+def detect_encoding(file_obj, sample_bytes=ENCODING_SAMPLE_BYTES):
+    """
+    根据BOM和文件开头的字节样本检测文本编码，不改变文件的读取位置
+
+    按 utf-8、gbk、latin-1 的顺序尝试解码样本，latin-1可以解码任意字节，作为兜底编码。
+    """
+    position = file_obj.tell()
+    file_obj.seek(0)
+    sample = file_obj.read(sample_bytes)
+    file_obj.seek(position)
+
+    for bom, encoding in _BOM_ENCODINGS:
+        if sample.startswith(bom):
+            return encoding
+    for encoding in ("utf-8", "gbk"):
+        try:
+            # 样本末尾可能截断多字节字符，使用增量解码器忽略结尾的不完整字符
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "latin-1"
+
+
+def parse_with_encoding_fallback(file_obj, encoding, parse):
+    """
+    用检测出的编码严格解析文件，出现UnicodeDecodeError时依次换用ENCODING_FALLBACKS中的编码重新解析
+
+    编码只根据文件开头的样本检测，例如前256KB都是ASCII的GBK文件会被检测为UTF-8，
+    严格解析可以避免中文被静默替换为"�"。
+
+    Args:
+        file_obj: 二进制文件对象，每次尝试前回到开头
+        encoding: 检测出的编码
+        parse: 以编码为参数的解析函数
+
+    Returns:
+        (解析结果, 实际使用的编码)
+    """
+    candidates = [encoding] + [candidate for candidate in ENCODING_FALLBACKS if candidate != encoding]
+    for index, candidate in enumerate(candidates):
+        file_obj.seek(0)
+        try:
+            return parse(candidate), candidate
+        except UnicodeDecodeError as e:
+            if index == len(candidates) - 1:
+                raise
+            print(f"使用{candidate}编码解析失败，改用{candidates[index + 1]}重新解析: {str(e)}")
+
+
+def _with_load_summary(result, **info):
+    """将加载信息（编码、读取行数等）记录到DataFrame的attrs["load_summary"]中"""
+    if isinstance(result, pd.DataFrame):
+        summary = dict(result.attrs.get("load_summary", {}))
+        summary.update(info)
+        result.attrs["load_summary"] = summary
+    return result
+
+def _get_file_size(file_obj):
+    """获取文件对象的总字节数，不改变当前读取位置"""
+    position = file_obj.tell()
+    file_obj.seek(0, io.SEEK_END)
+    size = file_obj.tell()
+    file_obj.seek(position)
+    return size
+
+
+def _read_fraction(file_obj):
+    """返回文件已读取的比例，压缩文件按已读取的压缩字节计算"""
+    if isinstance(file_obj, DecompressedFile):
+        return file_obj.progress_fraction()
+    return min(file_obj.tell() / (_get_file_size(file_obj) or 1), 1.0)
+
+
+# 支持的压缩格式：扩展名 -> 压缩算法
+COMPRESSION_FORMATS = {
+    "gz": "gzip",
+    "zst": "zstd",
+    "bz2": "bz2",
+    "zip": "zip",
+}
+
+
+class DecompressedFile(io.BufferedIOBase):
+    """压缩上传文件的只读流式解压视图
+
+    读取时边解压边交给解析器，不会在内存中生成完整的解压内容。
+    向后定位时从头重新解压，向前定位时读取并丢弃中间内容，
+    因此编码检测、分隔符检测等只读取文件开头的操作开销很小。
+    """
+
+    def __init__(self, source, compression, name):
+        self._source = source
+        self._source_size = _get_file_size(source) or 1
+        self.compression = compression
+        self.name = name
+        self._stream = None
+        self._position = 0
+        self._open()
+
+    def _open(self):
+        """从压缩文件开头重新创建解压流"""
+        if self._stream is not None:
+            self._stream.close()
+        self._source.seek(0)
+        if self.compression == "gzip":
+            self._stream = gzip.GzipFile(fileobj=self._source, mode="rb")
+        elif self.compression == "bz2":
+            self._stream = bz2.BZ2File(self._source, mode="rb")
+        elif self.compression == "zstd":
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                self._source, read_across_frames=True, closefd=False
+            )
+            self._stream = io.BufferedReader(reader)
+        elif self.compression == "zip":
+            archive = zipfile.ZipFile(self._source)
+            members = [info for info in archive.infolist() if not info.is_dir()]
+            if not members:
+                raise ValueError("ZIP压缩包中没有文件")
+            self._stream = archive.open(members[0])
+        else:
+            raise ValueError(f"不支持的压缩格式: {self.compression}")
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._position += len(data)
+        return data
+
+    def read1(self, size=-1):
+        return self.read(size)
+
+    def readinto(self, buffer):
+        count = self._stream.readinto(buffer)
+        self._position += count
+        return count
+
+    def readline(self, size=-1):
+        line = self._stream.readline(size)
+        self._position += len(line)
+        return line
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("解压流不支持从末尾定位")
+        if offset < self._position:
+            self._open()
+        while self._position < offset:
+            if not self.read(min(offset - self._position, 1024 * 1024)):
+                break
+        return self._position
+
+    def progress_fraction(self):
+        """按已读取的压缩字节估算解压进度"""
+        return min(self._source.tell() / self._source_size, 1.0)
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+        super().close()
+
+
+def open_decompressed(uploaded_file):
+    """
+    按扩展名识别压缩的上传文件，返回流式解压的文件对象
+
+    Returns:
+        (文件对象, 压缩算法)，未压缩时原样返回上传文件和None
+    """
+    name, _, extension = uploaded_file.name.rpartition(".")
+    compression = COMPRESSION_FORMATS.get(extension.lower())
+    if not name or compression is None:
+        return uploaded_file, None
+    return DecompressedFile(uploaded_file, compression, name), compression
+
+
+def _shrink_chunk(chunk, category_ratio=CATEGORY_RATIO_THRESHOLD, downcast_integers=DOWNCAST_INTEGERS,
+                  downcast_floats=DOWNCAST_FLOATS):
+    """对单个数据块做低基数文本列分类化，整数和浮点数降位需显式开启"""
+    for col in chunk.columns:
+        series = chunk[col]
+        # 只处理NumPy类型的列，可空类型和ArrowDtype列保持不变
+        if not isinstance(series.dtype, np.dtype):
+            continue
+        if pd.api.types.is_integer_dtype(series.dtype):
+            if downcast_integers:
+                chunk[col] = pd.to_numeric(series, downcast="integer")
+        elif pd.api.types.is_float_dtype(series.dtype):
+            if not downcast_floats:
+                continue
+            downcast = pd.to_numeric(series, downcast="float")
+            # 只有在数值完全一致时才降为float32
+            if downcast.dtype != series.dtype and downcast.astype(series.dtype).equals(series):
+                chunk[col] = downcast
+        elif series.dtype == object and len(series) > 0:
+            try:
+                unique_ratio = series.nunique(dropna=True) / len(series)
+            except TypeError:
+                # 列中包含列表、字典等不可哈希的值
+                continue
+            if unique_ratio < category_ratio:
+                chunk[col] = series.astype("category")
+    return chunk
+
+
+def optimize_dataframe_memory(df, category_ratio=CATEGORY_RATIO_THRESHOLD, downcast_integers=DOWNCAST_INTEGERS,
+                              downcast_floats=DOWNCAST_FLOATS):
+    """
+    压缩DataFrame的内存占用：低基数文本列转换为category类型，数值列默认保持64位
+
+    Args:
+        df: 待优化的DataFrame（原地修改）
+        category_ratio: 文本列唯一值占比低于该阈值时转换为category类型
+        downcast_integers: 是否同时降位整数列（结果交给代理计算时可能溢出）
+        downcast_floats: 是否把逐值无损的浮点列降为float32（求和、均值等聚合会丢失精度）
+
+    Returns:
+        pandas.DataFrame，attrs["load_summary"]中记录优化前后的内存占用（字节）
+    """
+    memory_before = int(df.memory_usage(deep=True).sum())
+    df = _shrink_chunk(df, category_ratio, downcast_integers, downcast_floats)
+    memory_after = int(df.memory_usage(deep=True).sum())
+    return _with_load_summary(df, memory_before=memory_before, memory_after=memory_after)
+
+
+def _concat_chunks(chunks):
+    """合并数据块，所有块中都是category的列合并类别后仍保持category类型"""
+    if not chunks:
+        return pd.DataFrame()
+    if len(chunks) == 1:
+        return chunks[0]
+    categorical_cols = [
+        col for col in chunks[0].columns
+        if all(col in chunk.columns and isinstance(chunk[col].dtype, pd.CategoricalDtype) for chunk in chunks)
+    ]
+    for col in categorical_cols:
+        union = pd.api.types.union_categoricals([chunk[col] for chunk in chunks]).categories
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(union)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _sample_chunk(chunk, frac):
+    """按比例均匀抽样数据块，并去掉分类列中抽样后不再出现的类别，否则类别字典仍占用原来的内存"""
+    chunk = chunk.sample(frac=frac, random_state=0).sort_index()
+    for col in chunk.columns:
+        if isinstance(chunk[col].dtype, pd.CategoricalDtype):
+            chunk[col] = chunk[col].cat.remove_unused_categories()
+    return chunk
+
+
+def _collect_chunks(chunks, file_obj, memory_limit_mb=None, sample_on_limit=False,
+                    progress_callback=None, shrink=False):
+    """
+    逐块收集数据块并合并，可逐块压缩内存、控制总内存上限和报告进度
+
+    Args:
+        chunks: 产生DataFrame数据块的迭代器
+        file_obj: 数据块读取自的文件对象，用于计算读取进度
+        memory_limit_mb: 合并结果的内存上限（MB），None表示不限制
+        sample_on_limit: 超出上限时是否改为均匀抽样，否则报错停止
+        progress_callback: 进度回调函数，参数为(已读取比例, 已读取行数)
+        shrink: 是否逐块压缩内存（见optimize_dataframe_memory）
+
+    Returns:
+        pandas.DataFrame，attrs["load_summary"]中记录读取行数和抽样信息
+    """
+    memory_limit = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+    kept = []
+    kept_sizes = []
+    rows_read = 0
+    sample_rate = 1.0
+
+    for chunk in chunks:
+        rows_read += len(chunk)
+        if sample_rate < 1.0:
+            chunk = _sample_chunk(chunk, sample_rate)
+        if shrink:
+            chunk = _shrink_chunk(chunk)
+        kept.append(chunk)
+        if memory_limit is not None:
+            kept_sizes.append(int(chunk.memory_usage(deep=True).sum()))
+
+        while memory_limit is not None and sum(kept_sizes) > memory_limit:
+            if not sample_on_limit:
+                raise ValueError(
+                    f"文件解析后超过内存上限 {memory_limit_mb} MB（已读取 {rows_read} 行），"
+                    f"请调高内存上限、开启超限抽样或拆分文件后再上传"
+                )
+            # 已保留的数据和后续数据块都按一半比例抽样，保证整体抽样均匀
+            previous_size = sum(kept_sizes)
+            sample_rate /= 2
+            kept = [_sample_chunk(c, 0.5) for c in kept]
+            kept_sizes = [int(c.memory_usage(deep=True).sum()) for c in kept]
+            # 抽样已无法继续减小内存（例如只剩固定开销）时报错，而不是无限循环
+            if not sum(len(c) for c in kept) or sum(kept_sizes) >= previous_size:
+                raise ValueError(
+                    f"文件抽样后仍超过内存上限 {memory_limit_mb} MB（已读取 {rows_read} 行，"
+                    f"抽样比例 {sample_rate:.4%}），请调高内存上限或拆分文件后再上传"
+                )
+
+        if progress_callback is not None:
+            progress_callback(_read_fraction(file_obj), rows_read)
+
+    df = _concat_chunks(kept)
+    df.attrs["load_summary"] = {
+        "rows_read": rows_read,
+        "rows_loaded": len(df),
+        "sampled": sample_rate < 1.0,
+        "sample_rate": sample_rate
+    }
+    if progress_callback is not None:
+        progress_callback(1.0, rows_read)
+    return df
+
+
+def read_csv_streaming(uploaded_file, sep=",", encoding="utf-8", chunk_rows=CSV_CHUNK_ROWS,
+                       memory_limit_mb=STREAMING_MEMORY_LIMIT_MB, sample_on_limit=False,
+                       progress_callback=None, shrink=False):
+    """
+    分块流式读取CSV/TSV文件，控制总内存上限，可逐块压缩内存
+
+    Args:
+        uploaded_file: 二进制文件对象
+        sep: 分隔符
+        encoding: 文件编码
+        chunk_rows: 每个分块的行数
+        memory_limit_mb: 解析结果的内存上限（MB）
+        sample_on_limit: 超出上限时是否改为均匀抽样，否则报错停止
+        progress_callback: 进度回调函数，参数为(已读取比例, 已读取行数)
+        shrink: 是否逐块压缩内存（见optimize_dataframe_memory），与加载选项中的内存压缩一致
+
+    Returns:
+        pandas.DataFrame，attrs["load_summary"]中记录读取行数和抽样信息
+    """
+    reader = pd.read_csv(uploaded_file, sep=sep, encoding=encoding, chunksize=chunk_rows)
+    return _collect_chunks(reader, uploaded_file, memory_limit_mb=memory_limit_mb,
+                           sample_on_limit=sample_on_limit, progress_callback=progress_callback,
+                           shrink=shrink)
+
+
+# JSON Lines按批构建DataFrame时每批的记录数
+JSON_BATCH_ROWS = int(os.getenv("JSON_BATCH_ROWS", 50000))
+
+
+def flatten_nested_columns(df, sep="."):
+    """
+    按列展开嵌套字典，列名以"父列.子列"的形式命名
+
+    每次把整列的字典交给DataFrame构造函数一次性展开，逐层处理直到没有嵌套字典列；
+    同时包含字典和其他非空值的列保持不变，列表值也保持不变。
+    """
+    while True:
+        expanded_any = False
+        for col in list(df.columns):
+            series = df[col]
+            if series.dtype != object:
+                continue
+            values = series.tolist()
+            has_dict = False
+            mixed = False
+            for value in values:
+                if isinstance(value, dict):
+                    has_dict = True
+                elif value is not None and not (isinstance(value, float) and value != value):
+                    mixed = True
+                    break
+            if not has_dict or mixed:
+                continue
+            expanded = pd.DataFrame(
+                [value if isinstance(value, dict) else {} for value in values],
+                index=df.index
+            )
+            if expanded.empty and len(expanded.columns) == 0:
+                continue
+            expanded.columns = [f"{col}{sep}{sub_col}" for sub_col in expanded.columns]
+            position = df.columns.get_loc(col)
+            df = pd.concat([df.iloc[:, :position], expanded, df.iloc[:, position + 1:]], axis=1)
+            expanded_any = True
+        if not expanded_any:
+            return df
+
+
+def _decode_json_line(line, encoding):
+    """UTF-8内容直接交给orjson解析字节，其他编码先解码为字符串"""
+    if encoding.startswith("utf-8"):
+        return line.removeprefix(codecs.BOM_UTF8)
+    return line.decode(encoding)
+
+
+def _loads_json(content, encoding):
+    """
+    使用orjson解析JSON文本或字节，orjson无法解析时回退到标准库json
+
+    orjson不接受标准库json.dumps默认输出的NaN/Infinity，这类文件交给json.loads解析；
+    orjson把非法的UTF-8字节报告为JSONDecodeError，这里改为抛出UnicodeDecodeError，
+    以便parse_with_encoding_fallback换用其他编码重新解析。
+    """
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError as error:
+        if isinstance(content, bytes):
+            content = content.decode(encoding)
+        try:
+            return json.loads(content)
+        except json.JSONDecodeError:
+            raise error
+
+
+def _is_json_lines(file_obj, encoding):
+    """根据前两个非空行判断是否为JSON Lines格式（每行一个JSON对象），不改变读取位置"""
+    if encoding.startswith(("utf-16", "utf-32")):
+        # 按字节切分行不适用于多字节宽度的编码
+        return False
+    position = file_obj.tell()
+    file_obj.seek(0)
+    lines = []
+    try:
+        while len(lines) < 2:
+            line = file_obj.readline()
+            if not line:
+                break
+            if line.strip():
+                lines.append(line)
+    finally:
+        file_obj.seek(position)
+    if len(lines) < 2:
+        return False
+    try:
+        return isinstance(_loads_json(_decode_json_line(lines[0], encoding), encoding), dict)
+    except orjson.JSONDecodeError:
+        return False
+
+
+def _iter_json_lines_batches(file_obj, encoding, batch_rows):
+    """逐行解析JSON Lines，每batch_rows条记录构建一个展开嵌套字段的DataFrame"""
+    batch = []
+    for line_number, line in enumerate(file_obj, 1):
+        if not line.strip():
+            continue
+        try:
+            record = _loads_json(_decode_json_line(line, encoding), encoding)
+        except orjson.JSONDecodeError as e:
+            raise ValueError(f"JSON Lines第 {line_number} 行格式错误: {str(e)}")
+        batch.append(record if isinstance(record, dict) else {"value": record})
+        if len(batch) >= batch_rows:
+            yield flatten_nested_columns(pd.DataFrame(batch))
+            batch = []
+    if batch:
+        yield flatten_nested_columns(pd.DataFrame(batch))
+
+
+def read_json_lines(file_obj, encoding="utf-8", batch_rows=JSON_BATCH_ROWS, memory_limit_mb=None,
+                    sample_on_limit=False, progress_callback=None, shrink=False):
+    """
+    使用orjson逐行读取JSON Lines文件，按批构建DataFrame，不会把整个文件读入内存
+
+    Args:
+        file_obj: 二进制文件对象
+        encoding: 文件编码
+        batch_rows: 每批的记录数
+        memory_limit_mb: 解析结果的内存上限（MB），None表示不限制
+        sample_on_limit: 超出上限时是否改为均匀抽样，否则报错停止
+        progress_callback: 进度回调函数，参数为(已读取比例, 已读取行数)
+        shrink: 是否逐批压缩内存
+
+    Returns:
+        pandas.DataFrame
+    """
+    batches = _iter_json_lines_batches(file_obj, encoding, batch_rows)
+    df = _collect_chunks(batches, file_obj, memory_limit_mb=memory_limit_mb, sample_on_limit=sample_on_limit,
+                         progress_callback=progress_callback, shrink=shrink)
+    if df.empty:
+        raise ValueError("JSON Lines文件中没有记录")
+    return df
+
+
+def _arrow_table_to_pandas(table, arrow_dtypes=False):
+    """将Arrow表转换为DataFrame，可选保留ArrowDtype列"""
+    if arrow_dtypes:
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+    return table.to_pandas()
+
+
+def read_csv_arrow(file_obj, sep=",", encoding="utf-8", arrow_dtypes=False, quote_char='"'):
+    """
+    使用PyArrow多线程解析分隔符文件
+
+    Args:
+        file_obj: 二进制文件对象
+        sep: 分隔符
+        encoding: 文件编码，非UTF-8编码由PyArrow转码后解析
+        arrow_dtypes: 是否保留ArrowDtype列（字符串列内存占用更小）
+        quote_char: 引号字符，False表示不处理引号
+
+    Returns:
+        pandas.DataFrame
+
+    Raises:
+        pa.ArrowInvalid: 存在列数与表头不一致的行等无法解析的内容
+    """
+    read_options = pacsv.ReadOptions(use_threads=True, encoding=encoding)
+    parse_options = pacsv.ParseOptions(delimiter=sep, quote_char=quote_char)
+    table = pacsv.read_csv(file_obj, read_options=read_options, parse_options=parse_options)
+    # 含非法字节的列会被静默读成binary类型，交给严格解码的C引擎处理并换用其他编码
+    binary_columns = [field.name for field in table.schema if pa.types.is_binary(field.type)]
+    if binary_columns:
+        raise pa.ArrowInvalid(f"列 {binary_columns} 含有无法按{encoding}解码的字节")
+    return _arrow_table_to_pandas(table, arrow_dtypes)
+
+
+def read_json_lines_arrow(file_obj, arrow_dtypes=False):
+    """使用PyArrow多线程解析JSON Lines文件（每行一个JSON对象，UTF-8编码）"""
+    read_options = pajson.ReadOptions(use_threads=True)
+    table = pajson.read_json(file_obj, read_options=read_options)
+    # 嵌套对象解析为struct列，逐层展开为"父列.子列"
+    while any(pa.types.is_struct(field.type) for field in table.schema):
+        table = table.flatten()
+    return _arrow_table_to_pandas(table, arrow_dtypes)
+
+
+class ParquetSource:
+    """按需读取的Parquet数据源
+
+    创建时只读取文件的schema和行组统计信息，读取数据时只解码选中的列，
+    并根据行范围和数值范围条件利用行组的min/max统计跳过整个行组。
+    """
+
+    def __init__(self, content):
+        self._content = content
+        # 文件指纹，由加载方按文件内容设置
+        self.fingerprint = None
+        self._file = pq.ParquetFile(pa.BufferReader(content))
+        self._lock = threading.Lock()
+        metadata = self._file.metadata
+        self.num_rows = metadata.num_rows
+        self.num_row_groups = metadata.num_row_groups
+        self.schema = self._file.schema_arrow
+        # pandas写入的索引列不作为数据列展示
+        self.columns = [name for name in self.schema.names if not name.startswith("__index_level_")]
+        self.numeric_columns = [
+            field.name for field in self.schema
+            if field.name in self.columns
+            and (pa.types.is_integer(field.type) or pa.types.is_floating(field.type))
+        ]
+        # 顶层列名到Parquet叶子列序号的映射，用于查找行组统计信息
+        self._column_index = {}
+        for i in range(metadata.num_columns):
+            path = metadata.schema.column(i).path
+            if "." not in path:
+                self._column_index[path] = i
+        self._group_offsets = []
+        offset = 0
+        for i in range(self.num_row_groups):
+            self._group_offsets.append(offset)
+            offset += metadata.row_group(i).num_rows
+        self._ranges = {}
+        self._last_key = None
+        self._last_frame = None
+        # 读取出新的数据后调用（无参数），数据加载缓存借此重新计算条目大小
+        self.on_materialize = None
+        self.last_read_stats = {}
+
+    def _group_stats(self, group, column):
+        """返回指定行组某列的(min, max)统计，缺失时返回None"""
+        index = self._column_index.get(column)
+        if index is None:
+            return None
+        statistics = self._file.metadata.row_group(group).column(index).statistics
+        if statistics is None or not statistics.has_min_max:
+            return None
+        return statistics.min, statistics.max
+
+    def column_range(self, column):
+        """返回数值列的(min, max)，优先使用行组统计，统计缺失时只读取该列计算"""
+        if column not in self._ranges:
+            stats = [self._group_stats(i, column) for i in range(self.num_row_groups)]
+            if stats and all(stat is not None for stat in stats):
+                self._ranges[column] = (min(stat[0] for stat in stats), max(stat[1] for stat in stats))
+            else:
+                with self._lock:
+                    values = self._file.read(columns=[column]).column(column)
+                result = pc.min_max(values)
+                self._ranges[column] = (result["min"].as_py(), result["max"].as_py())
+        return self._ranges[column]
+
+    def preview(self, rows=10):
+        """读取文件开头的若干行，用于原始数据预览"""
+        with self._lock:
+            batch = next(self._file.iter_batches(batch_size=rows, columns=self.columns), None)
+        if batch is None:
+            return pd.DataFrame(columns=self.columns)
+        return batch.to_pandas(ignore_metadata=True)
+
+    def read(self, start_row=0, end_row=None, columns=None, ranges=None):
+        """
+        按筛选条件读取数据
+
+        Args:
+            start_row: 起始行号（包含）
+            end_row: 结束行号（不包含），默认读取到文件末尾
+            columns: 要读取的列，默认读取全部列
+            ranges: 数值列范围条件 {列名: (最小值, 最大值)}，只对选中的列生效
+
+        Returns:
+            pandas.DataFrame，索引为原始文件中的行号；每次返回最近一次读取结果的副本，
+            调用方修改返回值不会影响缓存的结果
+        """
+        end_row = self.num_rows if end_row is None else min(end_row, self.num_rows)
+        columns = list(columns) if columns else list(self.columns)
+        ranges = {col: value for col, value in (ranges or {}).items() if col in columns}
+        key = (start_row, end_row, tuple(columns), tuple(sorted(ranges.items())))
+        with self._lock:
+            if key == self._last_key:
+                return self._last_frame.copy()
+
+            tables = []
+            for group in range(self.num_row_groups):
+                group_start = self._group_offsets[group]
+                group_end = group_start + self._file.metadata.row_group(group).num_rows
+                if group_end <= start_row or group_start >= end_row:
+                    continue
+                # 行组的min/max与范围条件不相交时整体跳过
+                skipped = False
+                for col, (low, high) in ranges.items():
+                    stats = self._group_stats(group, col)
+                    if stats is not None and (stats[1] < low or stats[0] > high):
+                        skipped = True
+                        break
+                if skipped:
+                    continue
+                table = self._file.read_row_group(group, columns=columns)
+                low_offset = max(start_row - group_start, 0)
+                high_offset = min(end_row, group_end) - group_start
+                table = table.slice(low_offset, high_offset - low_offset)
+                row_numbers = pa.array(range(group_start + low_offset, group_start + high_offset), pa.int64())
+                tables.append(table.append_column("__row__", row_numbers))
+
+            if tables:
+                table = pa.concat_tables(tables)
+            else:
+                table = self.schema.empty_table().select(columns)
+                table = table.append_column("__row__", pa.array([], pa.int64()))
+            for col, (low, high) in ranges.items():
+                mask = pc.and_(pc.greater_equal(table[col], low), pc.less_equal(table[col], high))
+                table = table.filter(mask)
+
+            # 忽略pandas元数据，pandas写入的具名索引（如id）按普通列读取，与columns一致
+            frame = table.select(columns).to_pandas(ignore_metadata=True)
+            frame.index = pd.Index(table["__row__"].to_numpy(), name=None)
+            self.last_read_stats = {
+                "row_groups_read": len(tables),
+                "row_groups_total": self.num_row_groups,
+                "columns_read": len(columns),
+                "columns_total": len(self.columns)
+            }
+            self._last_key = key
+            self._last_frame = frame
+        if self.on_materialize is not None:
+            self.on_materialize()
+        return frame.copy()
+
+    def memory_bytes(self):
+        """原始文件字节数加上最近一次读取结果占用的内存"""
+        return len(self._content) + _estimate_result_bytes(self._last_frame)
+
+
+# 检测TXT文件分隔符时读取的字节前缀大小和最多检查的行数
+SNIFF_SAMPLE_BYTES = int(os.getenv("SNIFF_SAMPLE_BYTES", 64 * 1024))
+SNIFF_MAX_LINES = 50
+# 候选分隔符，列数一致性相同时优先选择靠前的分隔符
+SNIFF_SEPARATORS = [',', '\t', ';', '|', ' ']
+
+
+@contextmanager
+def _text_stream(file_obj, encoding, newline=None):
+    """把二进制文件对象包装为文本流，结束时分离包装器，避免关闭原文件"""
+    wrapper = io.TextIOWrapper(file_obj, encoding=encoding, newline=newline)
+    try:
+        yield wrapper
+    finally:
+        wrapper.detach()
+
+
+def _field_count_score(counts):
+    """返回(众数列数出现的行数, 众数列数)，众数列数不大于1时返回None"""
+    if not counts:
+        return None
+    most_common_cols = max(set(counts), key=counts.count)
+    if most_common_cols <= 1:
+        return None
+    return counts.count(most_common_cols), most_common_cols
+
+
+def sniff_delimiter(file_obj, encoding, sample_bytes=SNIFF_SAMPLE_BYTES):
+    """
+    只读取文件开头的字节前缀，检测分隔符和引号处理方式，不改变文件的读取位置
+
+    对每个候选分隔符分别按"识别引号"和"直接切分"统计各行列数，
+    选择列数一致的行最多且列数大于1的组合。
+
+    Returns:
+        dict: sep（分隔符）、quoting（csv模块的引号模式）、lines（样本中的非空行数）
+    """
+    position = file_obj.tell()
+    file_obj.seek(0)
+    sample = file_obj.read(sample_bytes)
+    file_obj.seek(position)
+
+    lines = sample.decode(encoding, errors="ignore").splitlines()
+    if len(sample) == sample_bytes and len(lines) > 1:
+        # 前缀末尾的行可能被截断
+        lines = lines[:-1]
+    lines = [line for line in lines if line.strip()][:SNIFF_MAX_LINES]
+
+    best = {"sep": ',', "quoting": csv.QUOTE_MINIMAL, "lines": len(lines)}
+    best_score = None
+    for sep in SNIFF_SEPARATORS:
+        if sep == ' ':
+            plain_counts = [len(line.split()) for line in lines]
+        else:
+            plain_counts = [len(line.split(sep)) for line in lines]
+        quoted_counts = [len(row) for row in csv.reader(lines, delimiter=sep, quotechar='"',
+                                                        skipinitialspace=True)]
+        quoted_score = _field_count_score(quoted_counts)
+        plain_score = _field_count_score(plain_counts)
+        # 默认识别引号；只有直接切分明显更一致时（如数据中有不成对的引号）才关闭引号处理
+        if plain_score is not None and (quoted_score is None or plain_score[0] > quoted_score[0]):
+            score, quoting = plain_score, csv.QUOTE_NONE
+        else:
+            score, quoting = quoted_score, csv.QUOTE_MINIMAL
+        if score is not None and (best_score is None or score[0] > best_score[0]):
+            best_score = score
+            best = {"sep": sep, "quoting": quoting, "lines": len(lines)}
+    return best
+
+
+def _recover_bad_lines(df, file_obj, line_numbers, sep, quoting, encoding):
+    """
+    用Python引擎只重新解析C引擎跳过的记录（多出的字段被截断），并按原始顺序插回
+
+    C引擎警告中的行号是记录序号（含空行），引号内带换行的字段会让记录序号与物理行号错开，
+    因此按与C引擎相同的引号规则逐条读取记录来定位，而不是按物理行定位。
+    """
+    targets = set(line_numbers)
+    last_target = max(targets)
+    bad_records = []
+    positions = []
+    good_rows = 0
+    header_seen = False
+    file_obj.seek(0)
+    with _text_stream(file_obj, encoding, newline="") as stream:
+        reader = csv.reader(stream, delimiter=sep, quotechar='"', quoting=quoting,
+                            skipinitialspace=True)
+        for record_number, fields in enumerate(reader, 1):
+            if sep == ' ':
+                # 空白分隔时连续空格和行首行尾空格不产生字段
+                fields = [field for field in fields if field]
+            if record_number in targets:
+                bad_records.append(fields)
+                positions.append(good_rows)
+            elif not fields:
+                continue
+            elif not header_seen:
+                header_seen = True
+            else:
+                good_rows += 1
+            if record_number >= last_target:
+                break
+
+    columns = list(df.columns)
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(bad_records)
+    buffer.seek(0)
+    with warnings.catch_warnings():
+        # 截断的行已记录在加载信息中并提示用户
+        warnings.simplefilter("ignore", pd.errors.ParserWarning)
+        recovered = pd.read_csv(
+            buffer,
+            header=None,
+            names=columns,
+            index_col=False,
+            engine='python',
+            on_bad_lines=lambda fields: fields[:len(columns)]
+        )
+    # 被跳过的行排在其后第一条正常行之前
+    df.index = np.arange(len(df), dtype=float)
+    recovered.index = np.array(positions[:len(recovered)], dtype=float) - 0.5
+    return pd.concat([df, recovered]).sort_index(kind="stable").reset_index(drop=True)
+
+
+def read_text_table(file_obj, sep, quoting, encoding):
+    """
+    使用C引擎解析分隔符文本，列数超出的记录交给Python引擎单独处理
+
+    Returns:
+        (pandas.DataFrame, 多余字段被截断的记录序号列表)
+    """
+    file_obj.seek(0)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always", pd.errors.ParserWarning)
+        df = pd.read_csv(
+            file_obj,
+            sep=r"\s+" if sep == ' ' else sep,
+            quoting=quoting,
+            encoding=encoding,
+            on_bad_lines='warn',   # 记录有问题的行号，稍后单独处理
+            skipinitialspace=True  # 跳过分隔符后的空格
+        )
+    line_numbers = sorted({
+        int(number)
+        for warning in caught if issubclass(warning.category, pd.errors.ParserWarning)
+        for number in re.findall(r"Skipping line (\d+)", str(warning.message))
+    })
+    if line_numbers:
+        df = _recover_bad_lines(df, file_obj, line_numbers, sep, quoting, encoding)
+    return df, line_numbers
+
+
+def _read_delimited(uploaded_file, sep, encoding, streaming, streaming_options, engine, arrow_dtypes):
+    """按加载选项读取CSV/TSV文件，PyArrow解析失败时回退到C引擎"""
+    if streaming:
+        # 大文件分块流式读取，控制内存峰值
+        return read_csv_streaming(uploaded_file, sep=sep, encoding=encoding, **streaming_options)
+    if engine == "pyarrow":
+        try:
+            return read_csv_arrow(uploaded_file, sep=sep, encoding=encoding, arrow_dtypes=arrow_dtypes)
+        except (pa.ArrowInvalid, UnicodeDecodeError) as e:
+            print(f"PyArrow解析失败，回退到C引擎: {str(e)}")
+            uploaded_file.seek(0)
+    return pd.read_csv(uploaded_file, sep=sep, encoding=encoding)
+
+
+def _read_json_content(uploaded_file, encoding, streaming, streaming_options, engine, arrow_dtypes):
+    """
+    按给定编码读取JSON文件
+
+    Returns:
+        JSON Lines文件返回DataFrame，JSON文档返回解析出的列表或字典
+    """
+    if _is_json_lines(uploaded_file, encoding):
+        if engine == "pyarrow" and not streaming and encoding.startswith("utf-8"):
+            # PyArrow多线程解析JSON Lines，失败时回退到orjson逐行解析
+            try:
+                return read_json_lines_arrow(uploaded_file, arrow_dtypes=arrow_dtypes)
+            except pa.ArrowInvalid as e:
+                print(f"PyArrow解析失败，回退到orjson: {str(e)}")
+                uploaded_file.seek(0)
+        if streaming:
+            return read_json_lines(uploaded_file, encoding, **streaming_options)
+        return read_json_lines(uploaded_file, encoding,
+                               progress_callback=streaming_options["progress_callback"])
+
+    content = uploaded_file.read()
+    if encoding.startswith("utf-8"):
+        # orjson直接解析UTF-8字节，省去解码出的字符串副本
+        content = content.removeprefix(codecs.BOM_UTF8)
+    else:
+        content = content.decode(encoding)
+
+    try:
+        return _loads_json(content, encoding)
+    except orjson.JSONDecodeError as e:
+        raise ValueError(f"JSON格式错误: {str(e)}")
+
+
+def load_data_file(uploaded_file, file_type_option, parallel_sheets=False, streaming=False,
+                   memory_limit_mb=STREAMING_MEMORY_LIMIT_MB, sample_on_limit=False,
+                   progress_callback=None, engine="c", arrow_dtypes=False, parquet_pushdown=False,
+                   optimize_memory=False):
+    """
+    加载不同格式的数据文件
+    
+    Args:
+        uploaded_file: Streamlit上传的文件对象
+        file_type_option: 用户选择的文件类型选项
+        parallel_sheets: 多工作表Excel文件较大时，是否在进程池中并行预解析全部工作表
+        streaming: CSV/TSV/JSON Lines文件是否分块流式读取
+        memory_limit_mb: 流式读取时解析结果的内存上限（MB）
+        sample_on_limit: 流式读取超出内存上限时是否改为抽样，否则报错停止
+        progress_callback: 流式读取的进度回调函数，参数为(已读取比例, 已读取行数)
+        engine: CSV/TSV/TXT/JSON Lines的解析引擎，"c"或"pyarrow"（多线程，流式读取时不适用）
+        arrow_dtypes: 使用pyarrow引擎时是否保留ArrowDtype列
+        parquet_pushdown: Parquet文件是否只读取元数据，数据在筛选时按列和范围条件按需读取
+        optimize_memory: 流式读取时是否逐块压缩内存（见optimize_dataframe_memory）
+    
+    文件名以.gz/.zst/.bz2/.zip结尾时按压缩文件处理，文本格式边解压边解析。
+    
+    Returns:
+        pandas.DataFrame、包含多个工作表的字典（工作表按需解析）或包含Parquet数据源的字典
+    """
+    file_extension = uploaded_file.name.split('.')[-1].lower()
+    streaming_options = {
+        "memory_limit_mb": memory_limit_mb,
+        "sample_on_limit": sample_on_limit,
+        "progress_callback": progress_callback,
+        "shrink": optimize_memory
+    }
+    
+    try:
+        # 压缩文件包装为流式解压视图，解析器按普通文件读取
+        uploaded_file, compression = open_decompressed(uploaded_file)
+        
+        if file_type_option.startswith("Excel"):
+            # Excel文件处理：先只读获取工作表元数据，工作表内容按需解析
+            try:
+                content = uploaded_file.read()
+                sheets = LazyExcelSheets(content)
+                if len(sheets.sheet_names) > 1:
+                    # 多个工作表，返回按需解析的工作表集合
+                    if sheets.all_empty():
+                        raise ValueError("所有工作表都为空")
+                    if parallel_sheets and len(content) >= EXCEL_PARALLEL_MIN_BYTES:
+                        sheets.preload()
+                    return {"sheets": sheets}
+                else:
+                    # 单个工作表
+                    return pd.read_excel(io.BytesIO(content))
+            except Exception as e:
+                raise ValueError(f"Excel文件读取失败: {str(e)}")
                 
         elif file_type_option.startswith("CSV"):
-            # CSV文件处理，添加编码检测和错误处理
-            try:
-                return pd.read_csv(uploaded_file, encoding='utf-8')
-            except UnicodeDecodeError:
-                try:
-                    return pd.read_csv(uploaded_file, encoding='gbk')
-                except UnicodeDecodeError:
-                    return pd.read_csv(uploaded_file, encoding='latin-1')
+            # CSV文件处理：基于字节样本检测编码后严格解析，样本之后出现非法字节时换用其他编码
+            detected = detect_encoding(uploaded_file)
+            df, encoding = parse_with_encoding_fallback(
+                uploaded_file, detected,
+                lambda candidate: _read_delimited(uploaded_file, ',', candidate, streaming, streaming_options,
+                                                  engine, arrow_dtypes)
+            )
+            return _with_load_summary(df, encoding=encoding, detected_encoding=detected)
             
         elif file_type_option.startswith("JSON"):
-            # JSON文件处理，支持多种JSON结构
-            content = uploaded_file.read()
-            if isinstance(content, bytes):
-                content = content.decode('utf-8')
-            
-            try:
-                json_data = json.loads(content)
-            except json.JSONDecodeError as e:
-                raise ValueError(f"JSON格式错误: {str(e)}")
+            # JSON文件处理，支持JSON Lines和多种JSON文档结构
+            detected = detect_encoding(uploaded_file)
+            json_data, encoding = parse_with_encoding_fallback(
+                uploaded_file, detected,
+                lambda candidate: _read_json_content(uploaded_file, candidate, streaming, streaming_options,
+                                                     engine, arrow_dtypes)
+            )
+            if isinstance(json_data, pd.DataFrame):
+                return _with_load_summary(json_data, encoding=encoding, format="JSON Lines",
+                                          detected_encoding=detected)
             
             # 尝试不同的JSON结构
             if isinstance(json_data, list):
                 if len(json_data) == 0:
                     raise ValueError("JSON数组为空")
-                return pd.DataFrame(json_data)
+                df = flatten_nested_columns(pd.DataFrame(json_data))
+                return _with_load_summary(df, encoding=encoding, detected_encoding=detected)
             elif isinstance(json_data, dict):
                 # 检查是否包含数据数组
                 for key, value in json_data.items():
                     if isinstance(value, list) and len(value) > 0:
                         if isinstance(value[0], dict):
-                            return pd.DataFrame(value)
+                            df = flatten_nested_columns(pd.DataFrame(value))
+                            return _with_load_summary(df, encoding=encoding, detected_encoding=detected)
                 
-                # 如果是嵌套字典，尝试normalize
-                try:
-                    return pd.json_normalize(json_data)
-                except Exception:
-                    # 如果normalize失败，将字典转换为单行DataFrame
-                    return pd.DataFrame([json_data])
+                # 嵌套字典按列展开为单行DataFrame
+                df = flatten_nested_columns(pd.DataFrame([json_data]))
+                return _with_load_summary(df, encoding=encoding, detected_encoding=detected)
             else:
                 raise ValueError("不支持的JSON格式，请确保JSON包含数组或对象结构")
                 
         elif file_type_option.startswith("TSV"):
             # TSV文件处理
-            return pd.read_csv(uploaded_file, sep='\t')
+            detected = detect_encoding(uploaded_file)
+            df, encoding = parse_with_encoding_fallback(
+                uploaded_file, detected,
+                lambda candidate: _read_delimited(uploaded_file, '\t', candidate, streaming, streaming_options,
+                                                  engine, arrow_dtypes)
+            )
+            return _with_load_summary(df, encoding=encoding, detected_encoding=detected)
             
         elif file_type_option.startswith("Parquet"):
             # Parquet文件处理
+            if parquet_pushdown:
+                # 只读取schema和行组统计，数据按筛选条件按需读取
+                return {"parquet": ParquetSource(uploaded_file.read())}
+            if compression:
+                # Parquet需要随机访问文件尾部的元数据，解压到内存后再读取
+                return pd.read_parquet(io.BytesIO(uploaded_file.read()))
             return pd.read_parquet(uploaded_file)
             
         elif file_type_option.startswith("TXT"):
-            # TXT文件处理（假设是分隔符分隔的数据）
-            content = uploaded_file.read()
-            if isinstance(content, bytes):
-                content = content.decode('utf-8')
-            
-            # 尝试检测分隔符
-            lines = content.strip().split('\n')
-            if len(lines) < 2:
+            # TXT文件处理（假设是分隔符分隔的数据），只读取文件前缀检测分隔符
+            detected = detect_encoding(uploaded_file)
+            dialect = sniff_delimiter(uploaded_file, detected)
+            if dialect["lines"] < 2:
                 raise ValueError("TXT文件内容不足，无法解析为表格数据")
+            best_sep, quoting = dialect["sep"], dialect["quoting"]
             
-            # 改进的分隔符检测算法
-            separators = [',', '\t', ';', '|', ' ']
-            best_sep = ','
-            max_consistency = 0
-            
-            # 检查前几行来确定最一致的分隔符
-            sample_lines = lines[:min(10, len(lines))]
-            
-            for sep in separators:
-                col_counts = []
-                for line in sample_lines:
-                    if line.strip():  # 跳过空行
-                        col_counts.append(len(line.split(sep)))
-                
-                if col_counts:
-                    # 计算列数的一致性（相同列数的行数）
-                    most_common_cols = max(set(col_counts), key=col_counts.count)
-                    consistency = col_counts.count(most_common_cols)
-                    
-                    # 选择一致性最高且列数大于1的分隔符
-                    if consistency > max_consistency and most_common_cols > 1:
-                        max_consistency = consistency
-                        best_sep = sep
+            if engine == "pyarrow" and best_sep != ' ':
+                # PyArrow多线程解析；遇到列数不一致的行时回退到C引擎，由其保留并报告这些行
+                try:
+                    df = read_csv_arrow(uploaded_file, sep=best_sep, encoding=detected,
+                                        arrow_dtypes=arrow_dtypes,
+                                        quote_char=False if quoting == csv.QUOTE_NONE else '"')
+                    return _with_load_summary(df, encoding=detected, separator=best_sep)
+                except (pa.ArrowInvalid, UnicodeDecodeError) as e:
+                    print(f"PyArrow解析失败，回退到C引擎: {str(e)}")
             
-            # 使用StringIO来模拟文件对象，添加错误处理参数
-            string_io = io.StringIO(content)
             try:
-                return pd.read_csv(
-                    string_io, 
-                    sep=best_sep,
-                    on_bad_lines='skip',  # 跳过有问题的行
-                    engine='python',     # 使用Python引擎，更宽容
-                    skipinitialspace=True  # 跳过分隔符后的空格
+                (df, truncated_lines), encoding = parse_with_encoding_fallback(
+                    uploaded_file, detected,
+                    lambda candidate: read_text_table(uploaded_file, best_sep, quoting, candidate)
                 )
+                return _with_load_summary(df, encoding=encoding, detected_encoding=detected,
+                                          separator=best_sep, truncated_lines=truncated_lines)
             except Exception as csv_error:
-                # 如果CSV解析失败，尝试作为固定宽度文件处理
-                string_io = io.StringIO(content)
+                # 如果CSV解析失败，直接在文件流上尝试作为固定宽度文件处理
+                def read_fixed_width(candidate):
+                    with _text_stream(uploaded_file, candidate) as stream:
+                        return pd.read_fwf(stream)
+
                 try:
-                    return pd.read_fwf(string_io)
+                    df, encoding = parse_with_encoding_fallback(uploaded_file, detected, read_fixed_width)
+                    return _with_load_summary(df, encoding=encoding, detected_encoding=detected)
                 except Exception:
                     raise ValueError(f"无法解析TXT文件格式。原始错误: {str(csv_error)}")
             
@@ -345,3 +3349,169 @@ def load_data_file(uploaded_file, file_type_option):
             
     except Exception as e:
         raise Exception(f"文件解析错误: {str(e)}")
+
+
+# 数据加载缓存的内存预算（字节），可通过环境变量覆盖，默认1GB
+INGESTION_CACHE_MAX_BYTES = int(os.getenv("INGESTION_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+
+
+def _estimate_result_bytes(result):
+    """估算解析结果（DataFrame、工作表集合或Parquet数据源）占用的内存字节数"""
+    if isinstance(result, pd.DataFrame):
+        try:
+            return int(result.memory_usage(deep=True).sum())
+        except Exception:
+            return int(result.memory_usage().sum())
+    if isinstance(result, (LazyExcelSheets, ParquetSource)):
+        return result.memory_bytes()
+    if isinstance(result, dict):
+        return sum(_estimate_result_bytes(value) for value in result.values())
+    return 0
+
+
+class IngestionCache:
+    """按上传文件内容哈希缓存解析结果的LRU缓存
+
+    Streamlit每次交互都会重新执行脚本，该缓存让相同的文件内容和加载选项
+    直接返回已解析的结果，超出内存预算时淘汰最久未使用的条目。
+    按需解析的工作表和Parquet数据在缓存后才被读取，读取后重新计算条目大小。
+    注意：返回的是缓存中的同一对象，调用方不应原地修改。
+    """
+
+    def __init__(self, max_bytes=INGESTION_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.current_bytes = 0
+
+    def get(self, key):
+        """查找缓存条目，命中时将其移到最近使用的位置"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        """写入缓存条目，超出内存预算时按LRU顺序淘汰"""
+        size = _estimate_result_bytes(result)
+        if size > self.max_bytes:
+            # 单个结果超过预算时不缓存，避免把其他条目全部挤出
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, size)
+            self.current_bytes += size
+            self._evict()
+        if isinstance(result, dict):
+            for source in result.values():
+                if isinstance(source, (LazyExcelSheets, ParquetSource)):
+                    source.on_materialize = lambda: self.resize(key)
+
+    def resize(self, key):
+        """重新计算条目的大小（按需解析的数据被读取后调用），超出内存预算时按LRU顺序淘汰"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return
+        # 在缓存锁外估算，避免与数据源自身的锁互相等待
+        size = _estimate_result_bytes(entry[0])
+        with self._lock:
+            current = self._entries.get(key)
+            if current is None or current[0] is not entry[0]:
+                return
+            self.current_bytes += size - current[1]
+            self._entries[key] = (current[0], size)
+            self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        """清空所有缓存条目"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """返回缓存统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+
+# 进程级共享的数据加载缓存，所有会话共用
+ingestion_cache = IngestionCache()
+
+
+def hash_uploaded_file(uploaded_file, chunk_size=8 * 1024 * 1024):
+    """分块计算上传文件内容的哈希值，计算完成后将读取位置重置到开头"""
+    hasher = hashlib.blake2b(digest_size=20)
+    uploaded_file.seek(0)
+    while True:
+        chunk = uploaded_file.read(chunk_size)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    uploaded_file.seek(0)
+    return hasher.hexdigest()
+
+
+def load_data_file_cached(uploaded_file, file_type_option, progress_callback=None, optimize_memory=False,
+                          content_hash=None, **load_options):
+    """
+    带缓存的数据文件加载，相同内容和加载选项的上传直接返回已解析的结果
+
+    Args:
+        uploaded_file: Streamlit上传的文件对象
+        file_type_option: 用户选择的文件类型选项
+        progress_callback: 加载进度回调函数，不参与缓存键的计算
+        optimize_memory: 加载后是否压缩内存（低基数文本列分类化，见optimize_dataframe_memory）
+        content_hash: 调用方已计算的hash_uploaded_file结果，为None时在这里计算
+        **load_options: 透传给load_data_file的加载选项，同时参与缓存键的计算
+
+    Returns:
+        pandas.DataFrame 或包含多个工作表的字典
+    """
+    options_key = "_".join(
+        f"{name}={value}" for name, value in sorted({**load_options, "optimize_memory": optimize_memory}.items())
+    )
+    if content_hash is None:
+        content_hash = hash_uploaded_file(uploaded_file)
+    cache_key = f"{content_hash}_{file_type_option}_{options_key}"
+    result = ingestion_cache.get(cache_key)
+    if result is None:
+        result = load_data_file(uploaded_file, file_type_option, progress_callback=progress_callback,
+                                optimize_memory=optimize_memory, **load_options)
+        if optimize_memory:
+            if isinstance(result, pd.DataFrame):
+                result = optimize_dataframe_memory(result)
+            elif isinstance(result, dict) and "sheets" in result:
+                result["sheets"].enable_memory_optimization()
+        # 数据集指纹直接由文件内容哈希和加载选项推导，无需再哈希解析出的数据
+        fingerprint = hashlib.blake2b(cache_key.encode(), digest_size=16).hexdigest()
+        if isinstance(result, pd.DataFrame):
+            set_dataset_fingerprint(result, fingerprint)
+        else:
+            for source in result.values():
+                source.fingerprint = fingerprint
+        ingestion_cache.put(cache_key, result)
+    return result